@@ -0,0 +1,505 @@
+from __future__ import print_function, division
+
+import argparse
+import gc
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+
+import fitsio
+import numpy as np
+
+# Benchmark the pypeira in this repository, not an installed one
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir)))
+
+import pypeira
+
+from pypeira.core import brightness
+from pypeira.core.binning import bin_pixels
+from pypeira.core.collection import HDUCollection
+from pypeira.core.hdu import HDU, CompactHDU
+from pypeira.io.common import read, iread
+from pypeira.io.reader import _find_files
+
+"""
+Benchmarks of the stages of a typical reduction, run on synthesized Spitzer-like data.
+
+For each number of files given, a directory of 64x32x32 float32 BCD data-cubes with the
+header keywords pypeira uses is written once (and reused by later runs), and each stage is
+timed as the best of a number of repeats.
+
+The inputs of each stage (e.g. the HDUs read into memory) are only built when a stage which
+needs them is run, and not timed. The stages which hold all the image data in memory are
+skipped when it would exceed --max-memory, while the streaming stages read the files one at
+a time using iread(), so they run at any scale, e.g. 100000 files (about 26 GB of data).
+
+The peak memory of each stage is measured in a forked process as the growth of its resident
+set size (RSS), so it covers memory not allocated by Python as well, and 'worker_peak_mb' is
+the largest RSS of any worker process it started, e.g. by read_processes. On Linux the peak
+RSS is reset before each stage, elsewhere it includes the peak of building the inputs.
+
+    python benchmarks/bench_pypeira.py --files 100 1000 --save baseline.json
+    python benchmarks/bench_pypeira.py --files 100 1000 --compare baseline.json
+
+Comparing against a baseline reports the stages which got slower than the given tolerance,
+and exits with a non-zero status if any did, so it can be used in CI.
+"""
+
+# Shape of a subarray data-cube, and the AOR of the synthesized files
+_shape = (64, 32, 32)
+_aorkey = 12345678
+
+# Seconds per frame, and days per second
+_frametime = 0.1
+_sec_to_day = 1 / (3600 * 24)
+
+# Changes smaller than these are noise, and not reported as regressions
+_min_change = {'seconds': 1e-3, 'peak_mb': 1.0, 'worker_peak_mb': 1.0}
+
+# Units of ru_maxrss, which is in bytes on macOS and in kilobytes elsewhere
+_maxrss_unit = 1 if sys.platform == 'darwin' else 1024
+
+
+def synthesize(path, n_files, seed=0):
+    """
+    Writes 'n_files' Spitzer-like BCD files to 'path', unless already there. Each cube holds
+    a Gaussian source on a noisy background, slightly moving around from frame to frame.
+
+    Returns
+    -------
+    str
+        The directory written to.
+    """
+    data_dir = os.path.join(path, 'bcd_{0}'.format(n_files))
+    done = os.path.join(data_dir, '.complete')
+
+    if os.path.exists(done):
+        return data_dir
+
+    if not os.path.isdir(data_dir):
+        os.makedirs(data_dir)
+
+    rng = np.random.RandomState(seed)
+    ys, xs = np.indices(_shape[1:])
+    width = max(4, len(str(n_files - 1)))
+
+    for expid in range(n_files):
+        x = 15 + rng.normal(0, 0.1, (_shape[0], 1, 1))
+        y = 15 + rng.normal(0, 0.1, (_shape[0], 1, 1))
+
+        cube = 1000 * np.exp(-((xs - x) ** 2 + (ys - y) ** 2) / (2 * 1.2 ** 2)) + 10
+        cube = (cube + rng.normal(0, 1, _shape)).astype(np.float32)
+
+        start = expid * _shape[0] * _frametime
+
+        header = [
+            {'name': 'CHNLNUM', 'value': 2},
+            {'name': 'EXPTYPE', 'value': 'sci'},
+            {'name': 'FRAMTIME', 'value': _frametime},
+            {'name': 'AORKEY', 'value': _aorkey},
+            {'name': 'EXPID', 'value': expid},
+            {'name': 'BMJD_OBS', 'value': 56000 + start * _sec_to_day},
+            {'name': 'AINTBEG', 'value': start},
+            {'name': 'ATIMEEND', 'value': start + _shape[0] * _frametime}
+        ]
+
+        fname = 'SPITZER_I2_{0}_{1:0{2}d}_0000_1_bcd.fits'.format(_aorkey, expid, width)
+        fitsio.write(os.path.join(data_dir, fname), cube, header=header, clobber=True)
+
+    open(done, 'w').close()
+
+    return data_dir
+
+
+class _Inputs(object):
+    """
+    The inputs of the stages of a data directory, built on first use, so only the inputs of
+    the stages which are run are built.
+    """
+    def __init__(self, data_dir, workers):
+        self.data_dir = data_dir
+        self.workers = workers
+
+        self._paths = None
+        self._hdus = None
+        self._idx = None
+
+    @property
+    def paths(self):
+        if self._paths is None:
+            self._paths = [p for p in _find_files(self.data_dir) if p.endswith('.fits')]
+
+        return self._paths
+
+    @property
+    def nbytes(self):
+        # Bytes of image data of all the files
+        return len(self.paths) * int(np.prod(_shape)) * 4
+
+    @property
+    def hdus(self):
+        # All the image data, held in memory
+        if self._hdus is None:
+            self._hdus = HDUCollection(read(self.data_dir, dtype='bcd', compact=True))
+
+        return self._hdus
+
+    @property
+    def idx(self):
+        # Index of the brightest pixel, found streaming so the image data is not held
+        if self._idx is None:
+            self._idx = brightness.get_brightest(iread(self.data_dir, dtype='bcd'))[0]
+
+        return self._idx
+
+
+def _consume(items):
+    # Iterates through 'items' without holding on to them
+    n = 0
+
+    for item in items:
+        n += 1
+
+    return n
+
+
+def _stages(inputs):
+    # The stages to benchmark, as (name, needed inputs, holds all the image data, function)
+    # tuples. Each function returns the number of bytes of image data it went through, used
+    # to compute the throughput.
+    data_dir = inputs.data_dir
+    workers = inputs.workers
+
+    def walk():
+        _find_files(data_dir)
+        return 0
+
+    def read_serial():
+        _consume(iread(data_dir, dtype='bcd'))
+        return inputs.nbytes
+
+    def read_threads():
+        _consume(iread(data_dir, dtype='bcd', workers=workers, executor='thread'))
+        return inputs.nbytes
+
+    def read_processes():
+        _consume(iread(data_dir, dtype='bcd', workers=workers, executor='process'))
+        return inputs.nbytes
+
+    def hdu_lazy():
+        [HDU(path, ftype='fits', dtype='bcd', lazy=True) for path in inputs.paths]
+        return 0
+
+    def hdu_compact():
+        [CompactHDU(path, ftype='fits', dtype='bcd', lazy=True) for path in inputs.paths]
+        return 0
+
+    def get_brightest_stream():
+        # Includes reading the files, one at a time
+        brightness.get_brightest(iread(data_dir, dtype='bcd'))
+        return inputs.nbytes
+
+    def light_curve_stream():
+        # Includes reading the files, one at a time
+        bin_pixels(iread(data_dir, dtype='bcd'), [inputs.idx], bin_size=64)
+        return inputs.nbytes
+
+    def get_brightest():
+        brightness.get_brightest(inputs.hdus)
+        return inputs.nbytes
+
+    def pixel_data():
+        # Only touches one pixel of each frame, so the throughput in bytes is not meaningful
+        brightness.pixel_data(inputs.idx, inputs.hdus)
+        return 0
+
+    def plot_brightest():
+        # What IRA.plot_brightest() computes before plotting
+        brightness.pixel_data(brightness.get_brightest(inputs.hdus)[0], inputs.hdus)
+        return inputs.nbytes
+
+    # The stages holding all the image data come last, so it is not held by the others
+    return [
+        ('walk', [], False, walk),
+        ('read_serial', ['paths'], False, read_serial),
+        ('read_threads', ['paths'], False, read_threads),
+        ('read_processes', ['paths'], False, read_processes),
+        ('hdu_lazy', ['paths'], False, hdu_lazy),
+        ('hdu_compact', ['paths'], False, hdu_compact),
+        ('get_brightest_stream', ['paths'], False, get_brightest_stream),
+        ('light_curve_stream', ['paths', 'idx'], False, light_curve_stream),
+        ('get_brightest', ['paths', 'hdus'], True, get_brightest),
+        ('pixel_data', ['hdus', 'idx'], True, pixel_data),
+        ('plot_brightest', ['paths', 'hdus'], True, plot_brightest)
+    ]
+
+
+def _time(func, repeat):
+    # Best of 'repeat' runs, which is the least affected by other processes
+    best = None
+    nbytes = 0
+
+    for i in range(repeat):
+        start = time.perf_counter()
+        nbytes = func()
+        elapsed = time.perf_counter() - start
+
+        best = elapsed if best is None else min(best, elapsed)
+
+    return best, nbytes
+
+
+def _status_kb(field):
+    # A field of /proc/self/status in kilobytes, e.g. VmRSS or VmHWM, None if not available
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1])
+    except (IOError, OSError):
+        pass
+
+    return None
+
+
+def _reset_peak_rss():
+    # Resets the peak RSS (VmHWM) of the process, only possible on Linux
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except (IOError, OSError):
+        pass
+
+
+def _rss():
+    # Current RSS in bytes, or the peak RSS if not available
+    kb = _status_kb('VmRSS')
+
+    if kb is not None:
+        return kb * 1024
+
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * _maxrss_unit
+
+
+def _peak_rss():
+    kb = _status_kb('VmHWM')
+
+    if kb is not None:
+        return kb * 1024
+
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * _maxrss_unit
+
+
+def _measure(func, queue):
+    # Run in a forked process, reporting the growth of its RSS while running 'func', and
+    # the peak RSS of any processes it started
+    try:
+        gc.collect()
+        before = _rss()
+        _reset_peak_rss()
+
+        func()
+
+        peak = max(_peak_rss() - before, 0)
+        workers = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * _maxrss_unit
+
+        queue.put((peak, workers if workers > 0 else None))
+    except Exception:
+        queue.put((None, None))
+        raise
+
+
+def _peak_memory(func):
+    """
+    Returns
+    -------
+    (int, int) or (None, None)
+        The peak memory used by 'func' in bytes, and the peak RSS of any worker processes
+        it started (None if none). (None, None) if processes can not be forked.
+    """
+    try:
+        context = multiprocessing.get_context('fork')
+    except ValueError:
+        return None, None
+
+    queue = context.Queue()
+    process = context.Process(target=_measure, args=(func, queue))
+    process.start()
+
+    result = queue.get()
+    process.join()
+
+    return result
+
+
+def _mb(nbytes):
+    return nbytes / 2 ** 20 if nbytes is not None else None
+
+
+def run(path, counts, repeat=3, workers=4, stages=None, max_memory=4096):
+    """
+    Runs the benchmarks for each number of files in 'counts'.
+
+    Parameters
+    ----------
+    max_memory: float, optional
+        The stages holding all the image data in memory are skipped if it is more than
+        this many MB. Default is 4096.
+
+    Returns
+    -------
+    dict
+        The results, by number of files and stage, along with information on the machine.
+    """
+    results = {
+        'machine': {
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'pypeira': pypeira.__version__,
+            'platform': platform.platform(),
+            'cpus': os.cpu_count()
+        },
+        'results': {}
+    }
+
+    for n_files in counts:
+        inputs = _Inputs(synthesize(path, n_files), workers)
+        stage_results = results['results'].setdefault(str(n_files), {})
+
+        for name, needs, in_memory, func in _stages(inputs):
+            if stages and name not in stages:
+                continue
+
+            if in_memory and _mb(inputs.nbytes) > max_memory:
+                stage_results[name] = {'skipped': "needs {0:.0f} MB of image data in memory".format(_mb(inputs.nbytes))}
+                continue
+
+            # Build the inputs outside of the timings
+            for need in needs:
+                getattr(inputs, need)
+
+            seconds, nbytes = _time(func, repeat)
+            peak, worker_peak = _peak_memory(func)
+
+            stage_results[name] = {
+                'seconds': seconds,
+                'files_per_second': len(inputs.paths) / seconds if seconds > 0 else None,
+                'mb_per_second': _mb(nbytes) / seconds if seconds > 0 and nbytes else None,
+                'peak_mb': _mb(peak),
+                'worker_peak_mb': _mb(worker_peak)
+            }
+
+        # Free the image data before the next data set
+        del inputs
+
+    return results
+
+
+def _format(value, spec):
+    return spec.format(value) if value is not None else '-'
+
+
+def report(results):
+    """ Prints the results as a table. """
+    row = '{0:>8} {1:<22} {2:>10} {3:>12} {4:>10} {5:>10} {6:>12}'
+
+    print(row.format('files', 'stage', 'seconds', 'files/s', 'MB/s', 'peak MB', 'worker MB'))
+
+    for n_files in sorted(results['results'], key=int):
+        for name, stage in results['results'][n_files].items():
+            if 'skipped' in stage:
+                print('{0:>8} {1:<22} skipped, {2}'.format(n_files, name, stage['skipped']))
+                continue
+
+            print(row.format(
+                n_files, name, _format(stage['seconds'], '{0:.4f}'),
+                _format(stage['files_per_second'], '{0:.0f}'),
+                _format(stage['mb_per_second'], '{0:.1f}'),
+                _format(stage['peak_mb'], '{0:.1f}'),
+                _format(stage['worker_peak_mb'], '{0:.1f}')
+            ))
+
+
+def compare(results, baseline, tolerance=0.2):
+    """
+    Compares the results with a baseline.
+
+    Parameters
+    ----------
+    results, baseline: dict
+        As returned by run().
+    tolerance: float, optional
+        The fraction a stage may be slower (or use more memory) than in the baseline before
+        it is reported as a regression. Default is 0.2.
+
+    Returns
+    -------
+    [str, ... ]
+        A description of each regression.
+    """
+    regressions = list()
+
+    for n_files, stages in results['results'].items():
+        for name, stage in stages.items():
+            base = baseline['results'].get(n_files, {}).get(name)
+
+            if base is None:
+                continue
+
+            for key in ('seconds', 'peak_mb', 'worker_peak_mb'):
+                # Skipped stages, and memory which could not be measured, are not compared
+                if stage.get(key) is None or not base.get(key):
+                    continue
+
+                if stage[key] > base[key] * (1 + tolerance) and stage[key] - base[key] > _min_change[key]:
+                    regressions.append('{0} files, {1}: {2} {3:.4g} -> {4:.4g} ({5:+.0%})'.format(
+                        n_files, name, key, base[key], stage[key], stage[key] / base[key] - 1
+                    ))
+
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks pypeira on synthesized Spitzer-like data.")
+    parser.add_argument('--files', type=int, nargs='+', default=[100, 1000],
+                        help="Numbers of files to benchmark, e.g. 100 1000 10000 100000.")
+    parser.add_argument('--data', default=os.path.join(tempfile.gettempdir(), 'pypeira_bench'),
+                        help="Directory for the synthesized files, which are reused by later runs.")
+    parser.add_argument('--repeat', type=int, default=3, help="Runs of each stage, the best is kept.")
+    parser.add_argument('--workers', type=int, default=4, help="Workers of the parallel readers.")
+    parser.add_argument('--stages', nargs='+', help="Only run these stages.")
+    parser.add_argument('--max-memory', type=float, default=4096,
+                        help="Skip the stages holding all the image data in memory if it is more MB than this.")
+    parser.add_argument('--save', help="Save the results to this JSON file, e.g. as a baseline.")
+    parser.add_argument('--compare', help="Compare the results with this JSON baseline.")
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help="Allowed slowdown relative to the baseline, as a fraction.")
+
+    args = parser.parse_args(argv)
+
+    results = run(args.data, args.files, args.repeat, args.workers, args.stages, args.max_memory)
+    report(results)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+
+        for regression in regressions:
+            print("REGRESSION " + regression)
+
+        return 1 if regressions else 0
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,248 @@
+from __future__ import division
+
+import warnings
+
+import numpy as np
+
+from pypeira.core.stack import Stack, as_frames, frame_chunks
+from pypeira.core.masks import bad_pixels
+from pypeira.core.outliers import sigma_clip
+
+"""
+Estimation of the sky background of each frame of a frame stack, i.e. an array of shape
+(n_frames, rows, columns) such as Stack.frames. Each estimator works on all the frames at
+once (in chunks, to bound the memory used), and returns an array of shape (n_frames, )
+aligned with the frames, and so with Stack.times if a Stack is given.
+
+Bad pixels are given by a mask, which is either a boolean array where True marks a bad pixel,
+or an integer bit mask such as the data of the 'bimsk' files accompanying each 'bcd' file,
+see core.masks.bad_pixels(). Reading the 'bimsk' files into a Stack gives a mask aligned with the Stack of the 'bcd' files,
+as both are sorted by the same timestamps.
+"""
+
+
+def apply_mask(frames, mask, bits=None, inplace=False):
+    """
+    Sets the bad pixels of the frames to NaN, which all the estimators ignore.
+
+    Parameters
+    ----------
+    frames: numpy.array or Stack
+        Array of shape (n_frames, rows, columns), or a Stack.
+    mask: numpy.array or Stack
+        A mask broadcastable to the frames, i.e. either one per frame or a single
+        (rows, columns) mask for all the frames. See bad_pixels().
+    bits: int, optional
+        See bad_pixels().
+    inplace: bool, optional
+        If True the frames are modified in place, which requires them to be writable floats.
+        Default is False, i.e. a float64 copy is returned.
+
+    Returns
+    -------
+    numpy.array
+        The frames with the bad pixels set to NaN.
+    """
+    frames = as_frames(frames)
+    bad = bad_pixels(mask, bits)
+
+    if not inplace:
+        frames = frames.astype(np.float64)
+
+    frames[np.broadcast_to(bad, frames.shape)] = np.nan
+
+    return frames
+
+
+def _masked_chunk(frames, mask, bits, chunk):
+    # A float64 copy of a chunk of frames, with the bad pixels set to NaN
+    data = frames[chunk].astype(np.float64)
+
+    if mask is not None:
+        bad = bad_pixels(mask[chunk] if mask.ndim == 3 else mask, bits)
+        data[np.broadcast_to(bad, data.shape)] = np.nan
+
+    return data
+
+
+def _as_mask(mask):
+    # Masks are indexed by chunk alongside the frames, unless shared by all the frames
+    if mask is None:
+        return None
+
+    if isinstance(mask, Stack):
+        mask = mask.frames
+
+    mask = np.asanyarray(mask)
+
+    if mask.ndim not in (2, 3):
+        raise RuntimeError("Mask needs to be of shape (n_frames, rows, columns) or (rows, columns).")
+
+    return mask
+
+
+def sigma_clipped_median(frames, sigma=3, iters=5, mask=None, bits=None, chunk_size=8192):
+    """
+    The median of all the pixels of each frame, after iterative sigma clipping. Suitable
+    when the target only covers a small part of the frames.
+
+    Parameters
+    ----------
+    frames: numpy.array or Stack
+        Array of shape (n_frames, rows, columns), or a Stack.
+    sigma, iters: optional
+        See core.outliers.sigma_clip().
+    mask: numpy.array or Stack, optional
+        Bad pixels to ignore, see apply_mask(). Default is None.
+    bits: int, optional
+        See bad_pixels().
+    chunk_size: int, optional
+        Maximum number of frames processed at once. Default is 8192.
+
+    Returns
+    -------
+    numpy.array
+        The background of each frame.
+    """
+    frames = as_frames(frames)
+    mask = _as_mask(mask)
+    bkg = np.empty(len(frames))
+
+    for chunk in frame_chunks(len(frames), chunk_size):
+        data = _masked_chunk(frames, mask, bits, chunk).reshape(chunk.stop - chunk.start, -1)
+
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            bkg[chunk] = np.nanmedian(sigma_clip(data, sigma, iters), axis=1)
+
+    return bkg
+
+
+def annulus_mode(frames, x, y, r_in=3, r_out=7, sigma=3, iters=5, mask=None, bits=None, chunk_size=8192):
+    """
+    The mode of the pixels within an annulus around the target in each frame, after
+    iterative sigma clipping. The mode is estimated as 3 * median - 2 * mean, which is
+    less biased by the wings of the target and by faint sources than the median.
+
+    Parameters
+    ----------
+    frames: numpy.array or Stack
+        Array of shape (n_frames, rows, columns), or a Stack.
+    x, y: float or numpy.array
+        The x (column) and y (row) center of the annulus, either the same for all the
+        frames or one per frame, e.g. as returned by centroids.centroids.get_centroids().
+    r_in, r_out: float, optional
+        The inner and outer radius of the annulus in pixels. Pixels whose centers are within
+        the annulus are used. Default is 3 and 7.
+    sigma, iters, mask, bits, chunk_size: optional
+        See sigma_clipped_median().
+
+    Returns
+    -------
+    numpy.array
+        The background of each frame.
+    """
+    frames = as_frames(frames)
+    mask = _as_mask(mask)
+    n = len(frames)
+
+    x = np.broadcast_to(np.asarray(x, dtype=np.float64), (n, ))
+    y = np.broadcast_to(np.asarray(y, dtype=np.float64), (n, ))
+
+    bkg = np.empty(n)
+    ys, xs = np.indices(frames.shape[1:])
+
+    for chunk in frame_chunks(n, chunk_size):
+        data = _masked_chunk(frames, mask, bits, chunk)
+
+        # Distance from the center of the annulus in each frame
+        dist2 = (xs - x[chunk, np.newaxis, np.newaxis]) ** 2 + (ys - y[chunk, np.newaxis, np.newaxis]) ** 2
+        data[(dist2 < r_in ** 2) | (dist2 > r_out ** 2)] = np.nan
+
+        data = sigma_clip(data.reshape(len(data), -1), sigma, iters)
+
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            bkg[chunk] = 3 * np.nanmedian(data, axis=1) - 2 * np.nanmean(data, axis=1)
+
+    return bkg
+
+
+def corner_median(frames, size=8, sigma=3, iters=5, mask=None, bits=None, chunk_size=8192):
+    """
+    The median of the pixels in the four 'size' x 'size' corners of each frame, after
+    iterative sigma clipping. Suitable for subarray frames with the target in the center.
+
+    Parameters
+    ----------
+    frames: numpy.array or Stack
+        Array of shape (n_frames, rows, columns), or a Stack.
+    size: int, optional
+        The width of each corner region in pixels. Default is 8.
+    sigma, iters, mask, bits, chunk_size: optional
+        See sigma_clipped_median().
+
+    Returns
+    -------
+    numpy.array
+        The background of each frame.
+    """
+    frames = as_frames(frames)
+    mask = _as_mask(mask)
+    bkg = np.empty(len(frames))
+
+    if 2 * size > min(frames.shape[1:]):
+        raise RuntimeError("Corners of size {0} overlap in frames of shape {1}.".format(size, frames.shape[1:]))
+
+    for chunk in frame_chunks(len(frames), chunk_size):
+        data = _masked_chunk(frames, mask, bits, chunk)
+
+        corners = np.concatenate([
+            data[:, :size, :size], data[:, :size, -size:],
+            data[:, -size:, :size], data[:, -size:, -size:]
+        ], axis=1).reshape(len(data), -1)
+
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            bkg[chunk] = np.nanmedian(sigma_clip(corners, sigma, iters), axis=1)
+
+    return bkg
+
+
+_methods = {
+    'median': sigma_clipped_median,
+    'annulus': annulus_mode,
+    'corners': corner_median
+}
+
+
+def get_background(frames, method='median', *args, **kwargs):
+    """
+    Estimates the background of each frame using the given method.
+
+    Parameters
+    ----------
+    frames: numpy.array or Stack
+        Array of shape (n_frames, rows, columns), or a Stack.
+    method: str, optional
+        One of
+
+            'median' - sigma-clipped median of the whole frame, see sigma_clipped_median(),
+            'annulus' - sigma-clipped mode in an annulus, see annulus_mode(),
+            'corners' - sigma-clipped median of the corners, see corner_median().
+
+        Default is 'median'.
+    *args, **kwargs: optional
+        Passed on to the function of the given method.
+
+    Returns
+    -------
+    numpy.array
+        The background of each frame, aligned with the frames.
+    """
+    func = _methods.get(method)
+
+    if func is None:
+        raise RuntimeError("Unknown background method {0}, must be one of {1}.".format(method, sorted(_methods)))
+
+    return func(frames, *args, **kwargs)
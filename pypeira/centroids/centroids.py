@@ -0,0 +1,416 @@
+from __future__ import division
+
+import warnings
+
+import numpy as np
+
+from pypeira.core.stack import as_frames, frame_chunks
+
+"""
+Centroiding of the frames of a frame stack, i.e. an array of shape (n_frames, rows, columns)
+such as Stack.frames. Each method works on all the frames at once (in chunks, to bound the
+memory used), instead of looping over the frames in Python.
+
+The coordinates returned follow the numpy indexing of the frames, that is 'x' is the column
+and 'y' the row, with the center of pixel [row, column] at (x, y) = (column, row).
+"""
+
+
+def _box_start(frames, center, box):
+    """
+    Finds the top left corner of the 'box' x 'box' stamp, centered on 'center', which
+    the centroids are computed in. If 'center' is None the brightest pixel of the median
+    frame is used, so single hot pixels or cosmic rays do not move the stamp.
+    """
+    rows, cols = frames.shape[1:]
+
+    if box > min(rows, cols):
+        raise RuntimeError("Box of size {0} does not fit in frames of shape {1}.".format(box, (rows, cols)))
+
+    if center is None:
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            median = np.nanmedian(frames[:min(len(frames), 1024)], axis=0)
+
+        if np.all(np.isnan(median)):
+            center = (rows // 2, cols // 2)
+        else:
+            center = np.unravel_index(np.nanargmax(median), median.shape)
+
+    # Keep the box within the frame
+    row0 = int(min(max(int(round(center[0])) - box // 2, 0), rows - box))
+    col0 = int(min(max(int(round(center[1])) - box // 2, 0), cols - box))
+
+    return row0, col0
+
+
+def _border_median(stamps):
+    # Median of the pixels along the edge of each stamp, used as a background estimate
+    border = np.concatenate([stamps[:, 0, :], stamps[:, -1, :], stamps[:, 1:-1, 0], stamps[:, 1:-1, -1]], axis=1)
+
+    with warnings.catch_warnings():
+        # All-NaN stamps give NaN, which is handled by the callers
+        warnings.simplefilter('ignore', RuntimeWarning)
+        return np.nanmedian(border, axis=1)
+
+
+def flux_weighted(frames, center=None, box=7, background=None, chunk_size=65536):
+    """
+    Flux-weighted center-of-light, i.e. the first moments of the background subtracted
+    flux within a box around the target.
+
+    Parameters
+    ----------
+    frames: numpy.array or Stack
+        Array of shape (n_frames, rows, columns), or a Stack.
+    center: (int, int), optional
+        The (row, column) of the pixel the box is centered on. Default is None, which is
+        the brightest pixel of the median frame.
+    box: int, optional
+        The width of the box the centroid is computed in. Default is 7.
+    background: numpy.array or float, optional
+        The background of each frame, subtracted before computing the moments. Default is
+        None, which is the median of the pixels along the edge of the box.
+    chunk_size: int, optional
+        Maximum number of frames processed at once. Default is 65536.
+
+    Returns
+    -------
+    x, y, width: numpy.array, numpy.array, numpy.array
+        The x (column) and y (row) centroids of each frame, and an array of shape (n_frames, 2)
+        holding the widths along x and y, i.e. the square root of the second moments.
+        Frames without any positive flux in the box get NaN.
+    """
+    frames = as_frames(frames)
+    row0, col0 = _box_start(frames, center, box)
+
+    n = len(frames)
+    x, y = np.empty(n), np.empty(n)
+    width = np.empty((n, 2))
+
+    if background is not None:
+        background = np.broadcast_to(np.asarray(background, dtype=np.float64), (n, ))
+
+    # Pixel coordinates of the box
+    ys, xs = np.mgrid[row0:row0 + box, col0:col0 + box].astype(np.float64)
+
+    for chunk in frame_chunks(n, chunk_size):
+        stamps = frames[chunk, row0:row0 + box, col0:col0 + box].astype(np.float64)
+        bg = _border_median(stamps) if background is None else background[chunk]
+
+        # Only the (positive) flux of the target is used as weights, NaNs weigh nothing
+        flux = np.nan_to_num(stamps - bg[:, np.newaxis, np.newaxis])
+        flux = np.clip(flux, 0, None)
+
+        with np.errstate(all='ignore'):
+            total = flux.sum(axis=(1, 2))
+
+            x[chunk] = (flux * xs).sum(axis=(1, 2)) / total
+            y[chunk] = (flux * ys).sum(axis=(1, 2)) / total
+
+            dx = xs - x[chunk, np.newaxis, np.newaxis]
+            dy = ys - y[chunk, np.newaxis, np.newaxis]
+
+            width[chunk, 0] = np.sqrt((flux * dx ** 2).sum(axis=(1, 2)) / total)
+            width[chunk, 1] = np.sqrt((flux * dy ** 2).sum(axis=(1, 2)) / total)
+
+    return x, y, width
+
+
+def _levenberg_marquardt(func, params, data, weights, iters):
+    """
+    Batched Levenberg-Marquardt least squares fit. Fits one model per row of 'data' at once,
+    solving the (small) normal equations of all the fits with a single call to
+    numpy.linalg.solve() per iteration.
+
+    Parameters
+    ----------
+    func: function
+        func(params) returns the model of shape (n_fits, n_points) and its Jacobian of
+        shape (n_fits, n_points, n_params).
+    params: numpy.array
+        Initial guess, of shape (n_fits, n_params).
+    data: numpy.array
+        The data to fit, of shape (n_fits, n_points).
+    weights: numpy.array
+        Weight of each data point, of shape (n_fits, n_points). Zero for missing data.
+    iters: int
+        Number of iterations.
+
+    Returns
+    -------
+    params: numpy.array
+        The fitted parameters.
+    """
+    diag_idx = np.arange(params.shape[1])
+    damping = np.full(len(params), 1e-3)
+
+    model, jac = func(params)
+    chi2 = (weights * (data - model) ** 2).sum(axis=1)
+
+    for i in range(iters):
+        resid = data - model
+
+        # Normal equations (J^T W J + damping * diag(J^T W J)) delta = J^T W r
+        wjac_t = (jac * weights[..., np.newaxis]).transpose(0, 2, 1)
+
+        jtj = np.matmul(wjac_t, jac)
+        jtr = np.matmul(wjac_t, resid[..., np.newaxis])[..., 0]
+
+        # The small constant keeps the system solvable for parameters without any gradient
+        lhs = jtj.copy()
+        lhs[:, diag_idx, diag_idx] += damping[:, np.newaxis] * jtj[:, diag_idx, diag_idx] + 1e-12
+
+        delta = np.linalg.solve(lhs, jtr[..., np.newaxis])[..., 0]
+
+        new_params = params + delta
+        new_model, new_jac = func(new_params)
+
+        with np.errstate(invalid='ignore'):
+            new_chi2 = (weights * (data - new_model) ** 2).sum(axis=1)
+
+        # Keep the steps improving the fit and decrease the damping, otherwise increase it
+        better = new_chi2 < chi2
+
+        params = np.where(better[:, np.newaxis], new_params, params)
+        model = np.where(better[:, np.newaxis], new_model, model)
+        jac = np.where(better[:, np.newaxis, np.newaxis], new_jac, jac)
+        chi2 = np.where(better, new_chi2, chi2)
+
+        damping = np.where(better, damping / 10, damping * 10)
+
+    return params
+
+
+def _gaussian_2d(xs, ys):
+    # Returns the model function of an axis-aligned 2D Gaussian on a background,
+    # with parameters (amplitude, x0, y0, x_width, y_width, background)
+    def func(params):
+        amp, x0, y0, sx, sy, bg = [p[:, np.newaxis] for p in params.T]
+
+        dx = (xs - x0) / sx
+        dy = (ys - y0) / sy
+        gauss = np.exp(-0.5 * (dx ** 2 + dy ** 2))
+
+        model = amp * gauss + bg
+        jac = np.stack([
+            gauss,
+            amp * gauss * dx / sx,
+            amp * gauss * dy / sy,
+            amp * gauss * dx ** 2 / sx,
+            amp * gauss * dy ** 2 / sy,
+            np.ones_like(gauss)
+        ], axis=-1)
+
+        return model, jac
+
+    return func
+
+
+def _gaussian_1d(xs):
+    # Returns the model function of a 1D Gaussian on a background,
+    # with parameters (amplitude, x0, width, background)
+    def func(params):
+        amp, x0, sx, bg = [p[:, np.newaxis] for p in params.T]
+
+        dx = (xs - x0) / sx
+        gauss = np.exp(-0.5 * dx ** 2)
+
+        model = amp * gauss + bg
+        jac = np.stack([
+            gauss,
+            amp * gauss * dx / sx,
+            amp * gauss * dx ** 2 / sx,
+            np.ones_like(gauss)
+        ], axis=-1)
+
+        return model, jac
+
+    return func
+
+
+def _initial_guess(stamps, row0, col0):
+    # Moments of the stamps, used as the starting point of the fits
+    box = stamps.shape[1]
+
+    bg = _border_median(stamps)
+
+    with warnings.catch_warnings():
+        # All-NaN stamps are handled by the callers
+        warnings.simplefilter('ignore', RuntimeWarning)
+        amp = np.nanmax(stamps, axis=(1, 2)) - bg
+
+    x, y, width = flux_weighted(stamps, center=(box // 2, box // 2), box=box, background=bg)
+
+    # Fall back to the center of the box for frames without flux
+    x = np.where(np.isfinite(x), x, (box - 1) / 2) + col0
+    y = np.where(np.isfinite(y), y, (box - 1) / 2) + row0
+    width = np.clip(np.where(np.isfinite(width), width, 1.0), 0.5, box / 2)
+
+    return np.nan_to_num(amp), x, y, width, np.nan_to_num(bg)
+
+
+def gaussian_2d(frames, center=None, box=7, iters=10, chunk_size=16384):
+    """
+    Fits an axis-aligned 2D Gaussian on a constant background to the box around the
+    target in each frame. All the frames of a chunk are fitted simultaneously using a
+    batched Levenberg-Marquardt, starting from the moments of each frame.
+
+    Parameters
+    ----------
+    frames: numpy.array or Stack
+        Array of shape (n_frames, rows, columns), or a Stack.
+    center, box: optional
+        See flux_weighted().
+    iters: int, optional
+        Number of Levenberg-Marquardt iterations. Default is 10.
+    chunk_size: int, optional
+        Maximum number of frames fitted at once. Default is 16384.
+
+    Returns
+    -------
+    x, y, width: numpy.array, numpy.array, numpy.array
+        The fitted x (column) and y (row) centers of each frame, and an array of shape
+        (n_frames, 2) holding the fitted widths (standard deviations) along x and y.
+        Frames without any valid pixels in the box get NaN.
+    """
+    frames = as_frames(frames)
+    row0, col0 = _box_start(frames, center, box)
+
+    n = len(frames)
+    x, y = np.empty(n), np.empty(n)
+    width = np.empty((n, 2))
+
+    ys, xs = np.mgrid[row0:row0 + box, col0:col0 + box].astype(np.float64)
+    func = _gaussian_2d(xs.ravel(), ys.ravel())
+
+    for chunk in frame_chunks(n, chunk_size):
+        stamps = frames[chunk, row0:row0 + box, col0:col0 + box].astype(np.float64)
+
+        amp, x0, y0, w0, bg = _initial_guess(stamps, row0, col0)
+        params = np.column_stack([amp, x0, y0, w0[:, 0], w0[:, 1], bg])
+
+        data = stamps.reshape(len(stamps), -1)
+        weights = np.isfinite(data).astype(np.float64)
+
+        params = _levenberg_marquardt(func, params, np.nan_to_num(data), weights, iters)
+
+        empty = weights.sum(axis=1) == 0
+        params[empty] = np.nan
+
+        x[chunk], y[chunk] = params[:, 1], params[:, 2]
+        width[chunk] = np.abs(params[:, 3:5])
+
+    return x, y, width
+
+
+def gaussian_1d(frames, center=None, box=7, iters=10, chunk_size=65536):
+    """
+    Fits 1D Gaussians on a constant background to the marginal distributions of the box
+    around the target in each frame, i.e. the sums of its columns and rows. Cheaper and
+    more robust than gaussian_2d(), as each fit only has 4 parameters and the marginals
+    have a higher signal to noise ratio. All the x and y marginals of a chunk are fitted
+    simultaneously using a batched Levenberg-Marquardt.
+
+    Parameters
+    ----------
+    frames: numpy.array or Stack
+        Array of shape (n_frames, rows, columns), or a Stack.
+    center, box: optional
+        See flux_weighted().
+    iters: int, optional
+        Number of Levenberg-Marquardt iterations. Default is 10.
+    chunk_size: int, optional
+        Maximum number of frames fitted at once. Default is 65536.
+
+    Returns
+    -------
+    x, y, width: numpy.array, numpy.array, numpy.array
+        The fitted x (column) and y (row) centers of each frame, and an array of shape
+        (n_frames, 2) holding the fitted widths (standard deviations) along x and y.
+        Frames without any valid pixels in the box get NaN.
+    """
+    frames = as_frames(frames)
+    row0, col0 = _box_start(frames, center, box)
+
+    n = len(frames)
+    x, y = np.empty(n), np.empty(n)
+    width = np.empty((n, 2))
+
+    func = _gaussian_1d(np.arange(box, dtype=np.float64))
+
+    for chunk in frame_chunks(n, chunk_size):
+        stamps = frames[chunk, row0:row0 + box, col0:col0 + box].astype(np.float64)
+        valid = np.isfinite(stamps)
+
+        # Marginals along x (summing the rows) and y (summing the columns), where missing
+        # pixels are replaced by the mean of the valid pixels of the same column/row
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            x_marg = np.nanmean(stamps, axis=1) * box
+            y_marg = np.nanmean(stamps, axis=2) * box
+
+        amp, x0, y0, w0, bg = _initial_guess(stamps, 0, 0)
+
+        # Fit the x and y marginals of all the frames as one batch
+        data = np.concatenate([x_marg, y_marg])
+        weights = np.concatenate([valid.any(axis=1), valid.any(axis=2)]).astype(np.float64)
+        params = np.column_stack([
+            np.tile(amp * np.sqrt(2 * np.pi) * w0.mean(axis=1), 2),
+            np.concatenate([x0, y0]),
+            np.concatenate([w0[:, 0], w0[:, 1]]),
+            np.tile(bg * box, 2)
+        ])
+
+        params = _levenberg_marquardt(func, params, np.nan_to_num(data), weights, iters)
+
+        empty = weights.sum(axis=1) == 0
+        params[empty] = np.nan
+
+        m = len(stamps)
+
+        x[chunk] = params[:m, 1] + col0
+        y[chunk] = params[m:, 1] + row0
+        width[chunk, 0] = np.abs(params[:m, 2])
+        width[chunk, 1] = np.abs(params[m:, 2])
+
+    return x, y, width
+
+
+_methods = {
+    'fwc': flux_weighted,
+    'gaussian_2d': gaussian_2d,
+    'gaussian_1d': gaussian_1d
+}
+
+
+def get_centroids(frames, method='fwc', *args, **kwargs):
+    """
+    Computes the centroid of each frame using the given method.
+
+    Parameters
+    ----------
+    frames: numpy.array or Stack
+        Array of shape (n_frames, rows, columns), or a Stack.
+    method: str, optional
+        One of
+
+            'fwc' - flux-weighted center-of-light, see flux_weighted(),
+            'gaussian_2d' - 2D Gaussian fit, see gaussian_2d(),
+            'gaussian_1d' - 1D Gaussian fits to the marginals, see gaussian_1d().
+
+        Default is 'fwc'.
+    *args, **kwargs: optional
+        Passed on to the function of the given method.
+
+    Returns
+    -------
+    x, y, width: numpy.array, numpy.array, numpy.array
+        See the function of the given method.
+    """
+    func = _methods.get(method)
+
+    if func is None:
+        raise RuntimeError("Unknown centroid method {0}, must be one of {1}.".format(method, sorted(_methods)))
+
+    return func(frames, *args, **kwargs)
@@ -0,0 +1,294 @@
+from __future__ import division
+
+import warnings
+
+import numpy as np
+
+from pypeira.core.outliers import sigma_clip
+from pypeira.core.stack import pixel_indices
+from pypeira.core.time import frame_times
+
+"""
+Binning of light curves and frames along the time axis, e.g. averaging the 64 frames of
+each subarray data-cube, or every N frames, before fitting.
+
+Bins are consecutive groups of 'bin_size' frames, in the order given, so the data should
+be sorted by time (as in a Stack). The last bin holds the remaining frames if their number
+is not a multiple of 'bin_size'. All the bins are computed at once by reshaping the data to
+(n_bins, bin_size, ... ), with the missing frames of the last bin padded with NaN, which
+all the methods ignore.
+
+For data too large to hold at full resolution, BinReducer bins the frames as they are fed
+to it, e.g. by a directory reader, only keeping the frames of the current bin. The frames
+have to be fed in time order, which iread() only does when the files are looked up in a
+catalog, as it otherwise reads them in the order of their paths. Example,
+
+    catalog = ira.catalog("/path/to/AOR")
+    hdus = ira.iread("/path/to/AOR", dtype='bcd', catalog=catalog)
+
+    times, flux, errors = bin_pixels(hdus, [(15, 15)], 64)
+
+For data which fits in memory, an HDUCollection (see core.collection) of the HDUs read
+is in time order as well.
+"""
+
+# Standard error of the median of a normal distribution in units of that of the mean
+median_to_mean_error = np.sqrt(np.pi / 2)
+
+
+def _counts(data):
+    # Number of values which are not NaN in each bin
+    return np.sum(~np.isnan(data), axis=1)
+
+
+def _mean(data, errors, **kwargs):
+    with warnings.catch_warnings():
+        # Bins of only NaNs give NaN
+        warnings.simplefilter('ignore', RuntimeWarning)
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.nanmean(data, axis=1), np.nanstd(data, axis=1) / np.sqrt(_counts(data))
+
+
+def _median(data, errors, **kwargs):
+    mean, error = _mean(data, errors)
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        return np.nanmedian(data, axis=1), median_to_mean_error * error
+
+
+def _clipped_mean(data, errors, sigma=3, iters=5, **kwargs):
+    # Move the frames of each bin to the last axis, so that each row is clipped on its own
+    rows = np.rollaxis(data, 1, data.ndim)
+    shape = rows.shape
+
+    clipped = sigma_clip(rows.reshape(-1, shape[-1]).copy(), sigma, iters)
+
+    return _mean(np.rollaxis(clipped.reshape(shape), -1, 1), errors)
+
+
+def _weighted_mean(data, errors, **kwargs):
+    if errors is None:
+        raise RuntimeError("Errors are needed for the error-weighted mean.")
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        weights = np.where(np.isnan(data), 0, 1 / errors ** 2)
+        total = weights.sum(axis=1)
+
+        return np.nansum(data * weights, axis=1) / total, 1 / np.sqrt(total)
+
+
+_methods = {
+    'mean': _mean,
+    'median': _median,
+    'clipped': _clipped_mean,
+    'weighted': _weighted_mean
+}
+
+
+def _reshape_bins(data, bin_size):
+    # Reshapes to (n_bins, bin_size, ... ), padding the last bin with NaN
+    data = np.asarray(data, dtype=np.float64)
+    pad = -len(data) % bin_size
+
+    if pad:
+        data = np.concatenate([data, np.full((pad, ) + data.shape[1:], np.nan)])
+
+    return data.reshape((len(data) // bin_size, bin_size) + data.shape[1:])
+
+
+def bin_frames(times, values, bin_size=64, method='mean', errors=None, sigma=3, iters=5):
+    """
+    Bins a light curve, a set of light curves or a set of frames along the time axis.
+
+    Parameters
+    ----------
+    times: numpy.array
+        The timestamp of each frame, e.g. Stack.times.
+    values: numpy.array
+        Array of shape (n_frames, ... ), e.g. a light curve of shape (n_frames, ), the pixels
+        returned by core.brightness.pixels_data() or the frames of a Stack.
+    bin_size: int, optional
+        The number of frames in each bin. Default is 64, i.e. one bin per subarray data-cube.
+    method: str, optional
+        One of
+
+            'mean' - the mean of each bin,
+            'median' - the median of each bin,
+            'clipped' - the mean of each bin after iterative sigma clipping,
+            'weighted' - the mean of each bin weighted by the inverse variance given by 'errors'.
+
+        NaNs are ignored by all the methods. Default is 'mean'.
+    errors: numpy.array, optional
+        The uncertainty of each value, of the same shape as 'values'. Required by 'weighted'.
+    sigma, iters: optional
+        See core.outliers.sigma_clip(). Only used by 'clipped'.
+
+    Returns
+    -------
+    times, values, errors: numpy.array, numpy.array, numpy.array
+        The mean time of each bin, the binned values of shape (n_bins, ... ), and their
+        uncertainty, which is the standard error of the mean (or median) of each bin, or
+        the propagated uncertainty for 'weighted'.
+    """
+    func = _methods.get(method)
+
+    if func is None:
+        raise RuntimeError("Unknown binning method {0}, must be one of {1}.".format(method, sorted(_methods)))
+
+    if bin_size < 1:
+        raise RuntimeError("Bin size needs to be positive, not {0}.".format(bin_size))
+
+    if len(times) != len(values):
+        raise RuntimeError("Number of frames ({0}) and timestamps ({1}) do not match."
+                           .format(len(values), len(times)))
+
+    data = _reshape_bins(values, bin_size)
+    errors = _reshape_bins(errors, bin_size) if errors is not None else None
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        bin_times = np.nanmean(_reshape_bins(times, bin_size), axis=1)
+
+    binned, bin_errors = func(data, errors, sigma=sigma, iters=iters)
+
+    return bin_times, binned, bin_errors
+
+
+class BinReducer(object):
+    """
+    Bins frames as they are fed to it, see bin_frames(). Only the binned values and the
+    frames of the current, incomplete bin are kept, so a long light curve never has to be
+    held at full resolution. The frames have to be fed in time order, and either all or
+    none of them with errors.
+    """
+    def __init__(self, bin_size=64, method='mean', sigma=3, iters=5):
+        if method not in _methods:
+            raise RuntimeError("Unknown binning method {0}, must be one of {1}.".format(method, sorted(_methods)))
+
+        self.bin_size = bin_size
+        self.method = method
+        self.sigma = sigma
+        self.iters = iters
+
+        self._pending = None        # (times, values, errors) of the frames of the incomplete bin
+        self._has_errors = None     # Whether the frames come with errors, set by the first update()
+        self._last_time = None      # Time of the last frame fed
+        self._bins = list()         # (times, values, errors) of the complete bins
+
+    def _bin(self, times, values, errors):
+        self._bins.append(bin_frames(times, values, self.bin_size, self.method, errors, self.sigma, self.iters))
+
+    def update(self, times, values, errors=None):
+        """
+        Adds frames, binning all the complete bins.
+
+        Parameters
+        ----------
+        times, values, errors: numpy.array
+            See bin_frames().
+
+        Returns
+        -------
+        self
+
+        Raises
+        ------
+        RuntimeError
+            If 'errors' is given but was not for the previous frames, or the other way around,
+            or if the frames are not in time order, including with respect to the previous.
+        """
+        if self._has_errors is None:
+            self._has_errors = errors is not None
+        elif self._has_errors != (errors is not None):
+            raise RuntimeError("Errors need to be given for either all or none of the frames.")
+
+        times = np.asarray(times, dtype=np.float64)
+        values = np.asarray(values, dtype=np.float64)
+        errors = np.asarray(errors, dtype=np.float64) if errors is not None else None
+
+        if len(times) == 0:
+            return self
+
+        # Bins of frames out of order would mix unrelated times, e.g. of different AORs
+        previous = np.concatenate([[self._last_time if self._last_time is not None else -np.inf], times[:-1]])
+        earlier = np.flatnonzero(times < previous)
+
+        if len(earlier):
+            raise RuntimeError("The frames need to be fed in time order, got {0} after {1}."
+                               .format(times[earlier[0]], previous[earlier[0]]))
+
+        self._last_time = times[-1]
+
+        if self._pending is not None:
+            times = np.concatenate([self._pending[0], times])
+            values = np.concatenate([self._pending[1], values])
+
+            if errors is not None:
+                errors = np.concatenate([self._pending[2], errors])
+
+        n = len(times) - len(times) % self.bin_size
+
+        if n > 0:
+            self._bin(times[:n], values[:n], errors[:n] if errors is not None else None)
+
+        self._pending = (times[n:], values[n:], errors[n:] if errors is not None else None)
+
+        return self
+
+    def result(self):
+        """
+        Bins the remaining frames, if any, and returns all the bins.
+
+        Returns
+        -------
+        times, values, errors: numpy.array, numpy.array, numpy.array
+            See bin_frames().
+        """
+        if self._pending is not None and len(self._pending[0]):
+            self._bin(*self._pending)
+            self._pending = None
+
+        if not self._bins:
+            return np.empty(0), np.empty(0), np.empty(0)
+
+        return tuple(np.concatenate(arrays) for arrays in zip(*self._bins))
+
+
+def bin_pixels(hdus, idxs, bin_size=64, method='mean', sigma=3, iters=5):
+    """
+    Bins the light curves of a set of pixels, reading the HDUs one at a time. Meant to be
+    used with a generator such as io.common.iread(), so only one HDU is held at a time.
+
+    Parameters
+    ----------
+    hdus: iterable of HDU objects
+        The HDUs, in time order, e.g. as yielded by io.common.iread() with a catalog, or an
+        HDUCollection. Exposure objects with a 'bunc' companion (see io.common.read())
+        provide the errors needed by the 'weighted' method.
+    idxs: [(int ... ), ... ]
+        The indices of the pixels, see core.stack.Stack.pixels().
+    bin_size, method, sigma, iters: optional
+        See bin_frames().
+
+    Returns
+    -------
+    times, values, errors: numpy.array, numpy.array, numpy.array
+        See bin_frames(), where the binned values are of shape (n_bins, n_pixels).
+
+    Raises
+    ------
+    RuntimeError
+        If the HDUs are not in time order, see BinReducer.update().
+    """
+    reducer = BinReducer(bin_size, method, sigma, iters)
+
+    for hdu in hdus:
+        rows, columns = pixel_indices(idxs, hdu.ndims)
+        unc = getattr(hdu, 'unc', None)
+
+        reducer.update(frame_times([hdu]), hdu.img[:, rows, columns],
+                       unc[:, rows, columns] if unc is not None else None)
+
+    return reducer.result()
@@ -2,8 +2,12 @@ from __future__ import division
 
 import numpy as np
 
+from pypeira.core.stack import Stack, stamp_indices
+from pypeira.core.collection import HDUCollection
+from pypeira.core.profiler import null_profiler
 
-def get_max(data, max_val=0, idx=0):
+
+def get_max(data, max_val=0, idx=0, mask=None):
     """
 
     Parameters
@@ -16,6 +20,9 @@ def get_max(data, max_val=0, idx=0):
         of the previous comparisons.
     idx: (int, ... ), float
         See get_brightest() for more information.
+    mask: numpy.array, optional
+        Boolean array of the same shape as 'data', where True marks entries to ignore,
+        e.g. the cosmic rays and hot pixels flagged by core.outliers.outlier_mask().
 
     Returns
     -------
@@ -23,24 +30,91 @@ def get_max(data, max_val=0, idx=0):
         idx is the index of the maximum value, represented in a n-tuple of
         the form (dim1, dim2, ... ).
         max_val is a float representing the maximum value in the array.
+        If no entry is greater than the given 'max_val' (or all entries are NaN),
+        the given 'idx' and 'max_val' are returned unchanged.
     """
-    # Use np.ndenumerate(data) to iterate through (idx, val)-pairs
-    # i.e. (i, j, k), data[i][j][k] pairs
-    for i, j in np.ndenumerate(data):
-        if not np.isnan(j) and j > max_val:
-            idx = i
-            max_val = j
+    data = np.asanyarray(data)
+
+    if mask is not None:
+        data = np.where(mask, np.nan, data)
+
+    # np.nanargmax() returns the first occurrence of the maximum in C-order, which is
+    # the same entry the element-wise scan used to pick. It raises for all-NaN input.
+    try:
+        flat_idx = np.nanargmax(data)
+    except ValueError:
+        return idx, max_val
+
+    curr_val = data.flat[flat_idx]
+
+    if curr_val > max_val:
+        idx = tuple(int(i) for i in np.unravel_index(flat_idx, data.shape))
+        max_val = curr_val
 
     return idx, max_val
 
 
-def get_brightest(hdus):
+def get_max_batch(cubes, max_val=0, idx=0, mask=None):
+    """
+    Batched version of get_max(). Reduces a whole stack of equally shaped data-cubes
+    in one pass instead of one Python-level call per cube.
+
+    Parameters
+    ----------
+    cubes: numpy.array or [numpy.array, ... ]
+        Either an array of shape (n_cubes, dim1, dim2, ... ) or an iterable of
+        equally shaped arrays, which will be stacked along a new first axis.
+    max_val: float, optional
+        See get_max().
+    idx: (int, ... ), optional
+        See get_max().
+    mask: numpy.array, optional
+        Boolean array which can be broadcast to the shape of the stacked cubes, where True
+        marks entries to ignore. See get_max().
+
+    Returns
+    -------
+    n, idx, max_val: int, (int, ... ), float
+        n is the position of the cube containing the maximum in 'cubes', idx is the index
+        of the maximum within that cube, and max_val the maximum value itself.
+        If no entry is greater than 'max_val', n will be None and 'idx' and 'max_val'
+        are returned unchanged.
+    """
+    if not isinstance(cubes, np.ndarray):
+        cubes = np.stack([np.asanyarray(cube) for cube in cubes])
+
+    stack_idx, stack_val = get_max(cubes, max_val, None, mask)
+
+    if stack_idx is None:
+        return None, idx, max_val
+
+    return stack_idx[0], stack_idx[1:], stack_val
+
+
+def get_brightest(hdus, batch_size=None, mask=None, profiler=None):
     """
 
     Parameters
     ----------
-    hdus: [HDU objects ... ]
-        A list or tuple of HDU objects containing the image data with entries to be compared.
+    hdus: [HDU objects ... ], HDUCollection or Stack
+        A list or tuple of HDU objects containing the image data with entries to be compared,
+        or an HDUCollection or Stack created from such.
+    batch_size: int, optional
+        If given, the image data of 'batch_size' HDUs at a time are stacked and reduced
+        in one pass using get_max_batch(). This assumes all HDUs in a batch have the same
+        dimensions. Larger batches trade memory for fewer Python-level iterations.
+        Default is None, i.e. each HDU is reduced on its own.
+    mask: numpy.array, optional
+        Boolean mask where True marks the pixels to ignore, see get_max(). Either of the
+        shape of a single frame, e.g. (32, 32), applying to every frame, or of the shape of
+        all the frames stacked, i.e. the frames of a Stack, or for HDUs the image data of
+        all of them concatenated along the data-layers, in the order they are iterated
+        over. An HDUCollection is iterated over in the same (time) order as the frames of
+        the Stack created from it. Default is None.
+    profiler: Profiler object, optional
+        If given, the time spent is added to its 'get_brightest' stage, and the time spent
+        in get_max() or get_max_batch() to its 'get_max' stage, excluding the time spent
+        reading the image data of lazy HDUs. See pypeira.core.profiler. Default is None.
 
     Returns
     -------
@@ -49,29 +123,66 @@ def get_brightest(hdus):
         the form (data-layer, row, column), usually of max lengths (64, 32, 32).
         max_bright is a float representing the brightness of the brightest pixel
         found.
+        If 'hdus' is a Stack the index is of the form (frame, row, column) instead, where
+        the frame is the index into the frames of the Stack.
 
     """
-    # Instantiate variables
-    max_bright = 0
-    idx = 0
+    profiler = profiler if profiler is not None else null_profiler
+
+    with profiler.stage('get_brightest'):
+        if isinstance(hdus, Stack):
+            with profiler.stage('get_max'):
+                return get_max(hdus.frames, mask=mask)
+
+        # Instantiate variables
+        max_bright = 0
+        idx = 0
+
+        # The first data-layer of the next HDU(s) in 'mask', if it covers the frames of all of them
+        offset = 0
 
-    # Iterate through the hdus in the FITS object
-    for hdu in hdus:
-        # Read image data from HDU
-        pxls = hdu.img
+        if batch_size is None:
+            # Iterate through the hdus in the FITS object
+            for hdu in hdus:
+                img = hdu.img
+                img_mask, offset = _layers_mask(mask, offset, img.shape)
 
-        # Hold the current idxs and brightness
-        curr_idx, curr_bright = get_max(pxls)
+                # Compare with the current maximum, which is carried over between calls
+                with profiler.stage('get_max'):
+                    idx, max_bright = get_max(img, max_bright, idx, img_mask)
+        else:
+            hdus = list(hdus)
 
-        # Compare with maximums
-        if curr_bright > max_bright:
-            max_bright = curr_bright
-            idx = curr_idx
+            # Reduce 'batch_size' cubes at a time
+            for i in range(0, len(hdus), batch_size):
+                cubes = np.stack([np.asanyarray(hdu.img) for hdu in hdus[i:i + batch_size]])
+                cubes_mask, offset = _layers_mask(mask, offset, cubes.shape)
+
+                with profiler.stage('get_max'):
+                    n, idx, max_bright = get_max_batch(cubes, max_bright, idx, cubes_mask)
+
+        if mask is not None and np.ndim(mask) > 2 and offset != len(mask):
+            raise RuntimeError("The mask has {0} frames, but the HDUs have {1}.".format(len(mask), offset))
 
     return idx, max_bright
 
 
-def pixel_data(idx, hdus, zipped=False):
+def _layers_mask(mask, offset, shape):
+    # The part of the mask given to get_brightest() for image data of the given shape, either a
+    # data-cube or several stacked, starting at data-layer 'offset' of the mask. Returns it along
+    # with the offset of the next image data. Masks of a single frame apply to all of them.
+    if mask is None or np.ndim(mask) <= 2:
+        return mask, offset
+
+    layers = int(np.prod(shape[:-2]))
+
+    if offset + layers > len(mask):
+        raise RuntimeError("The mask has {0} frames, but the HDUs have more.".format(len(mask)))
+
+    return np.reshape(mask[offset:offset + layers], shape), offset + layers
+
+
+def pixel_data(idx, hdus, zipped=False, profiler=None):
     """
     Functions as a wrapper for extracting data for a specific pixel for the
     different HDU formats (currently only using FITS).
@@ -80,8 +191,11 @@ def pixel_data(idx, hdus, zipped=False):
     ----------
     idx: (int ... )
         The n-dimensional index of the pixel.
-    hdus: [HDU, ... ]
-        An iterable of HDU objects which contain the relevant data.
+    hdus: [HDU, ... ], HDUCollection or Stack
+        An iterable of HDU objects which contain the relevant data, or an HDUCollection or
+        Stack created from such. The given iterable is not modified. When extracting the data
+        of several pixels, use an HDUCollection (see core.collection) so the HDUs are only
+        sorted once, or a Stack, as each extraction is then a single slice of the stacked data.
     zipped: bool, optional
         Specifies whether or not to return the time and pixel value zipped. That is, if zipped = True
         then the returned values are in the form
@@ -97,41 +211,39 @@ def pixel_data(idx, hdus, zipped=False):
         more convenient to have them in two different lists. Note that lists will still
         have the same order, thus (timestamps[i], pixel_values[i]) for zipped = False is the
         same as the ith pair if we had zipped = True.
+    profiler: Profiler object, optional
+        If given, the time spent is added to its 'pixel_data' stage, and the time spent
+        sorting the HDUs by timestamp to its 'sort' stage. See pypeira.core.profiler.
+        Default is None.
 
     Returns
     -------
     pxl_data: iterable (list for now, might turn into generator if the process turns out to be demanding)
-        The entire set of data for the specified index/pixel in this set of HDUs.
+        The entire set of data for the specified index/pixel in this set of HDUs. The pixel
+        values are always a new float64 array, whether 'hdus' is a Stack or not, so they
+        never alias the image data of the HDUs.
 
     None
         If the file type/extension is not known.
     """
-    # Conversion from secs to BMJD
-    sec_to_day = 1 / (3600 * 24)
+    profiler = profiler if profiler is not None else null_profiler
 
-    # Dimension of data cube / number of images in data cube - normally 64
-    # Assuming same dimension for all data cubes
-    dims = hdus[0].ndims[0]
+    with profiler.stage('pixel_data'):
+        if isinstance(hdus, Stack):
+            # A copy, as the Stack returns a view into its frames, which may be the image
+            # data of the HDUs themselves, see Stack.from_hdus()
+            times, pix_vals = hdus.pixel(idx)
+            pix_vals = pix_vals.astype(np.float64)
+        else:
+            # The HDUs are sorted by their timestamps, without modifying the given iterable.
+            # An HDUCollection only sorts them once, so this is next to free on later calls.
+            with profiler.stage('sort'):
+                if not isinstance(hdus, HDUCollection):
+                    hdus = HDUCollection(hdus)
 
-    # Prove the first HDU to get the total number of entries needed
-    # Assuming all HDUs to have the same dimensions
-    pix_vals = np.empty(dims * len(hdus))
-    times = np.empty(dims * len(hdus))
+                hdus.sorted()
 
-    # Sort the HDUs using the Barycenter Mod. Julian Date of the observation as key
-    hdus.sort(key=lambda x: x.timestamp)
-
-    # Iterate through the HDUs
-    for j in range(0, len(hdus)):
-        # Array of pixel values for
-        np.put(pix_vals, np.arange(j * dims, j * dims + dims), hdus[j].pixel_values(idx))
-
-        # Assume equal time between each integration
-        time_increment = (hdus[j].integ_end - hdus[j].integ_start) / hdus[j].ndims[0]
-        times_curr = [(hdus[j].timestamp + (time_increment * i * sec_to_day)) for i in range(0, hdus[j].ndims[0])]
-
-        # Array of all the timestamps, where we add i * frametime to the timestamp
-        np.put(times, np.arange(j * dims, j * dims + dims), times_curr)
+            times, pix_vals = hdus.pixel(idx)
 
     if zipped:
         # Returns the two arrays zipped in (time, pix_val)-pairs
@@ -139,3 +251,57 @@ def pixel_data(idx, hdus, zipped=False):
     else:
         # Returns the two arrays separate: times, pix_vals
         return times, pix_vals
+
+
+def pixels_data(idxs, hdus):
+    """
+    Extracts the data of several pixels in a single pass over the data, instead of one call
+    of pixel_data() per pixel.
+
+    Parameters
+    ----------
+    idxs: [(int ... ), ... ]
+        The indices of the pixels, each as for pixel_data().
+    hdus: [HDU, ... ], HDUCollection or Stack
+        See pixel_data().
+
+    Returns
+    -------
+    times, pix_vals: numpy.array, numpy.array
+        The timestamps of the frames, and a new float64 array of shape (n_frames, n_pixels)
+        where pix_vals[:, k] is the light curve of the k-th pixel, as for pixel_data().
+    """
+    if isinstance(hdus, Stack):
+        times, pix_vals = hdus.pixels(idxs)
+
+        return times, pix_vals.astype(np.float64)
+
+    if not isinstance(hdus, HDUCollection):
+        hdus = HDUCollection(hdus)
+
+    return hdus.pixels(idxs)
+
+
+def stamp_data(center, size, hdus):
+    """
+    Extracts the data of all the pixels of a square stamp around a pixel in a single pass,
+    e.g. the 5x5 or 7x7 pixels around the target for photometry.pld.
+
+    Parameters
+    ----------
+    center: (int ... )
+        The index of the center pixel, as for pixel_data().
+    size: int
+        The (odd) width of the stamp in pixels.
+    hdus: [HDU, ... ], HDUCollection or Stack
+        See pixel_data().
+
+    Returns
+    -------
+    times, stamps: numpy.array, numpy.array
+        The timestamps of the frames, and an array of shape (n_frames, size, size) holding
+        the stamp of each frame.
+    """
+    times, pix_vals = pixels_data(stamp_indices(center, size), hdus)
+
+    return times, pix_vals.reshape(len(pix_vals), size, size)
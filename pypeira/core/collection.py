@@ -0,0 +1,178 @@
+from __future__ import division
+
+import numpy as np
+
+from pypeira.core.stack import Stack, pixel_indices
+from pypeira.core.time import frame_times
+
+"""
+A time-ordered view of a set of HDUs, computing the order once instead of sorting the
+HDUs every time they are needed in time order. Example,
+
+    hdus = HDUCollection(ira.read("/path/to/AOR", dtype='bcd'))
+
+    times, pix_vals = pixel_data((15, 15), hdus)
+    first_hour = hdus.between(hdus.start, hdus.start + 1 / 24)
+"""
+
+
+class HDUCollection(object):
+    """
+    A collection of HDU objects, ordered by the timestamp of the observation.
+
+    The timestamps are gathered into an array and argsorted once when the collection is
+    created, and the list of HDUs given is not modified. Iterating over and indexing the
+    collection is in time order. The timestamps of the frames and the Stack of the image
+    data are computed on first use and cached.
+    """
+    def __init__(self, hdus):
+        self.hdus = list(hdus)      # The HDUs in the order given
+        self.timestamps = np.array([hdu.timestamp for hdu in self.hdus], dtype=np.float64)
+
+        # Stable, so HDUs with equal timestamps keep the order given
+        self.order = np.argsort(self.timestamps, kind='mergesort')
+        self.sorted_timestamps = self.timestamps[self.order]
+
+        self._sorted = None
+        self._frame_times = None
+        self._stack = None
+
+    def __len__(self):
+        return len(self.hdus)
+
+    def __iter__(self):
+        return iter(self.sorted())
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return HDUCollection(self.sorted()[idx])
+
+        return self.sorted()[idx]
+
+    @property
+    def start(self):
+        """ The earliest timestamp, None if the collection is empty. """
+        return float(self.sorted_timestamps[0]) if len(self) else None
+
+    @property
+    def end(self):
+        """ The latest timestamp, None if the collection is empty. """
+        return float(self.sorted_timestamps[-1]) if len(self) else None
+
+    def sorted(self):
+        """
+        Returns
+        -------
+        [HDU, ... ]
+            The HDUs sorted by timestamp. The list is cached, so do not modify it.
+        """
+        if self._sorted is None:
+            self._sorted = [self.hdus[i] for i in self.order]
+
+        return self._sorted
+
+    @property
+    def frame_times(self):
+        """
+        numpy.array
+            The timestamps of every frame of the HDUs in time order, see core.time.frame_times().
+            The array is cached and shared, so it is read-only.
+        """
+        if self._frame_times is None:
+            self._frame_times = frame_times(self.sorted())
+            self._frame_times.setflags(write=False)
+
+        return self._frame_times
+
+    @property
+    def stack(self):
+        """
+        Stack
+            The image data of the HDUs, see core.stack.Stack.from_hdus(). Created on first use.
+        """
+        if self._stack is None:
+            # The HDUs are already sorted, so this keeps their order
+            self._stack = Stack.from_hdus(self.sorted())
+
+        return self._stack
+
+    def between(self, t0=None, t1=None):
+        """
+        Selects the HDUs observed within a time range, using a binary search of the
+        sorted timestamps.
+
+        Parameters
+        ----------
+        t0, t1: float, optional
+            The inclusive start and end of the range, in the same format as the timestamps
+            (BMJD). Default is None, i.e. no limit.
+
+        Returns
+        -------
+        HDUCollection
+            The HDUs with t0 <= timestamp <= t1.
+        """
+        lo = 0 if t0 is None else np.searchsorted(self.sorted_timestamps, t0, side='left')
+        hi = len(self) if t1 is None else np.searchsorted(self.sorted_timestamps, t1, side='right')
+
+        return self[lo:hi]
+
+    def pixel(self, idx):
+        """
+        Parameters
+        ----------
+        idx: (int ... )
+            The index of the pixel. Either (row, column) or (data-layer, row, column), where
+            the data-layer is ignored, as one wants the values for all the layers.
+
+        Returns
+        -------
+        times, pix_vals: numpy.array, numpy.array
+            The timestamps (see frame_times) and the values of the pixel for each frame, in
+            time order. 'pix_vals' is always a new float64 array, whether it is taken from
+            the Stack, if it has been created, or from each HDU.
+        """
+        if self._stack is not None:
+            return self.frame_times, self._stack.pixel(idx)[1].astype(np.float64)
+
+        hdus = self.sorted()
+
+        # Number of images in data cube - normally 64, assuming same for all data cubes
+        dims = hdus[0].ndims[0]
+        pix_vals = np.empty(dims * len(hdus))
+
+        for j, hdu in enumerate(hdus):
+            pix_vals[j * dims:(j + 1) * dims] = hdu.pixel_values(idx)
+
+        return self.frame_times, pix_vals
+
+    def pixels(self, idxs):
+        """
+        Extracts the values of several pixels in a single pass over the HDUs.
+
+        Parameters
+        ----------
+        idxs: [(int ... ), ... ]
+            The indices of the pixels, see core.stack.Stack.pixels().
+
+        Returns
+        -------
+        times, pix_vals: numpy.array, numpy.array
+            The timestamps (see frame_times), and a new float64 array of shape (n_frames,
+            n_pixels) holding the values of each pixel for each frame, in time order, as
+            for pixel().
+        """
+        if self._stack is not None:
+            return self.frame_times, self._stack.pixels(idxs)[1].astype(np.float64)
+
+        hdus = self.sorted()
+        rows, columns = pixel_indices(idxs, hdus[0].ndims)
+
+        # Number of images in data cube - normally 64, assuming same for all data cubes
+        dims = hdus[0].ndims[0]
+        pix_vals = np.empty((dims * len(hdus), len(rows)))
+
+        for j, hdu in enumerate(hdus):
+            pix_vals[j * dims:(j + 1) * dims] = hdu.img[:, rows, columns]
+
+        return self.frame_times, pix_vals
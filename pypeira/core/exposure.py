@@ -0,0 +1,111 @@
+import numpy as np
+
+from pypeira.core.masks import bad_pixels as _bad_pixels
+
+
+class Exposure(object):
+    """
+    Groups the products of a single exposure, i.e. the HDU of the main product (such as
+    the 'bcd' file) together with the image data of its companion products (such as the
+    'bunc' uncertainties and the 'bimsk' bit mask).
+
+    Attributes not found on the Exposure itself are looked up on the HDU of the main
+    product, so an Exposure can be used wherever an HDU is expected, e.g. Stack.from_hdus().
+    """
+    def __init__(self, hdu, companions=None):
+        self.hdu = hdu                                                  # HDU of the main product
+        self.companions = companions if companions is not None else {}  # Image data of each companion product
+
+    def __getattr__(self, name):
+        # Guard against recursion before 'hdu' is set, e.g. when unpickling. Special methods,
+        # e.g. __getstate__() on Python < 3.11, are not those of the HDU either, or pickling
+        # would only keep the state of the HDU.
+        if name == 'hdu' or name.startswith('__'):
+            raise AttributeError(name)
+
+        return getattr(self.hdu, name)
+
+    @property
+    def unc(self):
+        """ The image data of the 'bunc' (uncertainty) product, None if not read. """
+        return self.companions.get('bunc')
+
+    @property
+    def mask(self):
+        """ The image data of the 'bimsk' (bit mask) product, None if not read. """
+        return self.companions.get('bimsk')
+
+    def bad_pixels(self, bits=None):
+        """
+        Parameters
+        ----------
+        bits: int, optional
+            The bits of the bit mask which mark a pixel as bad. Default is None, which
+            is any set bit.
+
+        Returns
+        -------
+        numpy.array
+            Boolean array of the same shape as the image data, where True marks a bad pixel.
+            All False if no mask has been read.
+        """
+        if self.mask is None:
+            return np.zeros(self.img.shape, dtype=np.bool_)
+
+        return _bad_pixels(self.mask, bits)
+
+    def masked(self, bits=None):
+        """
+        Returns the image data as a masked array, masking the bad pixels. The image data is
+        not copied, so the masked array is a view of 'img'.
+
+        Parameters
+        ----------
+        bits: int, optional
+            See bad_pixels().
+
+        Returns
+        -------
+        numpy.ma.MaskedArray
+        """
+        return np.ma.MaskedArray(self.img, mask=self.bad_pixels(bits), copy=False)
+
+    def nan_filled(self, bits=None, inplace=False):
+        """
+        Returns the image data with the bad pixels set to NaN. Use masked() for a view of the
+        image data which leaves it as it is.
+
+        Parameters
+        ----------
+        bits: int, optional
+            See bad_pixels().
+        inplace: bool, optional
+            If True the image data of the HDU is modified in place, so no copy is made, which
+            requires it to be writable, i.e. not memory mapped. Default is False, i.e. a copy
+            is returned and the HDU is left as it is.
+
+        Returns
+        -------
+        numpy.array
+            The image data with the bad pixels set to NaN.
+
+        Raises
+        ------
+        RuntimeError
+            If the image data is not of a floating point type, which can not hold NaN, or
+            if 'inplace' is True and the image data is read-only.
+        """
+        img = self.img
+
+        if img.dtype.kind != 'f':
+            raise RuntimeError("Image data of type {0} can not hold NaN.".format(img.dtype))
+
+        if not inplace:
+            img = np.array(img, dtype=img.dtype.newbyteorder('='))
+        elif not img.flags.writeable:
+            raise RuntimeError("Image data of {0} is read-only, and can not be modified in place."
+                               .format(self.path))
+
+        np.copyto(img, np.nan, where=self.bad_pixels(bits))
+
+        return img
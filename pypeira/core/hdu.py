@@ -1,90 +1,173 @@
 import numpy as np
 import os.path
 
-from pypeira.io.reader import _read_file
+from pypeira.io.reader import _read_file, _match_file, parse_filename
 from pypeira.core.brightness import get_max
 
 
-class HDU(object):
+class _BaseHDU(object):
     """
-    Will function as a standardized Header Data Unit for this package.
-
-    The plan is that there will be subclasses of this, either specific to
-    the source of the data or to the file the HDU is created from. This
-    is something that would depend on how similar the header files of
-    the different telescopes are, if FITS is the standard for ALL, etc.
-    Would like to discuss this with mentor if possible.
-
-    Original plan was to leverage the FITS objects from fitsio, which provides both
-    performance (parser written in C and Fortran). As it turns out you run into
-    quite a bit of problems when iterating over a large number of FITS files,
-    as the number of simultaneously "opened" is quite limited.
+    The methods shared by HDU and CompactHDU. Holds no attributes itself, so that
+    CompactHDU can be defined using __slots__.
     """
-    def __init__(self, path, ftype=None, dtype=None, *args, **kwargs):
+    __slots__ = ()
 
+    def _init(self, path, ftype, dtype, lazy, args, kwargs):
         self.path = path
         self.ftype = ftype
         self.dtype = dtype
+        self.lazy = lazy
 
-        # Get the name of the file
-        if os.path.isfile(path):
-            self.filename = os.path.split(path)[1]
-        else:
-            raise RuntimeError("{0} is not a file.".format(path))
+        # Times the reads of the file, see pypeira.core.profiler. Not kept when pickled.
+        self.profiler = kwargs.pop('profiler', None)
+
+        # Kept for reading the image data at a later point
+        self._args = args
+        self._kwargs = kwargs
+
+        # Identifiers of the exposure from the file name, None if it does not follow the
+        # Spitzer naming convention. See io.reader.parse_filename().
+        info = parse_filename(path) or {}
+
+        self.channel = info.get('channel')  # Channel number
+        self.aorkey = info.get('aorkey')    # Astronomical Observation Request key
+        self.expid = info.get('expid')      # Exposure number
+        self.dce = info.get('dce')          # Data Collection Event number
 
         self.naxis = None           # Number of axes
-        self.ndims = None           # Array of dimensions for each axis in order with greatest numbered axis first
+        self.ndims = None           # Dimensions for each axis in order with greatest numbered axis first
         self.timestamp = None       # The timestamp of the observation in BMJD
         self.integ_start = None     # Time of integration start
         self.integ_end = None     # Time of integration end
         self.frametime = None       # Integration time for whole array
 
+        self._header = None
+        self._image = None
+
+        # Header table and row holding the header values instead of '_header', see to_table()
+        self._table = None
+        self._row = None
+
+        # Files which would not be read anyway are discarded by name, without touching the file system
+        if not _match_file(path, ftype, dtype):
+            return
+
+        if not os.path.isfile(path):
+            raise RuntimeError("{0} is not a file.".format(path))
+
         # Read the file
-        data = self._read(*args, **kwargs)
+        if lazy:
+            data = self._read(headers_only=True, *args, **kwargs)
+
+            # Image data is read on first access of 'img'
+            if data is not None:
+                data = (data, None)
+        else:
+            data = self._read(*args, **kwargs)
 
         if data:
             self._header = data[0]
             self._image = data[1]
 
             self.init_from_hdr()
-        else:
-            self._header = None
-            self._image = None
 
     def _read(self, *args, **kwargs):
         return _read_file(
             self.path,
             ftype=self.ftype,
             data_type=self.dtype,
+            profiler=self.profiler,
             *args,
             **kwargs
         )
 
     def init_from_hdr(self):
-        self.naxis = self.hdr.get('NAXIS')
-        self.ndims = np.zeros(self.naxis)
+        hdr = self.hdr
 
-        # Iterate through each NAXIS keyword of the header to get the dimensions
-        for i in range(1, self.naxis + 1):
-            self.ndims[self.naxis - i] = self.hdr.get('NAXIS{0}'.format(i))
+        self.naxis = hdr.get('NAXIS')
 
-        self.ndims = self.ndims.astype(np.dtype('int64'))
+        # Iterate through each NAXIS keyword of the header to get the dimensions
+        self.ndims = tuple(int(hdr.get('NAXIS{0}'.format(i))) for i in range(self.naxis, 0, -1))
 
-        self.timestamp = self.hdr.get('BMJD_OBS')
-        self.integ_start = self.hdr.get('AINTBEG')
-        self.integ_end = self.hdr.get('ATIMEEND')
-        self.frametime = self.hdr.get('FRAMTIME')
+        self.timestamp = hdr.get('BMJD_OBS')
+        self.integ_start = hdr.get('AINTBEG')
+        self.integ_end = hdr.get('ATIMEEND')
+        self.frametime = hdr.get('FRAMTIME')
 
     @property
     def hdr(self):
+        if self._table is not None:
+            return self._table.row(self._row)
+
         return self._header
 
+    def to_table(self, table):
+        """
+        Moves the header values of the HDU into a header table, dropping the full header.
+        Only the keywords stored by the table are kept, and 'hdr' returns a view of its row.
+
+        Parameters
+        ----------
+        table: HeaderTable object
+            See pypeira.core.header_table.
+
+        Returns
+        -------
+        int
+            The row of the HDU in the table.
+        """
+        if self._header is not None:
+            self._row = table.append(self._header)
+            self._table = table
+            self._header = None
+
+        return self._row
+
     @property
     def img(self):
+        # Read the image data if it has not been read yet, or has been released
+        if self._image is None and (self._header is not None or self._table is not None):
+            self._image = self._read(image_only=True, *self._args, **self._kwargs)
+
         return self._image
 
+    @property
+    def is_loaded(self):
+        return self._image is not None
+
+    def release(self):
+        """
+        Releases the image data of the HDU, freeing its memory as long as there are
+        no other references to it. The data will be read again on the next access of 'img'.
+        """
+        self._image = None
+
+    def share_image(self, image):
+        """
+        Replaces the image data of the HDU by 'image', typically a view of a larger array
+        holding the data of many HDUs, so that the HDU no longer owns a copy of its own.
+
+        Parameters
+        ----------
+        image: numpy.array
+            Array of the same shape as the image data.
+        """
+        if self.ndims is not None and tuple(image.shape) != tuple(self.ndims):
+            raise RuntimeError("Image of shape {0} does not match HDU of shape {1}."
+                               .format(image.shape, tuple(self.ndims)))
+
+        self._image = image
+
     @property
     def has_data(self):
+        # Avoid reading the image data of a lazy HDU just to check it, use the header instead
+        if self.lazy and not self.is_loaded:
+            return (self._header is not None or self._table is not None) and bool(self.naxis)
+
+        # Same for memory mapped image data, as checking it would read every page of the file
+        if isinstance(self._image, np.memmap):
+            return bool(self.naxis)
+
         if np.any(self.img):
             return True
         else:
@@ -105,14 +188,111 @@ class HDU(object):
             raise RuntimeError("Index needs to be equal to or one less than the number"
                                "of axes in the data-cube.")
 
-        # Instantiate the array to hold the data for each pixel
-        pix_val = np.zeros(self.ndims[0])
-
-        # Iterate through the "data-layers", which is the 1st entry in ndims
-        for i in range(0, self.ndims[0]):
-            pix_val[i] = self.img[i, pix_idx[0], pix_idx[1]]
+        # Slice out the pixel through all the "data-layers", which is the 1st axis
+        pix_val = np.array(self.img[:, pix_idx[0], pix_idx[1]], dtype=np.float64)
 
         return pix_val
 
     def get_max(self):
         return get_max(self.img)
+
+
+class HDU(_BaseHDU):
+    """
+    Will function as a standardized Header Data Unit for this package.
+
+    The plan is that there will be subclasses of this, either specific to
+    the source of the data or to the file the HDU is created from. This
+    is something that would depend on how similar the header files of
+    the different telescopes are, if FITS is the standard for ALL, etc.
+    Would like to discuss this with mentor if possible.
+
+    Original plan was to leverage the FITS objects from fitsio, which provides both
+    performance (parser written in C and Fortran). As it turns out you run into
+    quite a bit of problems when iterating over a large number of FITS files,
+    as the number of simultaneously "opened" is quite limited.
+
+    If 'lazy' is True only the header is read when the HDU is created, and the image
+    data is read the first time it is accessed through 'img'. The image data can be
+    released again using release(), in which case it will be re-read if needed.
+
+    Any additional arguments are passed on to the reader, i.e. io.fits.read_fits() for FITS
+    files. For example 'mmap=True' memory maps the image data of uncompressed files instead
+    of reading it, in which case 'img' is a read-only view of the file, and 'profiler' times
+    the reads of the header and image data, including those of a lazy HDU later on.
+    """
+    def __init__(self, path, ftype=None, dtype=None, lazy=False, *args, **kwargs):
+        # Get the name of the file
+        self.filename = os.path.split(path)[1]
+
+        self._init(path, ftype, dtype, lazy, args, kwargs)
+
+    def __getstate__(self):
+        # A profiler can not be pickled, e.g. when sent back from the workers of a process pool
+        state = self.__dict__.copy()
+        state['profiler'] = None
+
+        return state
+
+    def init_from_hdr(self):
+        super(HDU, self).init_from_hdr()
+
+        self.ndims = np.array(self.ndims, dtype=np.dtype('int64'))
+
+
+class CompactHDU(_BaseHDU):
+    """
+    A lightweight version of HDU for large collections of files, with the same methods
+    and attributes. The attributes are stored in fixed slots instead of a per-instance
+    __dict__, the dimensions are a tuple instead of a numpy array, and the file name is
+    derived from the path when needed, which cuts the memory used per object and speeds up
+    attribute access when holding tens of thousands of them.
+
+    The image data can be a view of an array shared with other objects, see share_image(),
+    e.g. of the frames of a Stack (see pypeira.core.stack.Stack.from_hdus()), so that the
+    data of many HDUs is held in one block of memory.
+    """
+    __slots__ = (
+        'path', 'ftype', 'dtype', 'lazy', 'profiler', '_args', '_kwargs', 'channel', 'aorkey', 'expid', 'dce',
+        'naxis', 'ndims', 'timestamp', 'integ_start', 'integ_end', 'frametime',
+        '_header', '_image', '_table', '_row'
+    )
+
+    def __init__(self, path, ftype=None, dtype=None, lazy=False, *args, **kwargs):
+        self._init(path, ftype, dtype, lazy, args, kwargs)
+
+    def __getstate__(self):
+        # Objects with __slots__ and no __dict__ need to be pickled explicitly under Python 2.
+        # A profiler can not be pickled, see HDU.__getstate__().
+        return dict((name, getattr(self, name) if name != 'profiler' else None) for name in self.__slots__)
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
+
+    @classmethod
+    def from_hdu(cls, hdu):
+        """
+        Creates a CompactHDU holding the same data as 'hdu', without reading the file again.
+
+        Parameters
+        ----------
+        hdu: HDU object
+
+        Returns
+        -------
+        CompactHDU object
+        """
+        compact = cls.__new__(cls)
+
+        for name in cls.__slots__:
+            setattr(compact, name, getattr(hdu, name))
+
+        if compact.ndims is not None:
+            compact.ndims = tuple(int(n) for n in compact.ndims)
+
+        return compact
+
+    @property
+    def filename(self):
+        return os.path.basename(self.path)
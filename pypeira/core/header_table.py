@@ -0,0 +1,361 @@
+import numbers
+
+import numpy as np
+
+from pypeira.core.time import layer_times
+
+"""
+A compact, columnar store of the header values of many HDUs.
+
+Instead of every HDU holding on to its full FITSHDR object, with hundreds of cards as
+Python objects, only the values of a set of keywords are kept, one array per keyword,
+and each HDU holds the index of its row. Example,
+
+    table = HeaderTable(ira.header_kwds)
+    hdus = ira.read("/path/to/AOR", dtype='bcd', header_table=table)
+
+    order = table.argsort('BMJD_OBS')
+    rows = table.select(EXPTYPE='sci', BMJD_OBS=(56270.4, 56270.5))
+
+Sorting, filtering and time computations are then vectorized operations on the columns.
+"""
+
+# Keywords used by HDU.init_from_hdr() and frame_times(), always stored
+_required_keywords = ['NAXIS', 'NAXIS1', 'NAXIS2', 'NAXIS3', 'BMJD_OBS', 'AINTBEG', 'ATIMEEND', 'FRAMTIME']
+
+# Initial number of rows of the column buffers, which double in size whenever full
+_initial_capacity = 64
+
+
+def _buffer_dtype(value):
+    # The type of buffer needed to store 'value': integers as int64, other numbers and missing
+    # values as float64 (missing as NaN), and anything else, e.g. strings, as Python objects
+    if value is None:
+        return np.dtype(np.float64)
+
+    if isinstance(value, numbers.Number) and not isinstance(value, (bool, np.bool_)):
+        if isinstance(value, numbers.Integral):
+            return np.dtype(np.int64)
+
+        return np.dtype(np.float64)
+
+    return np.dtype(object)
+
+
+def _common_dtype(dtype, value):
+    # The type of buffer which can hold both the values of a buffer of type 'dtype' and 'value'
+    if dtype.kind == 'O':
+        return dtype
+
+    other = _buffer_dtype(value)
+
+    if other == dtype:
+        return dtype
+
+    if dtype.kind in 'if' and other.kind in 'if':
+        return np.dtype(np.float64)
+
+    return np.dtype(object)
+
+
+def _to_scalar(value):
+    # Header values are returned as Python scalars, with missing numbers as None
+    if isinstance(value, np.generic):
+        value = value.item()
+
+    if isinstance(value, float) and value != value:
+        return None
+
+    return value
+
+
+class HeaderRow(object):
+    """
+    A read-only view of a row of a HeaderTable, which can be used like a FITSHDR object or
+    a dict, e.g. row['NAXIS'] or row.get('BMJD_OBS'). The values are looked up in the
+    columns of the table when accessed. Missing values are None.
+    """
+    __slots__ = ('_table', '_idx')
+
+    def __init__(self, table, idx):
+        self._table = table
+        self._idx = idx
+
+    def __getitem__(self, kwd):
+        if kwd not in self._table:
+            raise KeyError(kwd)
+
+        return self._table.value(kwd, self._idx)
+
+    def get(self, kwd, default=None):
+        if kwd not in self._table:
+            return default
+
+        return self._table.value(kwd, self._idx)
+
+    def __contains__(self, kwd):
+        return kwd in self._table
+
+    def __iter__(self):
+        return iter(self._table.keywords)
+
+    def __len__(self):
+        return len(self._table.keywords)
+
+    def keys(self):
+        return list(self._table.keywords)
+
+    def items(self):
+        return [(kwd, self[kwd]) for kwd in self._table.keywords]
+
+    def __eq__(self, other):
+        if isinstance(other, HeaderRow):
+            other = dict(other.items())
+
+        return dict(self.items()) == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return "HeaderRow({0})".format(dict(self.items()))
+
+
+class HeaderTable(object):
+    """
+    The values of a set of header keywords for each of a number of HDUs, stored by column.
+    Each column is a numpy array with room to grow, which doubles in size whenever it is
+    full, so rows are added in amortized constant time without keeping the values as
+    Python objects. Numbers are stored as int64 (float64 if any is not an integer or is
+    missing, with missing values as NaN), and anything else, e.g. strings, as objects.
+    """
+    def __init__(self, keywords=None):
+        """
+        Parameters
+        ----------
+        keywords: [str, ... ], optional
+            The header keywords to store, e.g. IRA.header_kwds. The keywords needed by
+            HDU objects are always stored. Default is None, i.e. only those.
+        """
+        self.keywords = list(_required_keywords)
+
+        for kwd in keywords or []:
+            if kwd not in self.keywords:
+                self.keywords.append(kwd)
+
+        self._size = 0                                                  # Number of rows
+        self._buffers = dict((kwd, None) for kwd in self.keywords)     # Column buffers, None until the first row
+        self._strings = dict()                                          # Cached string arrays of object columns
+
+    @classmethod
+    def from_columns(cls, columns):
+        """
+        Creates a HeaderTable from the columns of another, e.g. as stored by io.cache. The
+        arrays are used as they are, e.g. memory mapped, until more rows are added.
+
+        Parameters
+        ----------
+        columns: {str: numpy.array}
+            The values of each keyword, all of the same length. Missing numbers are NaN.
+
+        Returns
+        -------
+        HeaderTable
+        """
+        table = cls(list(columns))
+        sizes = set(len(column) for column in columns.values())
+
+        if len(sizes) > 1:
+            raise RuntimeError("The columns need to be of the same length.")
+
+        for kwd in table.keywords:
+            if kwd not in columns:
+                raise RuntimeError("Keyword {0} is missing from the columns.".format(kwd))
+
+            table._buffers[kwd] = columns[kwd]
+
+        table._size = sizes.pop() if sizes else 0
+
+        return table
+
+    def __len__(self):
+        return self._size
+
+    def __contains__(self, kwd):
+        return kwd in self._buffers
+
+    def __getitem__(self, kwd):
+        return self.column(kwd)
+
+    def _store(self, kwd, value):
+        # Stores 'value' in the next row of the buffer of 'kwd', first growing the buffer if it
+        # is full, or converting it if it can not hold the value
+        buf = self._buffers[kwd]
+        n = self._size
+
+        if buf is None:
+            buf = np.empty(_initial_capacity, dtype=_buffer_dtype(value))
+        else:
+            dtype = _common_dtype(buf.dtype, value)
+            capacity = len(buf) if len(buf) > n else max(2 * len(buf), _initial_capacity)
+
+            if dtype != buf.dtype or capacity != len(buf):
+                grown = np.empty(capacity, dtype=dtype)
+                grown[:n] = buf[:n]
+                buf = grown
+
+        if value is None and buf.dtype.kind == 'f':
+            value = np.nan
+
+        buf[n] = value
+        self._buffers[kwd] = buf
+
+    def append(self, header):
+        """
+        Adds a row holding the values of the keywords in 'header'. Missing keywords get None.
+
+        Parameters
+        ----------
+        header: FITSHDR object or dict
+            The header of an HDU.
+
+        Returns
+        -------
+        int
+            The index of the new row.
+        """
+        for kwd in self.keywords:
+            self._store(kwd, header.get(kwd))
+
+        self._size += 1
+        self._strings.clear()
+
+        return self._size - 1
+
+    def column(self, kwd):
+        """
+        Returns
+        -------
+        numpy.array
+            A read-only view of the values of 'kwd' for all the rows. Missing numbers are
+            NaN. Columns of only strings are returned as string arrays, which are cached
+            until the next row is added.
+        """
+        if kwd not in self._buffers:
+            raise RuntimeError("Keyword {0} is not in the table.".format(kwd))
+
+        if self._buffers[kwd] is None:
+            return np.empty(0, dtype=np.float64)
+
+        column = self._buffers[kwd][:self._size]
+
+        if column.dtype.kind == 'O':
+            if kwd not in self._strings:
+                values = column.tolist()
+
+                if all(isinstance(value, str) for value in values):
+                    self._strings[kwd] = np.array(values, dtype=np.str_)
+                else:
+                    self._strings[kwd] = column
+
+            column = self._strings[kwd]
+
+        # The buffer itself stays writable, so that rows can be added
+        column = column.view()
+        column.setflags(write=False)
+
+        return column
+
+    def value(self, kwd, idx):
+        """
+        Returns
+        -------
+        object
+            The value of 'kwd' in row 'idx' as a Python scalar, None if missing.
+        """
+        if not -self._size <= idx < self._size:
+            raise IndexError("Row {0} is out of range for {1} rows.".format(idx, self._size))
+
+        return _to_scalar(self._buffers[kwd][idx % self._size])
+
+    def row(self, idx):
+        """
+        Returns
+        -------
+        HeaderRow object
+            A view of the values of the keywords of row 'idx'. Can be used like a FITSHDR
+            object, e.g. row.get('BMJD_OBS').
+        """
+        return HeaderRow(self, idx)
+
+    def argsort(self, kwd='BMJD_OBS'):
+        """
+        Returns
+        -------
+        numpy.array
+            The indices of the rows sorted by the values of 'kwd'. Default is 'BMJD_OBS'.
+        """
+        return np.argsort(self.column(kwd), kind='mergesort')
+
+    def select(self, **conditions):
+        """
+        Looks up the rows satisfying the given conditions.
+
+        Parameters
+        ----------
+        **conditions: optional
+            Keyword/value pairs the rows have to satisfy. A value can be either a single
+            value which the keyword must be equal to, or a (low, high)-pair of inclusive
+            limits, where None means no limit. See also io.catalog.Catalog.select().
+
+        Returns
+        -------
+        numpy.array
+            The indices of the rows satisfying all the conditions, in increasing order.
+        """
+        keep = np.ones(len(self), dtype=np.bool_)
+
+        for kwd, value in conditions.items():
+            column = self.column(kwd)
+
+            if isinstance(value, tuple):
+                low, high = value
+
+                with np.errstate(invalid='ignore'):
+                    if low is not None:
+                        keep &= column >= low
+                    if high is not None:
+                        keep &= column <= high
+            else:
+                keep &= column == value
+
+        return np.flatnonzero(keep)
+
+    def frame_times(self, rows=None):
+        """
+        Computes the timestamps of every frame of the HDUs of the given rows in one go.
+        See core.time.frame_times().
+
+        Parameters
+        ----------
+        rows: numpy.array, optional
+            The indices of the rows, e.g. as returned by argsort() or select(). Default is
+            None, i.e. all the rows in order.
+
+        Returns
+        -------
+        numpy.array
+            Array of shape (n_rows * n_layers, ).
+        """
+        rows = np.arange(len(self)) if rows is None else np.asarray(rows)
+
+        if len(rows) == 0:
+            return np.empty(0, dtype=np.float64)
+
+        layers = self.column('NAXIS3')[rows]
+
+        if np.any(layers != layers[0]):
+            raise RuntimeError("All HDUs need to have the same number of data-layers.")
+
+        return layer_times(self.column('BMJD_OBS')[rows], self.column('AINTBEG')[rows],
+                           self.column('ATIMEEND')[rows], int(layers[0]))
@@ -0,0 +1,41 @@
+import numpy as np
+
+from pypeira.core.stack import Stack
+
+"""
+Masks of the bad pixels of the frames, either boolean arrays where True marks a bad pixel,
+or integer bit masks such as the data of the 'bimsk' files accompanying each 'bcd' file.
+Used both by the HDU-level objects in core (see core.exposure.Exposure) and by the
+estimators in pypeira.background.
+"""
+
+
+def bad_pixels(mask, bits=None):
+    """
+    Converts a mask to a boolean array marking the bad pixels.
+
+    Parameters
+    ----------
+    mask: numpy.array or Stack
+        A boolean array, where True marks a bad pixel, or an integer bit mask.
+    bits: int, optional
+        For integer bit masks, the bits which mark a pixel as bad. Default is None, which
+        is any set bit.
+
+    Returns
+    -------
+    numpy.array
+        Boolean array of the same shape as 'mask'.
+    """
+    if isinstance(mask, Stack):
+        mask = mask.frames
+
+    mask = np.asanyarray(mask)
+
+    if mask.dtype == np.bool_:
+        return mask
+
+    if bits is None:
+        return mask != 0
+
+    return (mask & bits) != 0
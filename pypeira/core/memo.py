@@ -0,0 +1,225 @@
+import hashlib
+import json
+import os
+import pickle
+
+from collections import OrderedDict
+
+import numpy as np
+
+from pypeira.io.cache import file_signatures
+from pypeira.core.profiler import null_profiler
+
+"""
+Memoization of analysis calls on sets of HDUs, so that repeating a reduction, e.g. in an
+interactive session, does not recompute it.
+
+The results are keyed by the name of the call, the files the HDUs were read from (path,
+modification time and size, so changed files are not served stale results) and the
+parameters of the call. They are kept in an in-memory LRU cache of a fixed number of
+entries and, optionally, pickled to a directory on disk, which is limited in size by
+removing the least recently used files first.
+
+As the results are keyed by the files, changes made to the image data of the HDUs after
+reading them (e.g. setting bad pixels to NaN in place) are not noticed. Clear the cache, see
+Memo.clear(), or do not use it if modifying the data in place. The arrays of the results are
+shared between calls, and so returned as read-only views.
+"""
+
+
+def _param_key(value):
+    # Arrays are keyed by their content, anything else by its representation
+    if isinstance(value, np.ndarray):
+        return ['array', value.shape, str(value.dtype), hashlib.sha1(np.ascontiguousarray(value)).hexdigest()]
+
+    return repr(value)
+
+
+def _read_only(value):
+    # Read-only views of the arrays of a result, leaving the arrays themselves as they are
+    if isinstance(value, np.ndarray):
+        value = value.view()
+        value.setflags(write=False)
+        return value
+
+    if isinstance(value, (tuple, list)):
+        return type(value)(_read_only(v) for v in value)
+
+    return value
+
+
+def hdu_paths(hdus):
+    """
+    Returns
+    -------
+    [str, ... ] or None
+        The paths of the files of a list (or HDUCollection) of HDU or Exposure objects, or
+        None if it is not one, e.g. a Stack or an array, which can not be keyed by its files,
+        or a generator, which would be consumed.
+    """
+    if isinstance(hdus, np.ndarray) or not hasattr(hdus, '__len__') or hasattr(hdus, 'frames'):
+        return None
+
+    paths = [getattr(hdu, 'path', None) for hdu in hdus]
+
+    if not paths or any(path is None for path in paths):
+        return None
+
+    return paths
+
+
+class Memo(object):
+    """
+    An in-memory LRU cache with an optional on-disk tier. See call().
+    """
+    def __init__(self, max_entries=32, path=None, max_bytes=2 ** 30, profiler=None):
+        """
+        Parameters
+        ----------
+        max_entries: int, optional
+            The number of results kept in memory. Default is 32, 0 disables the memory tier.
+        path: str, optional
+            Directory where results are pickled. Default is None, i.e. no disk tier.
+        max_bytes: int, optional
+            The maximum total size of the pickled results. Default is 1 GiB.
+        profiler: Profiler object, optional
+            If given, the hits and misses are also counted by its 'cache_hits' and
+            'cache_misses' counters. See pypeira.core.profiler. Default is None.
+        """
+        self.max_entries = max_entries
+        self.path = path
+        self.max_bytes = max_bytes
+        self.profiler = profiler if profiler is not None else null_profiler
+
+        self.hits = 0
+        self.misses = 0
+
+        self._entries = OrderedDict()
+
+        if path is not None and not os.path.isdir(path):
+            os.makedirs(path)
+
+    def key(self, name, paths, params):
+        """
+        Returns
+        -------
+        str
+            The key of a call of 'name' on the files 'paths' with the parameters 'params'.
+        """
+        data = json.dumps([name, file_signatures(paths), [_param_key(p) for p in params]])
+
+        return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+    def _disk_path(self, key):
+        return os.path.join(self.path, key + '.pkl')
+
+    def get(self, key):
+        """
+        Returns
+        -------
+        (bool, object)
+            Whether 'key' was found, and its result.
+        """
+        if key in self._entries:
+            # Move to the end, i.e. make it the most recently used
+            value = self._entries.pop(key)
+            self._entries[key] = value
+
+            return True, value
+
+        if self.path is not None and os.path.isfile(self._disk_path(key)):
+            with open(self._disk_path(key), 'rb') as f:
+                value = _read_only(pickle.load(f))
+
+            # Mark as recently used for the eviction
+            os.utime(self._disk_path(key), None)
+            self._put_memory(key, value)
+
+            return True, value
+
+        return False, None
+
+    def _put_memory(self, key, value):
+        if self.max_entries <= 0:
+            return
+
+        self._entries[key] = value
+
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def put(self, key, value):
+        """ Stores the result 'value' of 'key' in both tiers. """
+        self._put_memory(key, value)
+
+        if self.path is not None:
+            with open(self._disk_path(key), 'wb') as f:
+                pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+            self._evict()
+
+    def _evict(self):
+        # Remove the least recently used files until the disk tier fits within 'max_bytes'
+        files = [os.path.join(self.path, fname) for fname in os.listdir(self.path) if fname.endswith('.pkl')]
+        files = sorted((os.stat(f).st_mtime, os.stat(f).st_size, f) for f in files)
+
+        total = sum(size for mtime, size, f in files)
+
+        for mtime, size, f in files:
+            if total <= self.max_bytes:
+                break
+
+            os.remove(f)
+            total -= size
+
+    def call(self, name, hdus, params, func):
+        """
+        Returns the memoized result of func(), which computes 'name' on 'hdus' with the
+        parameters 'params'. If 'hdus' can not be keyed by its files (see hdu_paths()),
+        func() is simply called.
+
+        Parameters
+        ----------
+        name: str
+            The name of the call.
+        hdus: iterable of HDU objects
+            The input data.
+        params: [object, ... ]
+            The other parameters of the call.
+        func: callable
+            Computes the result, called without arguments.
+
+        Returns
+        -------
+        object
+            The result of func(). It is shared between calls, so any arrays in it (or in a
+            tuple or list of it) are returned as read-only views.
+        """
+        paths = hdu_paths(hdus)
+
+        if paths is None or (self.max_entries <= 0 and self.path is None):
+            return func()
+
+        key = self.key(name, paths, params)
+        found, value = self.get(key)
+
+        if found:
+            self.hits += 1
+            self.profiler.count('cache_hits')
+            return value
+
+        self.misses += 1
+        self.profiler.count('cache_misses')
+        value = _read_only(func())
+        self.put(key, value)
+
+        return value
+
+    def clear(self):
+        """ Removes all the results from both tiers. """
+        self._entries.clear()
+
+        if self.path is not None:
+            for fname in os.listdir(self.path):
+                if fname.endswith('.pkl'):
+                    os.remove(os.path.join(self.path, fname))
@@ -0,0 +1,196 @@
+from __future__ import division
+
+import warnings
+
+import numpy as np
+
+from numpy.lib.stride_tricks import as_strided
+
+from pypeira.core.stack import as_frames, frame_chunks
+
+"""
+Rejection of hot pixels, cosmic rays and bad frames in a frame stack, i.e. an array of
+shape (n_frames, rows, columns) such as Stack.frames.
+
+Each pixel is compared with the moving median of its own time series, and flagged if it
+deviates by more than a number of (robust) standard deviations, as estimated from the
+moving median absolute deviation (MAD). The moving windows are strided views of the frames,
+so the work is done by vectorized medians over the window axis, and scales linearly with
+the number of frames. sigma_clip() rejects outliers within the rows of an array instead,
+e.g. the frames of a bin, see core.binning.
+"""
+
+# Standard deviation of a normal distribution in units of its MAD
+mad_to_std = 1.4826
+
+
+def rolling_median(frames, window=15, chunk_size=512):
+    """
+    Moving median along the time axis of each pixel, ignoring NaNs. The frames are
+    mirrored at the ends, so the result has the same length as the frames.
+
+    Parameters
+    ----------
+    frames: numpy.array or Stack
+        Array of shape (n_frames, rows, columns), or a Stack.
+    window: int, optional
+        The (odd) number of frames in the moving window. Default is 15.
+    chunk_size: int, optional
+        Maximum number of frames processed at once. Default is 512, as each chunk
+        is copied 'window' times by the median.
+
+    Returns
+    -------
+    numpy.array
+        Float64 array of the same shape as the frames.
+    """
+    frames = as_frames(frames)
+
+    if window % 2 == 0 or window < 1:
+        raise RuntimeError("Window needs to be a positive odd number, not {0}.".format(window))
+
+    half = window // 2
+    n = len(frames)
+
+    if half >= n:
+        raise RuntimeError("Window of {0} frames is too large for {1} frames.".format(window, n))
+
+    padded = np.pad(np.asarray(frames, dtype=np.float64), ((half, half), (0, 0), (0, 0)), mode='reflect')
+    median = np.empty(frames.shape)
+
+    for chunk in frame_chunks(n, chunk_size):
+        sub = padded[chunk.start:chunk.stop + 2 * half]
+
+        # View of shape (n_chunk, window, rows, columns) where [i, j] is frame i + j - half.
+        # Made read-only after the fact, as the 'writeable' argument needs numpy >= 1.12.
+        windows = as_strided(sub, shape=(chunk.stop - chunk.start, window) + sub.shape[1:],
+                             strides=(sub.strides[0], ) + sub.strides)
+        windows.setflags(write=False)
+
+        # np.median() is much faster than np.nanmedian(), so only use the latter if needed
+        if np.isnan(sub).any():
+            with warnings.catch_warnings():
+                # Windows of only NaNs give NaN
+                warnings.simplefilter('ignore', RuntimeWarning)
+                median[chunk] = np.nanmedian(windows, axis=1)
+        else:
+            median[chunk] = np.median(windows, axis=1)
+
+    return median
+
+
+def outlier_mask(frames, window=15, nsigma=5, mad_window=None, chunk_size=512):
+    """
+    Flags the pixels deviating from the moving median of their time series by more than
+    'nsigma' robust standard deviations, where the standard deviation is estimated from the
+    MAD of the deviations. Catches cosmic rays and flickering hot pixels.
+
+    Parameters
+    ----------
+    frames: numpy.array or Stack
+        Array of shape (n_frames, rows, columns), or a Stack.
+    window, chunk_size: optional
+        See rolling_median().
+    nsigma: float, optional
+        The number of standard deviations at which a pixel is flagged. Default is 5.
+    mad_window: int, optional
+        The (odd) number of frames in the moving window of the MAD. Default is None, which
+        is the MAD of the whole time series of each pixel. A short moving MAD follows
+        changes in the noise, but is itself noisy and so flags more false positives.
+
+    Returns
+    -------
+    numpy.array
+        Boolean mask cube of the same shape as the frames, where True marks an outlier.
+        NaN pixels are not flagged.
+    """
+    frames = as_frames(frames)
+
+    resid = np.abs(frames - rolling_median(frames, window, chunk_size))
+
+    if mad_window is None:
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            mad = np.nanmedian(resid, axis=0)
+    else:
+        mad = rolling_median(resid, mad_window, chunk_size)
+
+    with np.errstate(invalid='ignore'):
+        return resid > nsigma * mad_to_std * mad
+
+
+def hot_pixels(mask, fraction=0.1):
+    """
+    Finds the pixels flagged as outliers in more than 'fraction' of the frames.
+
+    Parameters
+    ----------
+    mask: numpy.array
+        Boolean mask cube, as returned by outlier_mask().
+    fraction: float, optional
+        Default is 0.1.
+
+    Returns
+    -------
+    numpy.array
+        Boolean array of shape (rows, columns).
+    """
+    return mask.mean(axis=0) > fraction
+
+
+def bad_frames(mask, fraction=0.01):
+    """
+    Finds the frames with more than 'fraction' of their pixels flagged as outliers.
+
+    Parameters
+    ----------
+    mask: numpy.array
+        Boolean mask cube, as returned by outlier_mask().
+    fraction: float, optional
+        Default is 0.01.
+
+    Returns
+    -------
+    numpy.array
+        Boolean array of shape (n_frames, ).
+    """
+    return mask.reshape(len(mask), -1).mean(axis=1) > fraction
+
+
+def sigma_clip(data, sigma=3, iters=5):
+    """
+    Iteratively sets the values of each row of 'data' deviating more than 'sigma' standard
+    deviations from the median of the row to NaN. All the rows are clipped at once.
+
+    Parameters
+    ----------
+    data: numpy.array
+        Float array of shape (n_rows, n_values), modified in place. NaNs are ignored.
+    sigma: float, optional
+        The number of standard deviations at which to clip. Default is 3.
+    iters: int, optional
+        The maximum number of iterations. Stops early if no more values are clipped.
+        Default is 5.
+
+    Returns
+    -------
+    numpy.array
+        'data', with the clipped values set to NaN.
+    """
+    with warnings.catch_warnings():
+        # Rows of only NaNs give NaN, which is what we want
+        warnings.simplefilter('ignore', RuntimeWarning)
+
+        for i in range(iters):
+            median = np.nanmedian(data, axis=1)[:, np.newaxis]
+            std = np.nanstd(data, axis=1)[:, np.newaxis]
+
+            with np.errstate(invalid='ignore'):
+                clip = np.abs(data - median) > sigma * std
+
+            if not clip.any():
+                break
+
+            data[clip] = np.nan
+
+    return data
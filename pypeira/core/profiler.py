@@ -0,0 +1,155 @@
+import threading
+import time
+
+from contextlib import contextmanager
+
+"""
+Stage-level instrumentation of a reduction, telling where the time goes without attaching
+an external profiler. A Profiler is passed (e.g. through IRA, see IRA.__init__()) to the
+functions it instruments, which time their stages and count what they process:
+
+    stages      'walk', 'filter', 'read' (see io.common.read()), 'read_header', 'read_image'
+                (see io.fits.read_fits()), 'has_data', 'get_brightest', 'get_max', 'pixel_data',
+                'sort' (see core.brightness)
+    counters    'files_seen', 'files_skipped', 'files_read', 'bytes_read', 'cache_hits',
+                'cache_misses' (see core.memo.Memo)
+
+Example,
+
+    ira = IRA(profile=True)
+    hdus = ira.read("/path/to/AOR", dtype='bcd')
+    ira.get_brightest(hdus)
+    print(ira.profile_report())
+
+Functions not given a profiler use null_profiler, which does nothing, so instrumentation
+costs next to nothing when it is not enabled. A Profiler can be shared by several threads,
+e.g. when reading with a pool of threads. The workers of a process pool each time their
+reads with a profiler of their own, which are merged into the profiler of the caller, see
+merge() and io.common.iread().
+"""
+
+
+class Profiler(object):
+    """
+    Accumulates the time spent in each stage and a set of counters. Safe to use from
+    several threads at once.
+    """
+    def __init__(self, callbacks=None):
+        """
+        Parameters
+        ----------
+        callbacks: [callable, ... ], optional
+            Called as callback(kind, name, value) each time a stage is timed ('stage', name,
+            seconds) or a counter is incremented ('count', name, increment). Default is None.
+        """
+        self.callbacks = list(callbacks or [])
+
+        self._lock = threading.Lock()
+        self._stages = dict()       # Total seconds and number of calls of each stage
+        self._counters = dict()     # Value of each counter
+
+    def __bool__(self):
+        return True
+
+    __nonzero__ = __bool__
+
+    def _emit(self, kind, name, value):
+        for callback in self.callbacks:
+            callback(kind, name, value)
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Context manager timing the code within it as stage 'name'. Nested stages are each
+        timed in full, i.e. the time of an inner stage is also part of the outer.
+        """
+        start = time.time()
+
+        try:
+            yield
+        finally:
+            self.add_time(name, time.time() - start)
+
+    def add_time(self, name, seconds):
+        """ Adds 'seconds' spent in stage 'name'. """
+        with self._lock:
+            total, calls = self._stages.get(name, (0.0, 0))
+            self._stages[name] = (total + seconds, calls + 1)
+
+        self._emit('stage', name, seconds)
+
+    def count(self, name, n=1):
+        """ Increments the counter 'name' by 'n'. """
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + n
+
+        self._emit('count', name, n)
+
+    def merge(self, stages):
+        """
+        Adds the stages of another profiler, e.g. of a worker process, to those of this one.
+
+        Parameters
+        ----------
+        stages: dict
+            The 'stages' of the report() of the other profiler.
+        """
+        with self._lock:
+            for name, stage in stages.items():
+                total, calls = self._stages.get(name, (0.0, 0))
+                self._stages[name] = (total + stage['seconds'], calls + stage['calls'])
+
+        for name, stage in stages.items():
+            self._emit('stage', name, stage['seconds'])
+
+    def report(self):
+        """
+        Returns
+        -------
+        dict
+            {'stages': {name: {'seconds': float, 'calls': int}, ... }, 'counters': {name: int, ... }}
+        """
+        with self._lock:
+            return {
+                'stages': dict((name, {'seconds': total, 'calls': calls})
+                               for name, (total, calls) in self._stages.items()),
+                'counters': dict(self._counters)
+            }
+
+    def reset(self):
+        """ Clears all the timers and counters. """
+        with self._lock:
+            self._stages.clear()
+            self._counters.clear()
+
+
+class NullProfiler(object):
+    """
+    A Profiler which does nothing, used when profiling is not enabled.
+    """
+    def __bool__(self):
+        return False
+
+    __nonzero__ = __bool__
+
+    @contextmanager
+    def stage(self, name):
+        yield
+
+    def add_time(self, name, seconds):
+        pass
+
+    def count(self, name, n=1):
+        pass
+
+    def merge(self, stages):
+        pass
+
+    def report(self):
+        return {'stages': {}, 'counters': {}}
+
+    def reset(self):
+        pass
+
+
+null_profiler = NullProfiler()
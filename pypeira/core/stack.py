@@ -0,0 +1,228 @@
+from __future__ import division
+
+import numpy as np
+
+from pypeira.core.time import frame_times
+
+
+class Stack(object):
+    """
+    A time-sorted stack of the image data of a set of HDUs.
+
+    The data-cubes of all the HDUs are stored in one contiguous array of shape
+    (n_hdus * n_layers, rows, columns), sorted by time, together with a float64
+    array holding the timestamp of each frame. This way the light curve of any
+    pixel or aperture is a single (strided) slice of the frame array, instead of
+    a loop over HDUs and data-layers.
+    """
+    def __init__(self, frames, times):
+        if len(frames) != len(times):
+            raise RuntimeError("Number of frames ({0}) and timestamps ({1}) do not match."
+                               .format(len(frames), len(times)))
+
+        self.frames = frames        # Array of shape (n_frames, rows, columns)
+        self.times = times          # Array of shape (n_frames, ) holding the timestamp of each frame
+
+    @classmethod
+    def from_hdus(cls, hdus, share=False):
+        """
+        Creates a Stack from an iterable of HDU objects.
+
+        Parameters
+        ----------
+        hdus: [HDU, ... ]
+            An iterable of HDU objects which contain the relevant data. Assumes all
+            HDUs to have the same dimensions. The given iterable is not modified.
+        share: bool, optional
+            If True, the image data of each HDU is replaced by a view of its frames in the
+            Stack (see HDU.share_image()), so the data is not held twice. Modifying the
+            frames then modifies the image data of the HDUs. Default is False.
+
+        Returns
+        -------
+        Stack
+            The image data of all the HDUs, sorted by the timestamp of the observation.
+        """
+        # Sort the HDUs using the Barycenter Mod. Julian Date of the observation as key
+        hdus = sorted(hdus, key=lambda x: x.timestamp)
+
+        if not hdus:
+            raise RuntimeError("Cannot create a Stack from an empty set of HDUs.")
+
+        # Number of images in data cube and the shape of each image - normally 64 and (32, 32)
+        layers = hdus[0].ndims[0]
+        shape = tuple(hdus[0].ndims[1:])
+
+        frames = np.empty((layers * len(hdus), ) + shape, dtype=hdus[0].img.dtype)
+
+        for j, hdu in enumerate(hdus):
+            frames[j * layers:(j + 1) * layers] = hdu.img
+
+            if share:
+                hdu.share_image(frames[j * layers:(j + 1) * layers])
+
+        # The timestamps are computed once here and kept with the frames
+        times = frame_times(hdus)
+
+        return cls(frames, times)
+
+    def __len__(self):
+        return len(self.frames)
+
+    @property
+    def shape(self):
+        return self.frames.shape
+
+    def pixel(self, idx):
+        """
+        Parameters
+        ----------
+        idx: (int ... )
+            The index of the pixel. Either (row, column) or (data-layer, row, column), where
+            the data-layer is ignored, as one wants the values for all the layers.
+
+        Returns
+        -------
+        times, pix_vals: numpy.array, numpy.array
+            The timestamps and the values of the pixel for each frame. 'pix_vals' is a view
+            into the frame array, so copy it if you intend to modify it.
+        """
+        if len(idx) == self.frames.ndim:
+            idx = idx[1:]
+        elif len(idx) != self.frames.ndim - 1:
+            raise RuntimeError("Index needs to be equal to or one less than the number"
+                               "of axes in the data-cube.")
+
+        return self.times, self.frames[(slice(None), ) + tuple(idx)]
+
+    def pixels(self, idxs):
+        """
+        Extracts the values of several pixels for all the frames at once, using a single
+        fancy index of the frame array.
+
+        Parameters
+        ----------
+        idxs: [(int ... ), ... ]
+            The indices of the pixels, each as for pixel(). See also stamp_indices().
+
+        Returns
+        -------
+        times, pix_vals: numpy.array, numpy.array
+            The timestamps, and an array of shape (n_frames, n_pixels) holding the values
+            of each pixel for each frame. 'pix_vals' is a copy.
+        """
+        rows, columns = pixel_indices(idxs, self.frames.shape)
+
+        return self.times, self.frames[:, rows, columns]
+
+    def aperture(self, rows, columns):
+        """
+        Parameters
+        ----------
+        rows: (int, int)
+            The (start, stop) rows of the box, where 'stop' is exclusive as for normal slicing.
+        columns: (int, int)
+            The (start, stop) columns of the box.
+
+        Returns
+        -------
+        times, stamps: numpy.array, numpy.array
+            The timestamps and a view of shape (n_frames, n_rows, n_columns) into the frame array.
+        """
+        return self.times, self.frames[:, rows[0]:rows[1], columns[0]:columns[1]]
+
+
+def as_frames(frames):
+    """
+    Returns the frames of a Stack, or the given array as an array of frames.
+
+    Parameters
+    ----------
+    frames: numpy.array, Stack or HDUCollection
+        A Stack, an HDUCollection (see core.collection), an array of shape (n_frames, rows, columns)
+        or a single frame of shape (rows, columns).
+
+    Returns
+    -------
+    numpy.array
+        Array of shape (n_frames, rows, columns). Not a copy, if it can be avoided.
+    """
+    # HDU collections are stacked on first use, and the Stack is kept with the collection
+    if not isinstance(frames, (Stack, np.ndarray)) and hasattr(frames, 'stack'):
+        frames = frames.stack
+
+    if isinstance(frames, Stack):
+        frames = frames.frames
+
+    frames = np.asanyarray(frames)
+
+    if frames.ndim == 2:
+        frames = frames[np.newaxis]
+    elif frames.ndim != 3:
+        raise RuntimeError("Frames need to be of shape (n_frames, rows, columns) or (rows, columns).")
+
+    return frames
+
+
+def pixel_indices(idxs, shape):
+    """
+    Splits a list of pixel indices into arrays of rows and columns, for fancy indexing.
+
+    Parameters
+    ----------
+    idxs: [(int ... ), ... ]
+        The indices of the pixels, either (row, column) or (data-layer, row, column), where
+        the data-layer is ignored.
+    shape: (int, int, int)
+        The shape of the data-cubes (or frame array) indexed.
+
+    Returns
+    -------
+    rows, columns: numpy.array, numpy.array
+    """
+    if any(len(idx) not in (len(shape), len(shape) - 1) for idx in idxs):
+        raise RuntimeError("Indices need to be equal to or one less than the number"
+                           "of axes in the data-cube.")
+
+    rows = np.array([idx[-2] for idx in idxs], dtype=np.intp)
+    columns = np.array([idx[-1] for idx in idxs], dtype=np.intp)
+
+    # Negative indices would silently wrap around, e.g. for a stamp at the edge of the frames
+    if np.any((rows < 0) | (rows >= shape[-2]) | (columns < 0) | (columns >= shape[-1])):
+        raise RuntimeError("Pixel indices are outside of frames of shape {0}.".format(tuple(shape[-2:])))
+
+    return rows, columns
+
+
+def stamp_indices(center, size):
+    """
+    The indices of the pixels of a square stamp around a pixel.
+
+    Parameters
+    ----------
+    center: (int, int)
+        The (row, column) of the center pixel.
+    size: int
+        The (odd) width of the stamp in pixels, e.g. 5 for a 5x5 stamp.
+
+    Returns
+    -------
+    [(int, int), ... ]
+        The (row, column) of each pixel of the stamp, in row-major order.
+    """
+    if size % 2 == 0 or size < 1:
+        raise RuntimeError("Stamp size needs to be a positive odd number, not {0}.".format(size))
+
+    half = size // 2
+    row, column = center[-2:]
+
+    return [(r, c) for r in range(row - half, row + half + 1) for c in range(column - half, column + half + 1)]
+
+
+def frame_chunks(n, chunk_size):
+    """
+    Yields the slices splitting 'n' frames into chunks of at most 'chunk_size' frames, used
+    to bound the memory of the temporary arrays when processing large frame stacks.
+    """
+    for i in range(0, n, chunk_size):
+        yield slice(i, min(i + chunk_size, n))
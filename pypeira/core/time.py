@@ -1,5 +1,11 @@
 # This might no have any use anymore, as the HDU objects is the new thing.
 # Possibly changed it a bit to a time converter instead of getter I suppose.
+from __future__ import division
+
+import numpy as np
+
+# Conversion from secs to days
+sec_to_day = 1 / (3600 * 24)
 
 
 def hdu_get_time(hdu, time_format='bmjd'):
@@ -40,3 +46,72 @@ def hdu_get_time(hdu, time_format='bmjd'):
         return hdu.hdr[format_to_kwrd.get(time_format)]
     else:
         return hdu.timestamp
+
+
+def frame_times(hdus):
+    """
+    Computes the timestamps of every frame/data-layer of every HDU in one go, assuming equal
+    time between each integration of a data-cube. That is, the i-th frame of an HDU gets the
+    timestamp
+
+        BMJD_OBS + i * (ATIMEEND - AINTBEG) / NAXIS3
+
+    where the time increment is converted from seconds to days.
+
+    Parameters
+    ----------
+    hdus: [HDU, ... ]
+        An iterable of HDU objects, assumed to all have the same number of data-layers.
+
+    Returns
+    -------
+    times: numpy.array
+        Array of shape (n_hdus * n_layers, ) holding the timestamps of the frames, in the
+        same order as the HDUs, i.e. times[j * n_layers + i] is the time of the i-th frame
+        of the j-th HDU.
+    """
+    hdus = list(hdus)
+
+    if not hdus:
+        return np.empty(0, dtype=np.float64)
+
+    # Number of images in data cube - normally 64
+    layers = hdus[0].ndims[0]
+
+    if any(hdu.ndims[0] != layers for hdu in hdus):
+        raise RuntimeError("All HDUs need to have the same number of data-layers.")
+
+    timestamps = np.array([hdu.timestamp for hdu in hdus], dtype=np.float64)
+    integ_start = np.array([hdu.integ_start for hdu in hdus], dtype=np.float64)
+    integ_end = np.array([hdu.integ_end for hdu in hdus], dtype=np.float64)
+
+    return layer_times(timestamps, integ_start, integ_end, layers)
+
+
+def layer_times(timestamps, integ_start, integ_end, layers):
+    """
+    Same as frame_times(), but taking the header values of the HDUs as arrays, e.g. the
+    columns of a HeaderTable (see pypeira.core.header_table).
+
+    Parameters
+    ----------
+    timestamps, integ_start, integ_end: numpy.array
+        The BMJD_OBS, AINTBEG and ATIMEEND header values of each HDU.
+    layers: int
+        The number of data-layers of each HDU.
+
+    Returns
+    -------
+    times: numpy.array
+        See frame_times().
+    """
+    timestamps = np.asarray(timestamps, dtype=np.float64)
+    integ_start = np.asarray(integ_start, dtype=np.float64)
+    integ_end = np.asarray(integ_end, dtype=np.float64)
+
+    # Time between each integration for each HDU, in days
+    time_increment = (integ_end - integ_start) / layers * sec_to_day
+
+    times = timestamps[:, np.newaxis] + time_increment[:, np.newaxis] * np.arange(layers)
+
+    return times.ravel()
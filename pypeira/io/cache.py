@@ -0,0 +1,216 @@
+import json
+import os
+
+from collections import OrderedDict
+
+import numpy as np
+
+from pypeira.core.stack import Stack
+from pypeira.core.header_table import HeaderTable
+
+"""
+A cache of reduced data, so the FITS files of a data set only have to be read and parsed
+once. The cache is a directory holding one .npy file per array,
+
+    frames.npy, times.npy          the frames and timestamps of a Stack
+    header/<keyword>.npy           the columns of a HeaderTable
+    arrays/<name>.npy              any other arrays, e.g. masks or light curves
+    meta.json                      what is in the cache, and the files it was made from
+
+which are memory mapped when loaded, so loading takes the same (short) time regardless of
+the size of the data, and only the parts used are read from disk. Example,
+
+    if cache_valid("/path/to/cache", paths):
+        cache = load_cache("/path/to/cache")
+    else:
+        save_cache("/path/to/cache", stack, table, sources=paths, mask=mask)
+
+The meta file is written last, so a cache which was not written completely is not valid.
+"""
+
+_meta_filename = 'meta.json'
+
+# Version of the layout of the cache, bumped if it changes
+_cache_version = 1
+
+
+class Cache(object):
+    """
+    The data loaded from a cache directory, see load_cache().
+    """
+    def __init__(self, stack=None, header_table=None, arrays=None, meta=None):
+        self.stack = stack                                              # Stack object or None
+        self.header_table = header_table                                # HeaderTable object or None
+        self.arrays = arrays if arrays is not None else {}              # Any other arrays by name
+        self.meta = meta if meta is not None else {}                    # Contents of meta.json
+
+    def __getitem__(self, name):
+        return self.arrays[name]
+
+
+def file_signatures(paths):
+    """
+    Returns
+    -------
+    [[str, float, int], ... ]
+        The absolute path, modification time and size of each file, used to tell whether
+        the files have changed.
+    """
+    signatures = list()
+
+    for path in paths:
+        stat = os.stat(path)
+        signatures.append([os.path.abspath(path), stat.st_mtime, stat.st_size])
+
+    return signatures
+
+
+def _save_array(path, array):
+    # Object arrays (e.g. header values of mixed types) have to be pickled
+    array = np.asanyarray(array)
+    np.save(path, array, allow_pickle=array.dtype.hasobject)
+
+
+def _load_array(path, mmap):
+    # Pickled object arrays can not be memory mapped
+    try:
+        return np.load(path, mmap_mode='r' if mmap else None)
+    except ValueError:
+        return np.load(path, allow_pickle=True)
+
+
+def save_cache(path, stack=None, header_table=None, sources=None, **arrays):
+    """
+    Saves reduced data to a cache directory.
+
+    Parameters
+    ----------
+    path: str
+        The cache directory. Created if it does not exist, and any previous cache in it
+        is replaced.
+    stack: Stack object, optional
+        The frames and timestamps to save.
+    header_table: HeaderTable object, optional
+        The header values to save.
+    sources: [str, ... ], optional
+        The paths of the files the data was reduced from. Their modification times and
+        sizes are stored, see cache_valid().
+    **arrays: numpy.array, optional
+        Any other arrays to save by name, e.g. mask=mask, flux=flux.
+    """
+    for subdir in ('', 'header', 'arrays'):
+        if not os.path.isdir(os.path.join(path, subdir)):
+            os.makedirs(os.path.join(path, subdir))
+
+    # Invalidate the previous cache, if any, until the new one is complete
+    meta_path = os.path.join(path, _meta_filename)
+
+    if os.path.exists(meta_path):
+        os.remove(meta_path)
+
+    meta = {
+        'version': _cache_version,
+        'stack': stack is not None,
+        'header': None,
+        'arrays': sorted(arrays),
+        'sources': file_signatures(sources) if sources is not None else None
+    }
+
+    if stack is not None:
+        _save_array(os.path.join(path, 'frames.npy'), stack.frames)
+        _save_array(os.path.join(path, 'times.npy'), stack.times)
+
+    if header_table is not None:
+        meta['header'] = list(header_table.keywords)
+
+        for kwd in header_table.keywords:
+            _save_array(os.path.join(path, 'header', kwd + '.npy'), header_table.column(kwd))
+
+    for name, array in arrays.items():
+        _save_array(os.path.join(path, 'arrays', name + '.npy'), array)
+
+    with open(meta_path, 'w') as f:
+        json.dump(meta, f)
+
+
+def load_cache(path, mmap=True):
+    """
+    Loads the data saved by save_cache().
+
+    Parameters
+    ----------
+    path: str
+        The cache directory.
+    mmap: bool, optional
+        If True the arrays are memory mapped read-only instead of read into memory, so only
+        the parts used are read from disk. Default is True.
+
+    Returns
+    -------
+    Cache object
+        Holding the Stack, HeaderTable and other arrays saved, and the meta data.
+    """
+    meta_path = os.path.join(path, _meta_filename)
+
+    if not os.path.isfile(meta_path):
+        raise RuntimeError("{0} is not a (complete) cache.".format(path))
+
+    with open(meta_path) as f:
+        meta = json.load(f)
+
+    if meta.get('version') != _cache_version:
+        raise RuntimeError("Cache {0} is of version {1}, expected {2}."
+                           .format(path, meta.get('version'), _cache_version))
+
+    stack = None
+    header_table = None
+
+    if meta['stack']:
+        stack = Stack(_load_array(os.path.join(path, 'frames.npy'), mmap),
+                      _load_array(os.path.join(path, 'times.npy'), mmap))
+
+    if meta['header'] is not None:
+        columns = OrderedDict((kwd, _load_array(os.path.join(path, 'header', kwd + '.npy'), mmap))
+                              for kwd in meta['header'])
+        header_table = HeaderTable.from_columns(columns)
+
+    arrays = dict((name, _load_array(os.path.join(path, 'arrays', name + '.npy'), mmap))
+                  for name in meta['arrays'])
+
+    return Cache(stack, header_table, arrays, meta)
+
+
+def cache_valid(path, sources=None):
+    """
+    Checks whether a complete cache exists in 'path', and if 'sources' is given, that it
+    was made from exactly these files, none of which have changed since.
+
+    Parameters
+    ----------
+    path: str
+        The cache directory.
+    sources: [str, ... ], optional
+        The paths of the files the data would be reduced from.
+
+    Returns
+    -------
+    bool
+    """
+    meta_path = os.path.join(path, _meta_filename)
+
+    if not os.path.isfile(meta_path):
+        return False
+
+    with open(meta_path) as f:
+        meta = json.load(f)
+
+    if meta.get('version') != _cache_version:
+        return False
+
+    if sources is None:
+        return True
+
+    try:
+        return meta.get('sources') == file_signatures(sources)
+    except OSError:
+        return False
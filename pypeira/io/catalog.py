@@ -0,0 +1,226 @@
+import os
+import sqlite3
+
+from pypeira.io.reader import _readers, _find_files, _data_type
+
+
+class Catalog(object):
+    """
+    A persistent index of the headers of the files in a data directory.
+
+    The catalog is stored as an SQLite database, by default in the root of the data
+    directory, with one row per file holding its path, data type suffix (e.g. 'bcd'),
+    modification time, size and the values of a set of header keywords. Calling update()
+    only re-reads the headers of files which have been added or changed since the last
+    update, so repeated reductions of the same data can look up the files they need
+    instead of parsing every header again. Example,
+
+        catalog = Catalog("/path/to/AOR", ira.header_kwds)
+        catalog.update()
+        paths = catalog.query(dtype='bcd', CHNLNUM=2, BMJD_OBS=(56270.4, 56270.5))
+
+    Can be used as a context manager, closing the database when done.
+    """
+    _default_filename = '.pypeira_catalog.sqlite'
+
+    def __init__(self, root, keywords, path=None, ftype='fits'):
+        """
+        Parameters
+        ----------
+        root: str
+            The data directory to be indexed.
+        keywords: [str, ... ]
+            The header keywords to store for each file, e.g. IRA.header_kwds.
+        path: str, optional
+            Where to store the catalog. Default is '.pypeira_catalog.sqlite' in 'root'.
+        ftype: str, optional
+            The file type/extension of the files to index. Default is 'fits'.
+        """
+        if not os.path.isdir(root):
+            raise RuntimeError("{0} is not a directory.".format(root))
+
+        if ftype.lower() not in _readers:
+            raise RuntimeError("No reader found for {0} file type.".format(ftype))
+
+        self.root = os.path.abspath(root)
+        self.path = path if path is not None else os.path.join(self.root, self._default_filename)
+        self.keywords = list(keywords)
+        self.ftype = ftype
+
+        self._conn = sqlite3.connect(self.path)
+        self._create_table()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self._conn.close()
+
+    @property
+    def columns(self):
+        return ['path', 'dtype', 'mtime', 'size'] + self.keywords
+
+    def _create_table(self):
+        self._conn.execute("CREATE TABLE IF NOT EXISTS files ("
+                           "path TEXT PRIMARY KEY, dtype TEXT, mtime REAL, size INTEGER)")
+
+        existing = set(row[1] for row in self._conn.execute("PRAGMA table_info(files)"))
+        missing = [kwd for kwd in self.keywords if kwd not in existing]
+
+        for kwd in missing:
+            self._conn.execute('ALTER TABLE files ADD COLUMN "{0}"'.format(kwd))
+
+        # The headers already in the catalog lack the new keywords, so mark them as outdated
+        if missing:
+            self._conn.execute("UPDATE files SET mtime = -1")
+
+        self._conn.commit()
+
+    def _in_scope(self, path, directory, walk):
+        # Whether the file at 'path' is one update() would find in 'directory'
+        if walk:
+            return path.startswith(os.path.join(directory, ''))
+
+        return os.path.dirname(path) == directory
+
+    def update(self, walk=True, path=None):
+        """
+        Brings the catalog up to date with the files in the data directory, reading the
+        headers of new or changed files and removing the rows of files no longer present.
+
+        Parameters
+        ----------
+        walk: bool, optional
+            Whether or not to index the sub-directories as well. Default is True.
+        path: str, optional
+            Only update the files in this directory, which has to be within the root. The
+            rows of files outside of it, or in its sub-directories if 'walk' is False, are
+            left as they are. Default is None, i.e. the root.
+
+        Returns
+        -------
+        int
+            The number of headers which had to be read.
+        """
+        directory = self.root if path is None else os.path.abspath(path)
+
+        if directory != self.root and not self._in_scope(directory, self.root, True):
+            raise RuntimeError("{0} is not within {1}.".format(path, self.root))
+
+        reader = _readers[self.ftype.lower()]
+        known = dict((row[0], row[1:]) for row in self._conn.execute("SELECT path, mtime, size FROM files")
+                     if self._in_scope(row[0], directory, walk))
+
+        rows = list()
+        seen = set()
+
+        for path in _find_files(directory, walk):
+            root, ext = os.path.splitext(path)
+
+            if ext[1:].lower() != self.ftype.lower():
+                continue
+
+            stat = os.stat(path)
+            seen.add(path)
+
+            # Only read the header if the file is new or has changed
+            if known.get(path) == (stat.st_mtime, stat.st_size):
+                continue
+
+            hdr = reader(path, headers_only=True)
+
+            row = [path, _data_type(path), stat.st_mtime, stat.st_size]
+            row.extend(hdr.get(kwd) for kwd in self.keywords)
+
+            rows.append(row)
+
+        self._conn.executemany(
+            'INSERT OR REPLACE INTO files ({0}) VALUES ({1})'.format(
+                ', '.join('"{0}"'.format(col) for col in self.columns),
+                ', '.join('?' * len(self.columns))
+            ),
+            rows
+        )
+        self._conn.executemany("DELETE FROM files WHERE path = ?",
+                               [(path, ) for path in set(known) - seen])
+        self._conn.commit()
+
+        return len(rows)
+
+    def _where(self, dtype, conditions):
+        # Builds the WHERE clause and its parameters for select() and query()
+        clauses = list()
+        params = list()
+
+        if dtype is not None:
+            conditions = dict(conditions, dtype=dtype)
+
+        for col, value in sorted(conditions.items()):
+            # Only allow known columns, as they are put directly into the query
+            if col not in self.columns:
+                raise RuntimeError("{0} is not a column of the catalog.".format(col))
+
+            if isinstance(value, (tuple, list)):
+                # (low, high)-pair, where None means no limit
+                low, high = value
+
+                if low is not None:
+                    clauses.append('"{0}" >= ?'.format(col))
+                    params.append(low)
+                if high is not None:
+                    clauses.append('"{0}" <= ?'.format(col))
+                    params.append(high)
+            else:
+                clauses.append('"{0}" = ?'.format(col))
+                params.append(value)
+
+        if clauses:
+            return " WHERE " + " AND ".join(clauses), params
+        else:
+            return "", params
+
+    def select(self, dtype=None, **conditions):
+        """
+        Looks up the rows of the files satisfying the given conditions.
+
+        Parameters
+        ----------
+        dtype: str, optional
+            The data type suffix of the files, e.g. 'bcd'. Default is None, i.e. any.
+        **conditions: optional
+            Column/value pairs the files have to satisfy, where a column is one of the
+            stored keywords or 'path', 'mtime', 'size'. A value can be either a single
+            value which the column must be equal to, or a (low, high)-pair of inclusive
+            limits, where None means no limit.
+
+        Returns
+        -------
+        rows: [dict, ... ]
+            The rows of the files as dictionaries with the columns as keys, sorted by
+            BMJD_OBS if it is one of the keywords, and by path otherwise.
+        """
+        where, params = self._where(dtype, conditions)
+        order = '"BMJD_OBS", path' if 'BMJD_OBS' in self.keywords else 'path'
+
+        cursor = self._conn.execute(
+            "SELECT {0} FROM files{1} ORDER BY {2}".format(
+                ', '.join('"{0}"'.format(col) for col in self.columns), where, order
+            ),
+            params
+        )
+
+        return [dict(zip(self.columns, row)) for row in cursor]
+
+    def query(self, dtype=None, **conditions):
+        """
+        Same as select(), but only returns the paths of the files.
+
+        Returns
+        -------
+        paths: [str, ... ]
+            The paths of the files satisfying the given conditions.
+        """
+        return [row['path'] for row in self.select(dtype, **conditions)]
@@ -1,7 +1,46 @@
 import os
+import time
 
-from pypeira.io.reader import _read_file
-from pypeira.core.hdu import HDU
+from collections import deque
+from functools import partial
+
+from pypeira.io.reader import _read_file, _find_files, _match_file
+from pypeira.core.hdu import HDU, CompactHDU
+from pypeira.core.exposure import Exposure
+from pypeira.core.profiler import Profiler, null_profiler
+
+# concurrent.futures is only in the standard library from Python 3.2, and needs the 'futures'
+# backport on Python 2. Without it the files can only be read serially.
+try:
+    from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+    _executors = {
+        'thread': ThreadPoolExecutor,
+        'process': ProcessPoolExecutor
+    }
+except ImportError:
+    _executors = {}
+
+# The options of read() and iread() along with their defaults. They can only be given as
+# keywords, so any positional 'args' are passed on to the reader function as they always were.
+_read_options = {
+    'workers': None,
+    'executor': 'thread',
+    'chunksize': 16,
+    'prefetch': None,
+    'lazy': False,
+    'catalog': None,
+    'query': None,
+    'companions': None,
+    'header_table': None,
+    'compact': False,
+    'profiler': None
+}
+
+
+def _pop_options(kwargs):
+    # Removes the options of read() and iread() from 'kwargs', the rest goes to the reader
+    return dict((name, kwargs.pop(name, default)) for name, default in _read_options.items())
 
 
 def read(path, ftype='fits', dtype=None, walk=True, headers_only=False, image_only=False, *args, **kwargs):
@@ -37,7 +76,56 @@ def read(path, ftype='fits', dtype=None, walk=True, headers_only=False, image_on
         Set to True if you only want to read the headers of the files. If True, the data
         return will only be the headers of the files read. Default is False.
     image_only: bool, optional
-        Set to True if you only want to read the image data of the files. NOT IMPLEMENTED.
+        Set to True if you only want to read the image data of the files. If True, the data
+        returned will only be the image data of the files read. Default is False.
+
+    The following options can only be given as keywords.
+
+    workers: int, optional
+        If given, the files of a directory are read by a pool of 'workers' threads or
+        processes, as specified by 'executor'. The returned data will be in the same order
+        as when read serially. Default is None, i.e. the files are read one by one.
+    executor: str, optional
+        Either 'thread' or 'process'. Only used if 'workers' is given. Threads are cheap to
+        start, but processes are not limited by the GIL when decoding many small files, at
+        the cost of having to send the data read back to the main process. Default is 'thread'.
+        On Python 2 both need the 'futures' package.
+    chunksize: int, optional
+        Number of files handed to a worker of a process pool at a time. Default is 16.
+    lazy: bool, optional
+        If True, only the headers are read when creating the HDU objects, and the image
+        data of each HDU is read the first time it is accessed. Not used if 'headers_only'
+        or 'image_only' is True. Default is False.
+    catalog: Catalog object, optional
+        A header catalog (see pypeira.io.catalog) of a directory containing 'path'. If given,
+        the catalog is updated and the files to read are looked up in it, instead of
+        checking the files found in 'path' one by one. Default is None.
+    query: dict, optional
+        Conditions the files looked up in 'catalog' have to satisfy, in addition to
+        'dtype', e.g. {'CHNLNUM': 2, 'BMJD_OBS': (56270.4, 56270.5)}. See Catalog.select().
+        Only used if 'catalog' is given.
+    companions: [str, ... ], optional
+        The data types of the products to read along with each file of type 'dtype', e.g.
+        ['bunc', 'bimsk'] for the uncertainties and bit mask of each 'bcd' file. The companion
+        files are found by replacing the data type in the file name, and only their image data
+        is read. If given, an Exposure object (see pypeira.core.exposure) is returned for each
+        file instead of an HDU object. Requires 'dtype', and can not be combined with
+        'headers_only' or 'image_only'. Default is None.
+    header_table: HeaderTable object, optional
+        If given, the header values of each file read are appended to it, and the HDU objects
+        only keep their row in the table instead of the full header, which saves a lot of
+        memory for many files. If 'headers_only' is True the headers are appended as well.
+        See pypeira.core.header_table. Can not be combined with 'image_only'. Default is None.
+    compact: bool, optional
+        If True, CompactHDU objects are created instead of HDU objects, which use much less
+        memory when reading many files. See pypeira.core.hdu.CompactHDU. Default is False.
+    profiler: Profiler object, optional
+        If given, the time spent finding, filtering and reading the files is added to its
+        'walk', 'filter' and 'read' stages, with the reads broken down into 'read_header',
+        'read_image' and 'has_data', and the files seen, skipped and read, along with the
+        bytes of image data read, to its counters. The HDUs read keep it, so the image data
+        of lazy HDUs is timed when read later on. See pypeira.core.profiler. Default is None,
+        i.e. no profiling.
     *args: optional
         Contains all arguments that will be passed onto the actual reader function, where the
         reader function used for each file type/extension is as specified above.
@@ -60,6 +148,13 @@ def read(path, ftype='fits', dtype=None, walk=True, headers_only=False, image_on
 
         See pypeira.core.hdu for implementation of HDU.
 
+    Exposure object
+        If 'companions' is given it will return in the same manner as for the HDU object,
+        but now the type will be Exposure objects, holding the HDU along with the image
+        data of the companion products.
+
+        See pypeira.core.exposure for implementation of Exposure.
+
     FITSHDR object
         If 'headers_only' is not False it will return in the same manner as for the FITS object,
         but now the type of the files will be FITSHDR objects.
@@ -81,6 +176,15 @@ def read(path, ftype='fits', dtype=None, walk=True, headers_only=False, image_on
     # Initialize variables
     data = list()
 
+    # 'data_type' is the name used by _read_file(), accept it as an alias of 'dtype'
+    dtype = kwargs.pop('data_type', dtype)
+    options = _pop_options(kwargs)
+
+    lazy = options['lazy']
+    compact = options['compact']
+    header_table = options['header_table']
+    profiler = options['profiler']
+
     # First check if path is valid, raise OSError() if invalid
     if not os.path.exists(path):
         raise RuntimeError("{0} does not exists.".format(path))
@@ -88,48 +192,410 @@ def read(path, ftype='fits', dtype=None, walk=True, headers_only=False, image_on
     # Check if file
     if os.path.isfile(path):
         # Read file
-        if headers_only or image_only:
-            data = _read_file(path, ftype, dtype, headers_only, image_only, *args, **kwargs)
+        if options['companions'] is not None:
+            kwargs.update(options)
+            data = next(iread(path, ftype, dtype, walk, headers_only, image_only, *args, **kwargs), None)
         else:
-            data = HDU(path, ftype=ftype, dtype=dtype)
+            profiler = profiler if profiler is not None else null_profiler
+
+            with profiler.stage('read'):
+                if headers_only or image_only:
+                    data = _read_file(path, ftype, dtype, headers_only, image_only, profiler=profiler,
+                                      *args, **kwargs)
+                else:
+                    hdu_cls = CompactHDU if compact else HDU
+                    data = hdu_cls(path, ftype=ftype, dtype=dtype, lazy=lazy, profiler=profiler, *args, **kwargs)
+
+            profiler.count('files_seen')
+            _count_read(profiler, data)
+            _to_table(data, header_table, image_only)
 
     # Check if dir
     elif os.path.isdir(path):
-        # If dir to be walked
-        if walk:
-            # Walk directory
-            nodes = os.walk(path)
-
-            # Iterate through the nodes:
-            # node[0] is the current node
-            # node[1] contains folders in current node
-            # node[2] contains the file names in current node
-            for node in nodes:
-                for fname in node[2]:
-                    # Create path for 'fname'
-                    file_path = os.path.join(node[0], fname)
-
-                    if headers_only or image_only:
-                        file_data = _read_file(file_path, ftype, dtype, headers_only, image_only,
-                                               *args, **kwargs)
-                        # If read was successful, append to data
-                        if file_data is not None:
-                            data.append(file_data)
-                    else:
-                        # Create HDU instance which will call _read_file() itself
-                        hdu = HDU(file_path, ftype=ftype, dtype=dtype, *args, **kwargs)
-
-                        # If read was successful, append to data
-                        if hdu.has_data:
-                            data.append(hdu)
+        kwargs.update(options)
+        data = list(iread(path, ftype, dtype, walk, headers_only, image_only, *args, **kwargs))
+
+    return data
+
+
+def iread(path, ftype='fits', dtype=None, walk=True, headers_only=False, image_only=False, *args, **kwargs):
+    """
+    Generator version of read(). Instead of collecting the data of all the files in a list,
+    it is yielded file by file as it is read, so the data can be processed while the rest is
+    being read, and without having to hold all of it in memory at once.
+
+    Parameters
+    ----------
+    path: str
+        The path you want to read files from. See read().
+    ftype, dtype, walk, headers_only, image_only, workers, executor, chunksize, lazy, catalog, query, companions, header_table, compact, profiler: optional
+        See read(). The 'read' stage of 'profiler' only holds the time spent waiting for the
+        data of each file, not the time spent processing it in between. The workers of a
+        process pool time their reads with a profiler of their own, which is returned along
+        with the data of each file and merged into 'profiler'.
+    prefetch: int, optional
+        Keyword only, like the options of read() from 'workers' on. The maximum number of
+        files (or chunks of files, for a process pool) being read ahead of what has been
+        yielded. If given without 'workers', a single thread reads ahead while the data
+        already read is processed. Default is None, which is twice the number of workers if
+        'workers' is given, and no read-ahead otherwise.
+    *args, **kwargs: optional
+        See read().
+
+    Yields
+    ------
+    HDU object, Exposure object, FITSHDR object or numpy.array
+        The data of each valid file, in the same order as returned by read().
+
+    Raises
+    ------
+    OSError
+        Raises OSError if the given path does not exist.
+    """
+    # 'data_type' is the name used by _read_file(), accept it as an alias of 'dtype'
+    dtype = kwargs.pop('data_type', dtype)
+    options = _pop_options(kwargs)
+
+    workers = options['workers']
+    executor = options['executor']
+    chunksize = options['chunksize']
+    prefetch = options['prefetch']
+    lazy = options['lazy']
+    catalog = options['catalog']
+    query = options['query']
+    companions = options['companions']
+    header_table = options['header_table']
+    compact = options['compact']
+    profiler = options['profiler']
+
+    # First check if path is valid, raise OSError() if invalid
+    if not os.path.exists(path):
+        raise RuntimeError("{0} does not exists.".format(path))
+
+    if header_table is not None and image_only:
+        raise RuntimeError("A header table can not be built when reading 'image_only'.")
+
+    profiler = profiler if profiler is not None else null_profiler
+
+    # Reads a single file, and is what is handed out to the workers if any
+    reader = partial(_read_path, ftype=ftype, dtype=dtype, headers_only=headers_only,
+                     image_only=image_only, lazy=lazy, args=args, kwargs=kwargs, compact=compact)
+
+    # Files found by walking 'path', used to look up companion files without touching the file system
+    found = None
+
+    with profiler.stage('walk'):
+        if os.path.isfile(path):
+            paths = [path]
+        elif catalog is not None:
+            paths = _query_catalog(catalog, path, dtype, walk, query)
         else:
-            # Read files from top dir only
-            for fname in os.listdir(path):
-                # os.listdir() returns a list of paths as strings for each file in path
-                file_data = _read_file(fname, ftype, dtype, headers_only, image_only, *args, **kwargs)
+            paths = found = _find_files(path, walk)
 
-                # if _read_file() was successful, append returned value to 'data' list
-                if file_data is not None:
-                    data.append(file_data)
+    n_seen = len(paths)
 
-    return data
+    # Discard the files which would not be read, based on the file names only
+    with profiler.stage('filter'):
+        paths = [file_path for file_path in paths if _match_file(file_path, ftype, dtype)]
+
+    profiler.count('files_seen', n_seen)
+    profiler.count('files_skipped', n_seen - len(paths))
+
+    if companions is not None:
+        if dtype is None:
+            raise RuntimeError("A 'dtype' is needed to find the companions of each file.")
+
+        if headers_only or image_only:
+            raise RuntimeError("Companions can not be read along with 'headers_only' or 'image_only'.")
+
+        # Each item is now the path of a file along with the paths of its companions
+        paths = _group_exposures(paths, dtype, companions, found)
+        reader = partial(_read_exposure, ftype=ftype, dtype=dtype, lazy=lazy, args=args, kwargs=kwargs,
+                         compact=compact)
+
+    # The profiler is not shared with the workers of a process pool, which instead time each
+    # file with a profiler of their own, returned along with its data
+    profiled = bool(profiler) and executor == 'process' and (workers is not None or prefetch is not None)
+
+    if profiled:
+        reader = partial(_profiled, reader)
+    else:
+        reader = partial(reader, profiler=profiler)
+
+    if workers is None and prefetch is None:
+        results = (reader(file_path) for file_path in paths)
+    else:
+        if not _executors:
+            raise RuntimeError("Reading with a pool of workers needs the 'futures' package on Python 2.")
+
+        if executor not in _executors:
+            raise RuntimeError("Unknown executor {0}, must be one of {1}."
+                               .format(executor, sorted(_executors)))
+
+        workers = workers if workers is not None else 1
+        prefetch = prefetch if prefetch is not None else 2 * workers
+
+        # Handing out several files per task keeps the process pool overhead down,
+        # while threads are cheap enough to hand out one file at a time
+        if executor != 'process':
+            chunksize = 1
+
+        results = _imap(reader, paths, _executors[executor](max_workers=workers), chunksize, prefetch)
+
+        if profiled:
+            results = _merged(results, profiler)
+
+    if profiler:
+        results = _timed(results, profiler, 'read')
+
+    for file_data in results:
+        _count_read(profiler, file_data)
+
+        # If read was successful, yield the data
+        if file_data is not None:
+            _to_table(file_data, header_table, image_only)
+
+            yield file_data
+
+
+def _to_table(data, header_table, image_only):
+    # Adds the header of the data read to 'header_table', if any. HDU and Exposure objects
+    # move their header into it, while headers read by 'headers_only' are simply appended.
+    if header_table is None or data is None:
+        return
+
+    if image_only:
+        raise RuntimeError("A header table can not be built when reading 'image_only'.")
+
+    if hasattr(data, 'to_table'):
+        data.to_table(header_table)
+    else:
+        header_table.append(data)
+
+
+def _timed(items, profiler, name):
+    # Yields the items, adding the time spent waiting for each to the stage 'name' of
+    # 'profiler', but not the time spent by the caller in between
+    items = iter(items)
+
+    while True:
+        start = time.time()
+
+        try:
+            item = next(items)
+        except StopIteration:
+            return
+
+        profiler.add_time(name, time.time() - start)
+
+        yield item
+
+
+def _profiled(reader, item):
+    # Reads 'item' in a worker of a process pool, timing it with a profiler of its own.
+    # Defined at module level so that it can be sent to the workers.
+    profiler = Profiler()
+    data = reader(item, profiler=profiler)
+
+    return data, profiler.report()['stages']
+
+
+def _merged(results, profiler):
+    # Merges the timings returned by _profiled() into 'profiler', which the HDUs keep from then on
+    for data, stages in results:
+        profiler.merge(stages)
+
+        hdu = getattr(data, 'hdu', data)
+
+        if hasattr(hdu, 'profiler'):
+            hdu.profiler = profiler
+
+        yield data
+
+
+def _nbytes(data):
+    # The bytes of image data held by the data read. Lazy HDUs have not read any yet.
+    if data is None:
+        return 0
+
+    if hasattr(data, 'nbytes'):
+        return data.nbytes
+
+    if hasattr(data, 'companions'):
+        return _nbytes(data.hdu) + sum(_nbytes(image) for image in data.companions.values())
+
+    if getattr(data, 'is_loaded', False):
+        return data.img.nbytes
+
+    return 0
+
+
+def _count_read(profiler, data):
+    # Files which turned out not to be valid, or to have no data, are counted as skipped
+    if not profiler:
+        return
+
+    if data is None:
+        profiler.count('files_skipped')
+    else:
+        profiler.count('files_read')
+        profiler.count('bytes_read', _nbytes(data))
+
+
+def _imap(func, items, pool, chunksize, prefetch):
+    """
+    Maps 'func' over 'items' using 'pool', handing out 'chunksize' items per task and
+    keeping at most 'prefetch' tasks in flight. The results are yielded in the same order
+    as the items. The pool is shut down when the generator is exhausted or closed.
+    """
+    tasks = (items[i:i + chunksize] for i in range(0, len(items), chunksize))
+    pending = deque()
+
+    with pool:
+        try:
+            for chunk in tasks:
+                pending.append(pool.submit(_map_chunk, func, chunk))
+
+                # Wait for the oldest task once the read-ahead limit is reached
+                if len(pending) >= prefetch:
+                    for result in pending.popleft().result():
+                        yield result
+
+            while pending:
+                for result in pending.popleft().result():
+                    yield result
+        finally:
+            # If the generator is closed early, don't read any more than necessary
+            for future in pending:
+                future.cancel()
+
+
+def _map_chunk(func, chunk):
+    # Defined at module level so that it can be sent to the workers of a process pool
+    return [func(item) for item in chunk]
+
+
+def _query_catalog(catalog, path, dtype, walk, query):
+    """
+    Looks up the files in 'catalog' which are in the directory 'path' and satisfy
+    the conditions given by 'dtype' and 'query'. See read().
+    """
+    root = os.path.abspath(path)
+
+    # Only the directory being read is updated, the rest of the catalog is left as it is
+    catalog.update(walk, root)
+    paths = list()
+
+    for file_path in catalog.query(dtype, **(query or {})):
+        if walk:
+            if file_path.startswith(os.path.join(root, '')):
+                paths.append(file_path)
+        elif os.path.dirname(file_path) == root:
+            paths.append(file_path)
+
+    return paths
+
+
+def _companion_path(file_path, dtype, companion):
+    # The path of the file of data type 'companion' of the same exposure as 'file_path',
+    # which is assumed to be of the form "filename_*_dtype.ext"
+    root, ext = os.path.splitext(file_path)
+
+    return root[:len(root) - len(dtype)] + companion + ext
+
+
+def _group_exposures(paths, dtype, companions, found=None):
+    """
+    Pairs each file in 'paths' with the files of the same exposure of the data types given
+    by 'companions'. Companion files which do not exist are left out.
+
+    Parameters
+    ----------
+    paths: [str, ... ]
+        The paths of the files of data type 'dtype'.
+    dtype, companions: str and [str, ... ]
+        See read().
+    found: [str, ... ], optional
+        All the files found when walking the directory. If given the companions are looked up
+        in it, otherwise the file system is checked for each of them. Default is None.
+
+    Returns
+    -------
+    [(str, {str: str}), ... ]
+        The path of each file, along with the path of each of its companions by data type.
+    """
+    if found is not None:
+        found = set(found)
+        exists = found.__contains__
+    else:
+        exists = os.path.isfile
+
+    groups = list()
+
+    for file_path in paths:
+        group = dict()
+
+        for companion in companions:
+            companion_path = _companion_path(file_path, dtype, companion)
+
+            if exists(companion_path):
+                group[companion] = companion_path
+
+        groups.append((file_path, group))
+
+    return groups
+
+
+def _read_exposure(item, ftype, dtype, lazy, args, kwargs, compact=False, profiler=None):
+    """
+    Reads a file along with the image data of its companions, as grouped by _group_exposures().
+    Defined at module level so that it can be sent to the workers of a process pool.
+
+    Returns
+    -------
+    Exposure object or None
+        See read(). None if the file is not valid or has no data.
+    """
+    file_path, group = item
+
+    hdu = _read_path(file_path, ftype, dtype, False, False, lazy, args, kwargs, compact, profiler)
+
+    if hdu is None:
+        return None
+
+    images = dict()
+
+    for companion, companion_path in group.items():
+        images[companion] = _read_file(companion_path, ftype, companion, False, True, profiler=profiler,
+                                       *args, **kwargs)
+
+    return Exposure(hdu, images)
+
+
+def _read_path(file_path, ftype, dtype, headers_only, image_only, lazy, args, kwargs, compact=False,
+               profiler=None):
+    """
+    Reads a single file found by read(). Defined at module level so that it can be
+    sent to the workers of a process pool.
+
+    Returns
+    -------
+    HDU object, FITSHDR object, numpy.array or None
+        See read(). None if the file is not valid or has no data.
+    """
+    profiler = profiler if profiler is not None else null_profiler
+
+    if headers_only or image_only:
+        return _read_file(file_path, ftype, dtype, headers_only, image_only, profiler=profiler, *args, **kwargs)
+
+    # Create HDU instance which will call _read_file() itself
+    hdu_cls = CompactHDU if compact else HDU
+    hdu = hdu_cls(file_path, ftype=ftype, dtype=dtype, lazy=lazy, profiler=profiler, *args, **kwargs)
+
+    with profiler.stage('has_data'):
+        has_data = hdu.has_data
+
+    if has_data:
+        return hdu
+
+    return None
@@ -1,6 +1,9 @@
 from __future__ import division
 
 import fitsio
+import numpy as np
+
+from pypeira.core.profiler import null_profiler
 
 """
 A FITS file is comprised of segments called Header/Data Units (HDUs), where the first
@@ -51,6 +54,103 @@ def read_image(path, *args, **kwargs):
     return data
 
 
+# The (big-endian) data types of the image data as given by the BITPIX keyword
+_bitpix_dtypes = {
+    8: np.dtype('u1'),
+    16: np.dtype('>i2'),
+    32: np.dtype('>i4'),
+    64: np.dtype('>i8'),
+    -32: np.dtype('>f4'),
+    -64: np.dtype('>f8')
+}
+
+
+def open_fits(path, mode='r'):
+    """
+    Opens a FITS file, returning a fitsio.FITS object which can be passed on to read_fits()
+    using the 'fits' keyword. Use this if you want to read several extensions of the same
+    file while only opening it once, i.e.
+
+        with open_fits(path) as fits:
+            hdr, image = read_fits(path, fits=fits, ext=0)
+            mask = read_fits(path, image_only=True, fits=fits, ext=1)
+
+    Parameters
+    ----------
+    path: str
+        Path to the FITS file you want to open.
+    mode: str, optional
+        See fitsio.FITS. Default is 'r'.
+
+    Returns
+    -------
+    fitsio.FITS object
+        Should be closed when done, preferably by using it as a context manager.
+    """
+    return fitsio.FITS(path, mode)
+
+
+def _image_hdu(fits, ext):
+    # Same behaviour as fitsio.read(): if no extension is given, read the first HDU with data
+    if ext is not None:
+        return fits[ext]
+
+    for hdu in fits:
+        if hdu.has_data():
+            return hdu
+
+    raise IOError("No extensions have data in {0}.".format(fits._filename))
+
+
+def read_image_mmap(path, ext=0, fits=None):
+    """
+    Memory maps the image data of an uncompressed FITS image, instead of reading it into
+    memory. Pages are read from the file as they are accessed, and are shared with the
+    OS page cache and other processes mapping the same file.
+
+    Parameters
+    ----------
+    path: str
+        Path to the FITS file.
+    ext: int or str, optional
+        The extension holding the image data. Default is 0, the primary HDU.
+    fits: fitsio.FITS object, optional
+        An already opened file, see open_fits(). Only used to look up where the image
+        data starts.
+
+    Returns
+    -------
+    numpy.memmap
+        A read-only array with the big-endian data type given by BITPIX, of the same shape
+        as returned by fitsio.read().
+
+    Raises
+    ------
+    IOError
+        If the image data cannot be mapped directly, i.e. it is compressed, scaled using
+        BSCALE/BZERO, or not an image.
+    """
+    if fits is None:
+        with open_fits(path) as fits:
+            return read_image_mmap(path, ext, fits)
+
+    hdu = fits[ext]
+
+    if hdu.get_exttype() != 'IMAGE_HDU' or hdu.is_compressed():
+        raise IOError("Extension {0} of {1} is not an uncompressed image.".format(ext, path))
+
+    hdr = hdu.read_header()
+
+    if hdr.get('BSCALE', 1) != 1 or hdr.get('BZERO', 0) != 0:
+        raise IOError("Image data of {0} is scaled, and cannot be memory mapped.".format(path))
+
+    # The dimensions are returned in the same (C-)order as used by fitsio.read()
+    shape = tuple(hdu.get_dims())
+    offset = hdu.get_offsets()['data_start']
+
+    return np.memmap(path, dtype=_bitpix_dtypes[hdr['BITPIX']], mode='r', offset=offset, shape=shape)
+
+
 def read_fits(path, headers_only=False, image_only=False, *args, **kwargs):
     """
     Reader function for the FITS files. Takes advantage of the fitsio
@@ -68,10 +168,26 @@ def read_fits(path, headers_only=False, image_only=False, *args, **kwargs):
         return will be a numpy array corresponding to the image data of the files read.
         Default is False.
     *args: optional
-        Contains all arguments that will be passed onto the fitsio reader. This reader will
-        be fitsio.read_headers() or fitsio.FITS() depending on if 'headers_only' is True or False.
+        Contains all arguments that will be passed onto the fitsio image reader, i.e.
+        fitsio.fitslib.ImageHDU.read(). Not used if 'headers_only' is True.
     **kwargs: optional
-        Contains all keyword arguments that will be passed to the fitsio reader.
+        Contains all keyword arguments that will be passed to the fitsio image reader, except
+        for the following which are used by this function itself:
+
+        ext: int or str, optional
+            The extension to read from. If not given the header is read from the primary HDU,
+            and the image from the first HDU with data, as done by fitsio.read_header()
+            and fitsio.read().
+        fits: fitsio.FITS object, optional
+            An already opened file, see open_fits(). It will not be closed after reading.
+            If not given, the file is opened once and both the header and the image data
+            are read from the same handle.
+        mmap: bool, optional
+            If True, the image data is memory mapped using read_image_mmap() instead of
+            read into memory. Default is False.
+        profiler: Profiler object, optional
+            If given, the time spent reading the header and the image data is added to its
+            'read_header' and 'read_image' stages. See pypeira.core.profiler. Default is None.
 
     Returns
     -------
@@ -89,18 +205,43 @@ def read_fits(path, headers_only=False, image_only=False, *args, **kwargs):
         If 'image_only' is not False it will return in the same manner as for the FITS object,
         but now the type of the tiles will be numpy.arrays.
     """
+    ext = kwargs.pop('ext', None)
+    fits = kwargs.pop('fits', None)
+    mmap = kwargs.pop('mmap', False)
+    profiler = kwargs.pop('profiler', None) or null_profiler
+
+    if fits is None:
+        with open_fits(path) as fits:
+            return _read_fits(path, fits, ext, mmap, profiler, headers_only, image_only, *args, **kwargs)
+
+    return _read_fits(path, fits, ext, mmap, profiler, headers_only, image_only, *args, **kwargs)
+
+
+def _read_fits(path, fits, ext, mmap, profiler, headers_only, image_only, *args, **kwargs):
+    # Reads from an opened file, see read_fits()
     if headers_only:
-        hdr = read_headers(path, *args, **kwargs)
+        with profiler.stage('read_header'):
+            hdr = fits[0 if ext is None else ext].read_header()
         return hdr
 
     elif image_only:
-        image = read_image(path, *args, **kwargs)
+        with profiler.stage('read_image'):
+            image = _read_image(path, fits, ext, mmap, *args, **kwargs)
         return image
 
     else:
-        hdr = read_headers(path, *args, **kwargs)
-        image = read_image(path, *args, **kwargs)
+        with profiler.stage('read_header'):
+            hdr = fits[0 if ext is None else ext].read_header()
+        with profiler.stage('read_image'):
+            image = _read_image(path, fits, ext, mmap, *args, **kwargs)
 
     return hdr, image
 
 
+def _read_image(path, fits, ext, mmap, *args, **kwargs):
+    hdu = _image_hdu(fits, ext)
+
+    if mmap:
+        return read_image_mmap(path, hdu.get_extnum(), fits)
+
+    return hdu.read(*args, **kwargs)
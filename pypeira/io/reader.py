@@ -1,4 +1,5 @@
 import os
+import re
 
 from pypeira.io.fits import read_fits
 
@@ -6,6 +7,90 @@ _readers = {
     'fits': read_fits
 }
 
+# Spitzer file names are of the form SPITZER_I<channel>_<aorkey>_<expid>_<dce>_<version>_<dtype>.<ftype>,
+# e.g. SPITZER_I2_46466816_0000_0000_2_bcd.fits
+_spitzer_fname = re.compile(
+    r'^SPITZER_I(?P<channel>\d)_(?P<aorkey>\d+)_(?P<expid>\d+)_(?P<dce>\d+)_(?P<version>\d+)'
+    r'_(?P<dtype>[^_.]+)\.(?P<ftype>[^.]+)$'
+)
+
+# Compiled file name patterns for each (ftype, data_type)-pair, see _file_pattern()
+_file_patterns = {}
+
+
+def parse_filename(path):
+    """
+    Parses the name of a file following the Spitzer naming convention
+
+        SPITZER_I<channel>_<aorkey>_<expid>_<dce>_<version>_<dtype>.<ftype>
+
+    Parameters
+    ----------
+    path: str
+        The path or name of the file.
+
+    Returns
+    -------
+    dict or None
+        The integers 'channel', 'aorkey', 'expid', 'dce' and 'version', and the
+        strings 'dtype' and 'ftype'. None if the name does not follow the convention.
+    """
+    match = _spitzer_fname.match(os.path.basename(path))
+
+    if match is None:
+        return None
+
+    info = match.groupdict()
+
+    for key in ('channel', 'aorkey', 'expid', 'dce', 'version'):
+        info[key] = int(info[key])
+
+    return info
+
+
+def _file_pattern(ftype=None, data_type=None):
+    # Compiles (once) a pattern matching the names of the files _read_file() would read,
+    # i.e. names of the form "filename_*_datatype.ext", where the extension is case-insensitive
+    key = (ftype, data_type)
+
+    if key not in _file_patterns:
+        if ftype is not None:
+            ext = ''.join('[{0}{1}]'.format(c.lower(), c.upper()) if c.isalpha() else re.escape(c)
+                          for c in ftype)
+        else:
+            ext = r'[^.]*'
+
+        if data_type is not None:
+            dtype = r'(?:^|_){0}'.format(re.escape(data_type))
+        else:
+            dtype = ''
+
+        _file_patterns[key] = re.compile(r'{0}\.{1}$'.format(dtype, ext))
+
+    return _file_patterns[key]
+
+
+def _data_type(path):
+    """
+    The data type of a file, assuming its name is of the form "filename_*_datatype.ext",
+    e.g. 'bcd'. Only the name of the file is used, not the directories in its path.
+    """
+    return os.path.splitext(os.path.basename(path))[0].split('_')[-1]
+
+
+def _match_file(path, ftype=None, data_type=None):
+    """
+    Checks whether the file at 'path' is of type 'ftype' and data type 'data_type', using only
+    its name, not the directories in its path. This is what decides which files _read_file()
+    reads, and lets read() and HDU discard files before touching the file system.
+
+    Returns
+    -------
+    bool
+        True if the name of the file satisfies the given criteria.
+    """
+    return _file_pattern(ftype, data_type).search(os.path.basename(path)) is not None
+
 
 def _read_file(path, ftype=None, data_type=None, headers_only=False, image_only=False, *args, **kwargs):
     """
@@ -48,8 +133,9 @@ def _read_file(path, ftype=None, data_type=None, headers_only=False, image_only=
     if ftype is None:
         ftype = ext[1:]
 
-    # Type-check the file
-    if ext[1:].lower() == ftype.lower():
+    # Type-check the file, and check that it is of the given data_type if any, using its name only.
+    # The same check as used to discard files up front, see _match_file().
+    if _match_file(path, ftype, data_type):
         # Grab the reader used for this file type. _readers can be found at the start of this file.
         reader = _readers.get(ftype.lower())
 
@@ -57,13 +143,48 @@ def _read_file(path, ftype=None, data_type=None, headers_only=False, image_only=
         if reader is None:
             raise RuntimeError("No reader found for {0} file type.".format(ftype))
 
-        # Check if data_type is specified, and if so, check that file satisfies this requirement.
-        if data_type is not None:
-            # Assuming files are of the form "filename_*_datatype.ext"
-            # If this is not a standard, then this validity check will be changed in the future.
-            if data_type == root.split('_')[-1]:
-                data = reader(path, headers_only, image_only, *args, **kwargs)
-        else:
-            data = reader(path, headers_only, image_only, *args, **kwargs)
+        data = reader(path, headers_only, image_only, *args, **kwargs)
+
+    return data
+
+
+def _find_files(path, walk=True):
+    """
+    Lists the paths of all the files in the directory 'path', sorted so that the
+    order of the data returned by io.common.read() is deterministic.
+
+    Parameters
+    ----------
+    path: str
+        The directory to look for files in.
+    walk: bool, optional
+        See io.common.read().
+
+    Returns
+    -------
+    paths: [str, ... ]
+        The paths of the files found.
+    """
+    paths = list()
+
+    if walk:
+        # Iterate through the nodes:
+        # node[0] is the current node
+        # node[1] contains folders in current node
+        # node[2] contains the file names in current node
+        for node in os.walk(path):
+            # Walk the sub-directories in sorted order as well
+            node[1].sort()
+
+            for fname in sorted(node[2]):
+                paths.append(os.path.join(node[0], fname))
+    else:
+        # Read files from top dir only
+        for fname in sorted(os.listdir(path)):
+            # os.listdir() returns only the names of the files, not their paths
+            file_path = os.path.join(path, fname)
+
+            if os.path.isfile(file_path):
+                paths.append(file_path)
 
-    return data
\ No newline at end of file
+    return paths
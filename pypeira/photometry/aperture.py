@@ -0,0 +1,209 @@
+from __future__ import division
+
+from collections import OrderedDict
+
+import numpy as np
+
+from pypeira.core.stack import as_frames, frame_chunks
+
+"""
+Circular aperture photometry of the frames of a frame stack, i.e. an array of shape
+(n_frames, rows, columns) such as Stack.frames, with per-frame aperture centers.
+
+Instead of computing the overlap of each aperture with the pixels for every frame, the
+sub-pixel position of the center is quantized into bins x bins offset bins, and the exact
+overlap of each aperture with the pixels of a stamp around the center is computed once for
+each bin. The most recently used weight tables are cached, and the flux of all the frames whose
+centers fall in the same bin is then a single matrix product of their stamps with the
+weights of that bin.
+
+As for the centroids, 'x' is the column and 'y' the row, with the center of pixel
+[row, column] at (x, y) = (column, row).
+"""
+
+# Weight tables for each (radii, bins)-pair, least recently used first, see aperture_weights()
+_weights_cache = OrderedDict()
+
+# Number of weight tables kept in _weights_cache, so sweeping many apertures does not grow it
+_weights_cache_size = 8
+
+
+def _area_above(x0, x1, h, r):
+    # Area of the part of the circle of radius 'r' centered on the origin which lies
+    # above the line y = h >= 0 and between the lines x = x0 and x = x1, x0 <= x1
+    s = np.sqrt(np.clip(r ** 2 - h ** 2, 0, None))
+
+    def integral(x):
+        # Indefinite integral of sqrt(r^2 - x^2) - h
+        return 0.5 * (x * np.sqrt(np.clip(r ** 2 - x ** 2, 0, None)) + r ** 2 * np.arcsin(np.clip(x / r, -1, 1))) \
+            - h * x
+
+    return integral(np.clip(x1, -s, s)) - integral(np.clip(x0, -s, s))
+
+
+def circle_overlap(x0, x1, y0, y1, r):
+    """
+    Exact area of the overlap between the rectangles [x0, x1] x [y0, y1] and the circle
+    of radius 'r' centered on the origin. All arguments are broadcast against each other.
+
+    Returns
+    -------
+    numpy.array
+        The area of each overlap.
+    """
+    x0, x1, y0, y1, r = np.broadcast_arrays(*[np.asarray(a, dtype=np.float64) for a in (x0, x1, y0, y1, r)])
+
+    # The rectangle split into its parts above and below the x-axis, the latter mirrored
+    return (_area_above(x0, x1, np.clip(y0, 0, None), r) - _area_above(x0, x1, np.clip(y1, 0, None), r) +
+            _area_above(x0, x1, np.clip(-y1, 0, None), r) - _area_above(x0, x1, np.clip(-y0, 0, None), r))
+
+
+def _half_size(radii):
+    # Half the width of the stamps needed to cover the apertures from any center in a pixel
+    return int(np.ceil(max(radii) + 0.5))
+
+
+def aperture_weights(radii, bins=20):
+    """
+    Computes (or looks up) the weight tables of circular apertures.
+
+    Parameters
+    ----------
+    radii: [float, ... ]
+        The radii of the apertures in pixels.
+    bins: int, optional
+        The number of offset bins along each axis within a pixel. The center of an aperture
+        is quantized to the center of its bin, i.e. to within 1 / (2 * bins) pixels.
+        Default is 20.
+
+    Returns
+    -------
+    numpy.array
+        Array of shape (bins * bins, n_radii, size * size), where size = 2 * half_size + 1,
+        holding the fraction of each pixel of a stamp centered on the pixel containing the
+        aperture center which lies within each aperture. The offset bin of a center is
+        row_bin * bins + column_bin. The array is cached, and read-only.
+    """
+    radii = tuple(float(r) for r in np.atleast_1d(radii))
+    key = (radii, bins)
+
+    if key in _weights_cache:
+        # Move to the end, i.e. make it the most recently used
+        weights = _weights_cache.pop(key)
+        _weights_cache[key] = weights
+    else:
+        half = _half_size(radii)
+
+        # Offsets of the centers of the bins from the center of the pixel
+        offsets = (np.arange(bins) + 0.5) / bins - 0.5
+        dy, dx = [a.ravel() for a in np.meshgrid(offsets, offsets, indexing='ij')]
+
+        # Pixel edges relative to the aperture center for each (bin, radius, row, column)
+        pix = np.arange(-half, half + 1, dtype=np.float64)
+        rows = pix[np.newaxis, np.newaxis, :, np.newaxis] - dy[:, np.newaxis, np.newaxis, np.newaxis]
+        cols = pix[np.newaxis, np.newaxis, np.newaxis, :] - dx[:, np.newaxis, np.newaxis, np.newaxis]
+        r = np.array(radii)[np.newaxis, :, np.newaxis, np.newaxis]
+
+        weights = circle_overlap(cols - 0.5, cols + 0.5, rows - 0.5, rows + 0.5, r)
+        weights = weights.reshape(bins * bins, len(radii), -1)
+        weights.setflags(write=False)
+
+        _weights_cache[key] = weights
+
+        while len(_weights_cache) > _weights_cache_size:
+            _weights_cache.popitem(last=False)
+
+    return weights
+
+
+def aperture_photometry(frames, x, y, radii, bins=20, background=None, chunk_size=65536):
+    """
+    Sums the flux within circular apertures of several radii around a center in each frame.
+
+    Parameters
+    ----------
+    frames: numpy.array or Stack
+        Array of shape (n_frames, rows, columns), or a Stack.
+    x, y: float or numpy.array
+        The x (column) and y (row) center of the apertures, either the same for all the
+        frames or one per frame, e.g. as returned by centroids.centroids.get_centroids().
+    radii: float or [float, ... ]
+        The radii of the apertures in pixels.
+    bins: int, optional
+        See aperture_weights(). Default is 20.
+    background: float or numpy.array, optional
+        The background per pixel of each frame, e.g. as returned by
+        background.background.get_background(), which is subtracted times the area of each
+        aperture. Default is None, i.e. no background subtraction.
+    chunk_size: int, optional
+        Maximum number of frames processed at once. Default is 65536.
+
+    Returns
+    -------
+    numpy.array
+        Array of shape (n_frames, n_radii) holding the flux within each aperture. NaN if a
+        pixel (partly) within the aperture is NaN or outside the frame, or if the center is NaN.
+    """
+    frames = as_frames(frames)
+    n = len(frames)
+    radii = np.atleast_1d(radii)
+
+    x = np.broadcast_to(np.asarray(x, dtype=np.float64), (n, ))
+    y = np.broadcast_to(np.asarray(y, dtype=np.float64), (n, ))
+
+    weights = aperture_weights(radii, bins)
+    areas = weights.sum(axis=2)
+    half = _half_size(radii)
+    pix = np.arange(-half, half + 1)
+
+    flux = np.full((n, len(radii)), np.nan)
+
+    for chunk in frame_chunks(n, chunk_size):
+        xc, yc = x[chunk], y[chunk]
+        valid = np.flatnonzero(np.isfinite(xc) & np.isfinite(yc))
+
+        # The pixel containing the center, and the offset bin of the center within it
+        col = np.floor(xc[valid] + 0.5).astype(np.int64)
+        row = np.floor(yc[valid] + 0.5).astype(np.int64)
+        col_bin = np.clip(((xc[valid] - col + 0.5) * bins).astype(np.int64), 0, bins - 1)
+        row_bin = np.clip(((yc[valid] - row + 0.5) * bins).astype(np.int64), 0, bins - 1)
+        bin_idx = row_bin * bins + col_bin
+
+        # Pad the frames with NaNs so stamps partly outside the frames can be cut out
+        padded = np.pad(frames[chunk][valid].astype(np.float64), ((0, 0), (half, half), (half, half)),
+                        mode='constant', constant_values=np.nan)
+
+        rows = np.clip(row[:, np.newaxis] + pix + half, 0, padded.shape[1] - 1)
+        cols = np.clip(col[:, np.newaxis] + pix + half, 0, padded.shape[2] - 1)
+
+        stamps = padded[np.arange(len(valid))[:, np.newaxis, np.newaxis],
+                        rows[:, :, np.newaxis], cols[:, np.newaxis, :]].reshape(len(valid), -1)
+
+        missing = np.isnan(stamps)
+        stamps[missing] = 0
+
+        chunk_flux = np.empty((len(valid), len(radii)))
+
+        # One matrix product per offset bin
+        order = np.argsort(bin_idx, kind='mergesort')
+        bounds = np.flatnonzero(np.diff(bin_idx[order])) + 1
+
+        for group in np.split(order, bounds):
+            if len(group) == 0:
+                continue
+
+            w = weights[bin_idx[group[0]]]
+
+            chunk_flux[group] = np.dot(stamps[group], w.T)
+
+            # Apertures covering missing pixels have an unknown flux
+            incomplete = np.dot(missing[group], (w > 0).T) > 0
+            chunk_flux[group] = np.where(incomplete, np.nan, chunk_flux[group])
+
+        if background is not None:
+            bkg = np.broadcast_to(np.asarray(background, dtype=np.float64), (n, ))[chunk][valid]
+            chunk_flux -= bkg[:, np.newaxis] * areas[bin_idx]
+
+        flux[np.arange(chunk.start, chunk.stop)[valid]] = chunk_flux
+
+    return flux
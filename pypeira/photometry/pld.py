@@ -0,0 +1,177 @@
+from __future__ import division
+
+import numpy as np
+
+from pypeira.core.stack import frame_chunks
+
+"""
+Pixel-level decorrelation (PLD), regressing a light curve against the normalized time
+series of the pixels of a stamp around the target, which model the intra-pixel
+sensitivity variations of IRAC as the target moves around on the detector.
+
+The stamps are typically taken from a Stack, e.g.
+
+    times, stamps = stack.aperture((13, 16), (13, 16))
+    pld = PLD(order=1).update(stamps, times=times)
+    residuals = stamps.sum(axis=(1, 2)) - pld.model(stamps, times)
+"""
+
+
+def design_matrix(stamps, times=None, order=0, t0=None):
+    """
+    Builds the PLD design matrix of a set of stamps in one go.
+
+    Parameters
+    ----------
+    stamps: numpy.array
+        Array of shape (n_frames, rows, columns) holding the pixels of the stamp of each frame.
+    times: numpy.array, optional
+        The timestamp of each frame. Required if 'order' > 0.
+    order: int, optional
+        The order of the polynomial in time added to the model, e.g. 1 for a linear ramp.
+        There is no constant term, as the normalized pixels always sum to one. Default is 0.
+    t0: float, optional
+        The time the polynomial is relative to. Default is None, which is the first time.
+
+    Returns
+    -------
+    numpy.array
+        Array of shape (n_frames, n_pixels + order), where the first n_pixels columns are the
+        pixels of each frame divided by the sum of the stamp, followed by (times - t0) ** k
+        for k = 1, ..., order.
+    """
+    stamps = np.asanyarray(stamps, dtype=np.float64)
+    pixels = stamps.reshape(len(stamps), -1)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        columns = [pixels / pixels.sum(axis=1)[:, np.newaxis]]
+
+    if order > 0:
+        if times is None:
+            raise RuntimeError("Times are needed for a polynomial in time of order {0}.".format(order))
+
+        times = np.asarray(times, dtype=np.float64)
+        dt = times - (times[0] if t0 is None else t0)
+
+        columns.append(dt[:, np.newaxis] ** np.arange(1, order + 1))
+
+    return np.hstack(columns)
+
+
+class PLD(object):
+    """
+    An incrementally updated PLD fit.
+
+    The least squares problem is solved using a QR decomposition, and only the triangular
+    factor R and Q^T y are kept. New frames are added by decomposing R stacked on top of
+    their design matrix, so the fit can be updated as new data comes in without refitting
+    all the previous frames, and the memory used does not grow with the number of frames.
+    """
+    def __init__(self, order=0, t0=None):
+        self.order = order          # Order of the polynomial in time
+        self.t0 = t0                # Time the polynomial is relative to, set by the first update if None
+        self.n_frames = 0           # Number of frames fitted
+
+        self._r = None              # Triangular factor of the QR decomposition of the design matrix
+        self._qty = None            # Q^T y
+        self._yty = 0.0             # y^T y, for the residual sum of squares
+
+    def update(self, stamps, flux=None, times=None, chunk_size=65536):
+        """
+        Adds frames to the fit. Frames with NaN pixels or flux are skipped.
+
+        Parameters
+        ----------
+        stamps: numpy.array
+            Array of shape (n_frames, rows, columns) holding the pixels of the stamp of each frame.
+        flux: numpy.array, optional
+            The light curve to fit. Default is None, which is the sum of each stamp.
+        times: numpy.array, optional
+            The timestamp of each frame. Required if the order of the polynomial is > 0.
+        chunk_size: int, optional
+            Maximum number of frames decomposed at once. Default is 65536.
+
+        Returns
+        -------
+        self
+        """
+        stamps = np.asanyarray(stamps, dtype=np.float64)
+
+        if flux is None:
+            flux = stamps.reshape(len(stamps), -1).sum(axis=1)
+
+        flux = np.asarray(flux, dtype=np.float64)
+
+        if self.t0 is None and times is not None and len(times) > 0:
+            self.t0 = float(times[0])
+
+        for chunk in frame_chunks(len(stamps), chunk_size):
+            x = design_matrix(stamps[chunk], None if times is None else times[chunk], self.order, self.t0)
+            y = flux[chunk]
+
+            valid = np.isfinite(x).all(axis=1) & np.isfinite(y)
+            x, y = x[valid], y[valid]
+
+            if self._r is None:
+                self._r = np.empty((0, x.shape[1]))
+                self._qty = np.empty(0)
+
+            # Decompose the previous R stacked on top of the new rows
+            q, self._r = np.linalg.qr(np.vstack([self._r, x]))
+            self._qty = np.dot(q.T, np.concatenate([self._qty, y]))
+
+            self._yty += np.dot(y, y)
+            self.n_frames += len(y)
+
+        return self
+
+    @property
+    def coeffs(self):
+        """
+        numpy.array
+            The fitted coefficients of the normalized pixels, followed by those of the
+            polynomial in time.
+        """
+        if self._r is None:
+            raise RuntimeError("No frames have been fitted.")
+
+        # Least squares, as R is singular if the pixels are degenerate. The cutoff of the small
+        # singular values is given explicitly, as rcond=None needs numpy >= 1.14.
+        rcond = np.finfo(np.float64).eps * max(self._r.shape)
+
+        return np.linalg.lstsq(self._r, self._qty, rcond=rcond)[0]
+
+    @property
+    def rss(self):
+        """ The residual sum of squares of the fit. """
+        return max(self._yty - np.dot(self._qty, self._qty), 0.0)
+
+    def model(self, stamps, times=None):
+        """
+        Evaluates the fitted model for a set of stamps.
+
+        Parameters
+        ----------
+        stamps: numpy.array
+            Array of shape (n_frames, rows, columns).
+        times: numpy.array, optional
+            The timestamp of each frame. Required if the order of the polynomial is > 0.
+
+        Returns
+        -------
+        numpy.array
+            The model of the light curve of each frame.
+        """
+        return np.dot(design_matrix(stamps, times, self.order, self.t0), self.coeffs)
+
+
+def pld_fit(stamps, flux=None, times=None, order=0, chunk_size=65536):
+    """
+    Fits a PLD model to a set of stamps. See PLD and PLD.update().
+
+    Returns
+    -------
+    PLD object
+        The fit, which can be updated further with new frames.
+    """
+    return PLD(order).update(stamps, flux, times, chunk_size)
@@ -1,9 +1,37 @@
+from functools import partial
+
 try:
-    from pypeira.io.common import read as _read
+    from pypeira.io.common import read as _read, iread as _iread
+    from pypeira.io.catalog import Catalog
+    from pypeira.io.cache import save_cache as _save_cache, load_cache as _load_cache, cache_valid as _cache_valid
+    from pypeira.core.header_table import HeaderTable
     import pypeira.core.brightness as brightness
+    from pypeira.core.stack import Stack
+    from pypeira.core.collection import HDUCollection
+    from pypeira.core.memo import Memo
+    from pypeira.core.profiler import Profiler, null_profiler
+    from pypeira.core.outliers import outlier_mask as _outlier_mask
+    from pypeira.core.binning import bin_frames as _bin_frames, bin_pixels as _bin_pixels
+    from pypeira.centroids.centroids import get_centroids as _get_centroids
+    from pypeira.background.background import get_background as _get_background
+    from pypeira.photometry.aperture import aperture_photometry as _aperture_photometry
+    from pypeira.photometry.pld import pld_fit as _pld_fit
 except ImportError:
-    from .io.common import read as _read
+    from .io.common import read as _read, iread as _iread
+    from .io.catalog import Catalog
+    from .io.cache import save_cache as _save_cache, load_cache as _load_cache, cache_valid as _cache_valid
+    from core.header_table import HeaderTable
     import core.brightness as brightness
+    from core.stack import Stack
+    from core.collection import HDUCollection
+    from core.memo import Memo
+    from core.profiler import Profiler, null_profiler
+    from core.outliers import outlier_mask as _outlier_mask
+    from core.binning import bin_frames as _bin_frames, bin_pixels as _bin_pixels
+    from centroids.centroids import get_centroids as _get_centroids
+    from background.background import get_background as _get_background
+    from photometry.aperture import aperture_photometry as _aperture_photometry
+    from photometry.pld import pld_fit as _pld_fit
 
 import matplotlib.pyplot as plt
 
@@ -52,7 +80,7 @@ class IRA(object):
         'CHNLNUM',              # Channel number used
         'FRAMTIME',             # Time spent integrating whole array
         'EXPTIME',              # Effective integration time per pixel
-        'EXPTYE',               # Exposure type
+        'EXPTYPE',              # Exposure type
         'BMJD_OBS',             # Solar System Barycenter Mod. Julian Date
         'FLUXCONV',             # Flux conversion factor (MJy/sr per DN/sec)
         'RONOISE',              # Readout Noise from array
@@ -62,7 +90,8 @@ class IRA(object):
         'ZEROPIX'               # If BADPIX is T, then this will give number of bad pixels
     ]
 
-    def __init__(self, header=None, header_kwds=None):
+    def __init__(self, header=None, header_kwds=None, memo_size=0, memo_path=None, memo_bytes=2 ** 30,
+                 profile=False, profile_callbacks=None):
         # See above comment for why this is almost empty. Will be populated in the future.
         self.header = header
 
@@ -71,6 +100,20 @@ class IRA(object):
         else:
             self.header_kwds = self._header_kwds_defaults
 
+        # Times the stages of read(), iread(), get_brightest() and pixel_data() if 'profile' is
+        # True, see pypeira.core.profiler. The callbacks are called with each measurement.
+        self.profiler = Profiler(profile_callbacks) if profile else null_profiler
+
+        # Calling these on the instance passes its profiler, while they stay static methods
+        # of the class, e.g. IRA.read(path)
+        if profile:
+            for name in ('read', 'iread', 'get_brightest', 'pixel_data'):
+                setattr(self, name, partial(getattr(IRA, name), profiler=self.profiler))
+
+        # Memoizes get_brightest_memo() and pixel_data_memo(), see pypeira.core.memo. Disabled
+        # unless a 'memo_size' above 0 or a 'memo_path' is given.
+        self.memo = Memo(memo_size, memo_path, memo_bytes, self.profiler)
+
     def read_header(self, path, inplace=False):
         """
 
@@ -98,6 +141,37 @@ class IRA(object):
 
         return headers
 
+    def catalog(self, root, path=None):
+        """
+        Creates a persistent header catalog of the files in 'root', storing the values
+        of the header keywords set on this instance. See pypeira.io.catalog.Catalog.
+
+        Parameters
+        ----------
+        root: str
+            The data directory to be indexed.
+        path: str, optional
+            Where to store the catalog. Default is a file in 'root'.
+
+        Returns
+        -------
+        Catalog object
+            Pass it to read() using the 'catalog' keyword to look up files in it.
+        """
+        return Catalog(root, self.header_kwds, path=path)
+
+    def header_table(self):
+        """
+        Creates an empty columnar header table storing the values of the header keywords
+        set on this instance. See pypeira.core.header_table.HeaderTable.
+
+        Returns
+        -------
+        HeaderTable object
+            Pass it to read() using the 'header_table' keyword to fill it while reading.
+        """
+        return HeaderTable(self.header_kwds)
+
     @staticmethod
     def read(path, ftype='fits', dtype=None, walk=True, headers_only=False, image_only=False, *args, **kwargs):
         """
@@ -132,7 +206,35 @@ class IRA(object):
             Set to True if you only want to read the headers of the files. If True, the data
             return will only be the headers of the files read. Default is False.
         image_only: bool, optional
-            Set to True if you only want to read the image data of the files. NOT IMPLEMENTED.
+            Set to True if you only want to read the image data of the files. If True, the data
+            returned will only be the image data of the files read. Default is False.
+
+        The following options can only be given as keywords.
+
+        workers: int, optional
+            If given, the files are read by a pool of 'workers' threads or processes. The order
+            of the returned data is the same as when read serially. Default is None.
+        executor: str, optional
+            Either 'thread' or 'process'. See io.common.read(). Default is 'thread'.
+        lazy: bool, optional
+            If True, the image data of each HDU is only read when it is first accessed,
+            see pypeira.core.hdu.HDU. Default is False.
+        catalog: Catalog object, optional
+            A header catalog, see catalog(). If given the files to read are looked up in it.
+        query: dict, optional
+            Conditions the files looked up in 'catalog' have to satisfy, see io.common.read().
+        companions: [str, ... ], optional
+            The data types of the products to read along with each file, e.g. ['bunc', 'bimsk'].
+            If given, Exposure objects are returned instead of HDU objects, see io.common.read().
+        header_table: HeaderTable object, optional
+            A header table, see header_table(). If given the header values of the files read are
+            stored in it instead of in each HDU.
+        compact: bool, optional
+            If True, lightweight CompactHDU objects are returned instead of HDU objects,
+            see pypeira.core.hdu.CompactHDU. Default is False.
+        profiler: Profiler object, optional
+            Times the stages of reading, see io.common.read(). Default is None, or the
+            profiler of the instance if profiling was enabled, see __init__().
         *args: optional
             Contains all arguments that will be passed onto the actual reader function, where the
             reader function used for each file type/extension is as specified above.
@@ -171,30 +273,138 @@ class IRA(object):
         OSError
             Raises OSError if the given path does not exist.
         """
-        return _read(
-            path,
-            ftype=ftype,
-            dtype=dtype,
-            walk=walk,
-            headers_only=headers_only,
-            image_only=image_only,
-            *args, **kwargs
-        )
+        # Passed on positionally, so that any positional 'args' follow 'image_only'
+        return _read(path, ftype, dtype, walk, headers_only, image_only, *args, **kwargs)
 
     @staticmethod
-    def get_brightest(hdus):
+    def iread(path, ftype='fits', dtype=None, walk=True, headers_only=False, image_only=False, *args, **kwargs):
+        """
+        Generator version of read(), yielding the data of each file as it is read instead
+        of returning a list. For docstring, see io.common.iread.
+        """
+        return _iread(path, ftype, dtype, walk, headers_only, image_only, *args, **kwargs)
+
+    def profile_report(self):
+        """
+        Returns
+        -------
+        dict
+            The time spent in each stage and the counters, see pypeira.core.profiler.Profiler.report().
+            Empty unless profiling was enabled, see __init__().
+        """
+        return self.profiler.report()
+
+    @staticmethod
+    def save(path, stack=None, header_table=None, sources=None, **arrays):
+        """ For docstring, see io.cache.save_cache. """
+        return _save_cache(path, stack, header_table, sources, **arrays)
+
+    @staticmethod
+    def load(path, mmap=True):
+        """ For docstring, see io.cache.load_cache. """
+        return _load_cache(path, mmap)
+
+    @staticmethod
+    def cache_valid(path, sources=None):
+        """ For docstring, see io.cache.cache_valid. """
+        return _cache_valid(path, sources)
+
+    @staticmethod
+    def get_brightest(hdus, batch_size=None, mask=None, profiler=None):
         """ For docstring, see core.brightness.get_brightest. """
-        return brightness.get_brightest(hdus)
+        return brightness.get_brightest(hdus, batch_size, mask, profiler)
+
+    def get_brightest_memo(self, hdus, batch_size=None, mask=None):
+        """
+        Memoized version of get_brightest(), see __init__() and pypeira.core.memo. Only use it
+        while the image data of the HDUs is not modified in memory, as that is not noticed.
+        """
+        # Only misses are timed, by get_brightest() itself, the lookups are counted by the memo
+        return self.memo.call('get_brightest', hdus, [mask],
+                              lambda: brightness.get_brightest(hdus, batch_size, mask, self.profiler))
 
     @staticmethod
-    def pixel_data(idx, hdus, zipped=False):
+    def stack(hdus, share=False):
+        """ For docstring, see core.stack.Stack.from_hdus. """
+        return Stack.from_hdus(hdus, share)
+
+    @staticmethod
+    def collection(hdus):
+        """ For docstring, see core.collection.HDUCollection. """
+        return HDUCollection(hdus)
+
+    @staticmethod
+    def outlier_mask(frames, window=15, nsigma=5):
+        """ For docstring, see core.outliers.outlier_mask. """
+        return _outlier_mask(frames, window, nsigma)
+
+    @staticmethod
+    def pixel_data(idx, hdus, zipped=False, profiler=None):
         """ For docstring, see core.brightness.pixel_data. """
         # Get data for a specific pixel
-        return brightness.pixel_data(idx, hdus, zipped)
+        return brightness.pixel_data(idx, hdus, zipped, profiler)
+
+    def pixel_data_memo(self, idx, hdus, zipped=False):
+        """
+        Memoized version of pixel_data(), see get_brightest_memo(). The arrays returned are
+        shared between calls, and so read-only.
+        """
+        # The arrays are memoized rather than the zip, which can only be iterated once
+        times, pix_vals = self.memo.call('pixel_data', hdus, [tuple(idx)],
+                                         lambda: brightness.pixel_data(idx, hdus, profiler=self.profiler))
+
+        if zipped:
+            return zip(times, pix_vals)
+        else:
+            return times, pix_vals
+
+    @staticmethod
+    def pixels_data(idxs, hdus):
+        """ For docstring, see core.brightness.pixels_data. """
+        return brightness.pixels_data(idxs, hdus)
+
+    @staticmethod
+    def stamp_data(center, size, hdus):
+        """ For docstring, see core.brightness.stamp_data. """
+        return brightness.stamp_data(center, size, hdus)
+
+    @staticmethod
+    def bin_frames(times, values, bin_size=64, method='mean', *args, **kwargs):
+        """ For docstring, see core.binning.bin_frames. """
+        return _bin_frames(times, values, bin_size, method, *args, **kwargs)
+
+    @staticmethod
+    def bin_pixels(hdus, idxs, bin_size=64, method='mean', *args, **kwargs):
+        """ For docstring, see core.binning.bin_pixels. """
+        return _bin_pixels(hdus, idxs, bin_size, method, *args, **kwargs)
+
+    @staticmethod
+    def get_centroids(frames, method='fwc', *args, **kwargs):
+        """ For docstring, see centroids.centroids.get_centroids. """
+        return _get_centroids(frames, method, *args, **kwargs)
+
+    @staticmethod
+    def get_background(frames, method='median', *args, **kwargs):
+        """ For docstring, see background.background.get_background. """
+        return _get_background(frames, method, *args, **kwargs)
+
+    @staticmethod
+    def aperture_photometry(frames, x, y, radii, *args, **kwargs):
+        """ For docstring, see photometry.aperture.aperture_photometry. """
+        return _aperture_photometry(frames, x, y, radii, *args, **kwargs)
+
+    @staticmethod
+    def pld(stamps, flux=None, times=None, order=0):
+        """ For docstring, see photometry.pld.pld_fit. """
+        return _pld_fit(stamps, flux, times, order)
 
     @staticmethod
     def plot_brightest(hdus):
         """ Simply calls the two methods above and plots the data returned. """
+        # Sort the HDUs once for both calls
+        if not isinstance(hdus, (Stack, HDUCollection)):
+            hdus = HDUCollection(hdus)
+
         idx, brightest = brightness.get_brightest(hdus)
 
         xs, ys = brightness.pixel_data(idx, hdus)
@@ -202,5 +412,20 @@ class IRA(object):
         plt.plot(xs, ys)
         plt.show()
 
+    def plot_brightest_memo(self, hdus):
+        """
+        Memoized version of plot_brightest(), using get_brightest_memo() and pixel_data_memo(),
+        so plotting the same HDUs again only draws the plot.
+        """
+        if not isinstance(hdus, (Stack, HDUCollection)):
+            hdus = HDUCollection(hdus)
+
+        idx, brightest = self.get_brightest_memo(hdus)
+
+        xs, ys = self.pixel_data_memo(idx, hdus)
+
+        plt.plot(xs, ys)
+        plt.show()
+
 
 
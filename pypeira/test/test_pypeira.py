@@ -1,19 +1,33 @@
 from __future__ import print_function
 
+import os
+import pickle
 import pytest
+import shutil
+import tempfile
 import unittest
 
 import fitsio
 import numpy as np
 
 from pypeira.pypeira import IRA
-from pypeira.core.hdu import HDU
+from pypeira.core.hdu import HDU, CompactHDU
+from pypeira.core.stack import Stack
+from pypeira.core.header_table import HeaderTable
+from pypeira.core.brightness import get_max
+from pypeira.core.time import frame_times
+from pypeira.core.binning import BinReducer
+from pypeira.core.outliers import bad_frames, hot_pixels, rolling_median
+from pypeira.background.background import bad_pixels
+from pypeira.photometry.aperture import aperture_weights, circle_overlap, _weights_cache
+from pypeira.photometry.pld import PLD, design_matrix
+from pypeira.io.fits import open_fits, read_fits
 
 
 class HDUtest(unittest.TestCase):
     def setUp(self):
         self.ira = IRA()
-        self.path = "data/test_imgs/ch2/bcd/SPITZER_I2_46467840_0000_0000_2_bcd.fits"
+        self.path = "data/test_imgs/ch2/bcd/SPITZER_I2_46466816_0000_0000_2_bcd.fits"
         self.hdu = HDU(self.path, ftype='fits', dtype='bcd')
 
     def test_header(self):
@@ -24,6 +38,15 @@ class HDUtest(unittest.TestCase):
         self.assertEqual(myhdr['NAXIS3'], hdr['NAXIS3'])
         self.assertEqual(myhdr['BITPIX'], hdr['BITPIX'])
 
+    def test_filename(self):
+        self.assertEqual((self.hdu.channel, self.hdu.aorkey, self.hdu.expid, self.hdu.dce),
+                         (2, 46466816, 0, 0))
+
+        # Not read at all, as the file name does not match the given data type
+        hdu = HDU(self.path, ftype='fits', dtype='bimsk')
+        self.assertIsNone(hdu.hdr)
+        self.assertFalse(hdu.has_data)
+
     def test_image(self):
         myimg = self.hdu.img
         img = fitsio.read(self.path)
@@ -34,7 +57,7 @@ class HDUtest(unittest.TestCase):
 class ReaderTest(unittest.TestCase):
     def setUp(self):
         self.ira = IRA()
-        self.path = "data/test_imgs/ch2/bcd/SPITZER_I2_46467840_0002_0000_2_bcd.fits"
+        self.path = "data/test_imgs/ch2/bcd/SPITZER_I2_46466816_0002_0000_2_bcd.fits"
 
     def test_reader(self):
         hdu = self.ira.read(self.path, data_type='bcd')
@@ -46,14 +69,798 @@ class ReaderTest(unittest.TestCase):
         self.assertEqual(hdu.img.any(), hdu_no_dtype.img.any())
         self.assertEqual(hdu.hdr['NAXIS'], hdu_no_dtype.hdr['NAXIS'])
 
+    def test_underscore_dir(self):
+        # Only the name of the file decides its data type, not the directories in its path
+        tmp_dir = tempfile.mkdtemp()
+
+        try:
+            for path in [os.path.join(tmp_dir, 'dir_x', 'bcd.fits'), os.path.join(tmp_dir, 'x_bcd', 'a.fits')]:
+                os.mkdir(os.path.dirname(path))
+                shutil.copy(self.path, path)
+
+            hdus = self.ira.read(tmp_dir, dtype='bcd')
+
+            self.assertEqual([hdu.filename for hdu in hdus], ['bcd.fits'])
+            self.assertIsNotNone(hdus[0].hdr)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_read_fits_handle(self):
+        hdr, img = read_fits(self.path)
+
+        with open_fits(self.path) as fits:
+            handle_img = read_fits(self.path, image_only=True, fits=fits, ext=0)
+            handle_hdr = read_fits(self.path, headers_only=True, fits=fits, ext=0)
+
+        self.assertEqual(hdr['BMJD_OBS'], handle_hdr['BMJD_OBS'])
+        np.testing.assert_array_equal(img, fitsio.read(self.path))
+        np.testing.assert_array_equal(img, handle_img)
+
+    def test_mmap(self):
+        hdu = self.ira.read(self.path, dtype='bcd', mmap=True)
+
+        self.assertIsInstance(hdu.img, np.memmap)
+        self.assertFalse(hdu.img.flags.writeable)
+        self.assertEqual(hdu.img.dtype, np.dtype('>f4'))
+        np.testing.assert_array_equal(hdu.img, fitsio.read(self.path))
+
+    def test_mmap_has_data(self):
+        # Decided from the header, without reading the mapped pages, here all zeros
+        hdu = self.ira.read(self.path, dtype='bcd', mmap=True)
+
+        with tempfile.NamedTemporaryFile() as f:
+            f.write(b'\0' * hdu.img.nbytes)
+            f.flush()
+
+            hdu._image = np.memmap(f.name, dtype=hdu.img.dtype, mode='r', shape=hdu.img.shape)
+
+            self.assertTrue(hdu.has_data)
+
 
 class BrightnessTest(unittest.TestCase):
     def setUp(self):
         self.ira = IRA()
-        self.path = "data/test_imgs/ch2/bcd/SPITZER_I2_46467840_0004_0000_2_bcd.fits"
+        self.path = "data/test_imgs/ch2/bcd/SPITZER_I2_46466816_0004_0000_2_bcd.fits"
 
     def test_get_max(self):
         hdu = self.ira.read(self.path)
         fits_img = fitsio.read(self.path)
 
         self.assertAlmostEqual(hdu.get_max()[1], np.nanmax(fits_img), 5)
+
+    def test_get_max_nan(self):
+        data = np.array([[np.nan, 1.0], [3.0, np.nan]])
+
+        self.assertEqual(get_max(data), ((1, 0), 3.0))
+        self.assertEqual(get_max(np.full((2, 2), np.nan)), (0, 0))
+
+    def test_get_brightest_batch(self):
+        hdus = self.ira.read("data/test_imgs/ch2/bcd", dtype='bcd')
+
+        idx, max_val = self.ira.get_brightest(hdus)
+        batch_idx, batch_max_val = self.ira.get_brightest(hdus, batch_size=4)
+
+        self.assertEqual(idx, batch_idx)
+        self.assertEqual(max_val, batch_max_val)
+        self.assertAlmostEqual(max_val, max(np.nanmax(hdu.img) for hdu in hdus), 5)
+
+    def test_get_brightest_mask(self):
+        # The mask is used for HDUs as well as for a Stack
+        hdus = self.ira.collection(self.ira.read("data/test_imgs/ch2/bcd", dtype='bcd'))
+        frames = hdus.stack.frames
+        idx, max_val = self.ira.get_brightest(hdus)
+
+        mask = frames == max_val
+        expected = self.ira.get_brightest(hdus.stack, mask=mask)[1]
+
+        self.assertLess(expected, max_val)
+        self.assertEqual(self.ira.get_brightest(hdus, mask=mask)[1], expected)
+        self.assertEqual(self.ira.get_brightest(list(hdus), batch_size=4, mask=mask)[1], expected)
+
+        # A mask of a single frame applies to all of them
+        pixel = np.zeros(frames.shape[1:], dtype=np.bool_)
+        pixel[idx[1:]] = True
+        self.assertEqual(self.ira.get_brightest(hdus, mask=pixel)[1],
+                         self.ira.get_brightest(hdus.stack, mask=pixel)[1])
+
+        self.assertEqual(self.ira.get_brightest(hdus, mask=np.ones(frames.shape, dtype=np.bool_)), (0, 0))
+        self.assertRaises(RuntimeError, self.ira.get_brightest, hdus, mask=mask[1:])
+
+
+class StackTest(unittest.TestCase):
+    def setUp(self):
+        self.ira = IRA()
+        self.hdus = self.ira.read("data/test_imgs/ch2/bcd", dtype='bcd')
+
+    def test_pixel_data(self):
+        stack = self.ira.stack(self.hdus)
+        times, pix_vals = self.ira.pixel_data((0, 15, 15), list(self.hdus))
+        stack_times, stack_vals = self.ira.pixel_data((15, 15), stack)
+
+        self.assertEqual(stack.shape, (64 * len(self.hdus), 32, 32))
+        self.assertTrue(np.all(np.diff(stack_times) > 0))
+        np.testing.assert_allclose(stack_times, times)
+        np.testing.assert_array_equal(stack_vals, pix_vals)
+
+    def test_pixel_data_copy(self):
+        # Same dtype as for HDUs, and never a view into the image data shared with the HDUs
+        stack = self.ira.stack(self.hdus, share=True)
+        times, pix_vals = self.ira.pixel_data((15, 15), stack)
+        times, pixels_vals = self.ira.pixels_data([(15, 15), (16, 16)], stack)
+
+        self.assertEqual((pix_vals.dtype, pixels_vals.dtype), (np.float64, np.float64))
+        self.assertFalse(np.may_share_memory(pix_vals, stack.frames))
+
+    def test_frame_times(self):
+        hdu = self.hdus[3]
+        times = frame_times(self.hdus).reshape(len(self.hdus), 64)
+
+        increment = (hdu.integ_end - hdu.integ_start) / 64 / (3600 * 24)
+        expected = [hdu.timestamp + increment * i for i in range(64)]
+
+        np.testing.assert_allclose(times[3], expected, rtol=0, atol=1e-9)
+
+
+class CollectionTest(unittest.TestCase):
+    def setUp(self):
+        self.ira = IRA()
+        self.hdus = self.ira.read("data/test_imgs/ch2/bcd", dtype='bcd')[::-1]
+
+    def test_pixel_data(self):
+        paths = [hdu.path for hdu in self.hdus]
+        collection = self.ira.collection(self.hdus)
+
+        times, pix_vals = self.ira.pixel_data((15, 15), self.hdus)
+
+        # The given list is not sorted in place
+        self.assertEqual([hdu.path for hdu in self.hdus], paths)
+        self.assertTrue(np.all(np.diff(times) > 0))
+        np.testing.assert_array_equal(self.ira.pixel_data((15, 15), collection)[1], pix_vals)
+
+        # Collections can be used in place of frames
+        self.assertEqual(self.ira.get_background(collection).shape, (64 * 11, ))
+        np.testing.assert_array_equal(self.ira.pixel_data((15, 15), collection)[1], pix_vals)
+
+    def test_pixels_data(self):
+        idxs = [(15, 15), (0, 3, 4), (31, 0)]
+        times, pix_vals = self.ira.pixels_data(idxs, self.hdus)
+
+        self.assertEqual(pix_vals.shape, (64 * 11, 3))
+        np.testing.assert_array_equal(pix_vals[:, 1], self.ira.pixel_data((3, 4), self.hdus)[1])
+        np.testing.assert_array_equal(self.ira.pixels_data(idxs, self.ira.stack(self.hdus))[1], pix_vals)
+
+        stack_times, stamps = self.ira.stamp_data((15, 16), 5, self.ira.stack(self.hdus))
+        np.testing.assert_array_equal(stack_times, times)
+        np.testing.assert_array_equal(stamps, self.ira.stack(self.hdus).aperture((13, 18), (14, 19))[1])
+
+        self.assertRaises(RuntimeError, self.ira.stamp_data, (1, 15), 5, self.hdus)
+
+    def test_consistent(self):
+        collection = self.ira.collection(self.hdus)
+        times, pix_vals = collection.pixel((15, 15))
+        pixels = collection.pixels([(15, 15)])[1]
+
+        # The same whether or not the Stack has been created
+        collection.stack
+
+        for before, after in ((pix_vals, collection.pixel((15, 15))[1]), (pixels, collection.pixels([(15, 15)])[1])):
+            self.assertEqual((before.dtype, after.dtype), (np.float64, np.float64))
+            self.assertFalse(np.shares_memory(after, collection.stack.frames))
+            np.testing.assert_array_equal(before, after)
+
+        self.assertFalse(times.flags.writeable)
+
+    def test_between(self):
+        collection = self.ira.collection(self.hdus)
+        timestamps = sorted(hdu.timestamp for hdu in self.hdus)
+
+        self.assertEqual(len(collection.between(timestamps[2], timestamps[5])), 4)
+        self.assertEqual(len(collection.between(t1=timestamps[0])), 1)
+        self.assertEqual(collection.between(timestamps[3]).start, timestamps[3])
+        self.assertEqual(len(collection.between(timestamps[-1] + 1)), 0)
+
+
+class ParallelReaderTest(unittest.TestCase):
+    def setUp(self):
+        self.ira = IRA()
+        self.path = "data/test_imgs/ch2/bcd"
+
+    def test_workers(self):
+        hdus = self.ira.read(self.path, dtype='bcd')
+
+        for executor in ('thread', 'process'):
+            pool_hdus = self.ira.read(self.path, dtype='bcd', workers=2, executor=executor)
+
+            self.assertEqual([hdu.path for hdu in hdus], [hdu.path for hdu in pool_hdus])
+            np.testing.assert_array_equal(hdus[-1].img, pool_hdus[-1].img)
+
+    def test_headers_only(self):
+        hdrs = self.ira.read(self.path, dtype='bcd', headers_only=True, workers=2)
+
+        self.assertEqual(len(hdrs), 11)
+        self.assertEqual(hdrs[0]['NAXIS3'], 64)
+
+    def test_iread(self):
+        paths = [hdu.path for hdu in self.ira.read(self.path, dtype='bcd', lazy=True)]
+
+        self.assertEqual([hdu.path for hdu in self.ira.iread(self.path, dtype='bcd')], paths)
+        self.assertEqual([hdu.path for hdu in self.ira.iread(self.path, dtype='bcd', prefetch=2)], paths)
+
+        images = self.ira.iread(self.path, dtype='bcd', image_only=True, workers=2)
+        np.testing.assert_array_equal(next(images), fitsio.read(paths[0]))
+        images.close()
+
+
+class LazyHDUTest(unittest.TestCase):
+    def setUp(self):
+        self.path = "data/test_imgs/ch2/bcd/SPITZER_I2_46466816_0001_0000_2_bcd.fits"
+
+    def test_lazy(self):
+        hdu = HDU(self.path, ftype='fits', dtype='bcd', lazy=True)
+
+        self.assertFalse(hdu.is_loaded)
+        self.assertTrue(hdu.has_data)
+        self.assertEqual(hdu.timestamp, fitsio.read_header(self.path)['BMJD_OBS'])
+
+        np.testing.assert_array_equal(hdu.img, fitsio.read(self.path))
+        self.assertTrue(hdu.is_loaded)
+
+        hdu.release()
+        self.assertFalse(hdu.is_loaded)
+        self.assertEqual(hdu.pixel_values((15, 15)).shape, (64, ))
+
+
+class CompactHDUTest(unittest.TestCase):
+    def setUp(self):
+        self.ira = IRA()
+        self.path = "data/test_imgs/ch2/bcd"
+
+    def test_compact(self):
+        hdus = self.ira.read(self.path, dtype='bcd')
+        compact = self.ira.read(self.path, dtype='bcd', compact=True, workers=2, executor='process')
+
+        self.assertFalse(hasattr(compact[0], '__dict__'))
+        self.assertEqual(compact[0].ndims, (64, 32, 32))
+        self.assertEqual(compact[0].filename, hdus[0].filename)
+        self.assertEqual(compact[0].get_max(), hdus[0].get_max())
+        np.testing.assert_array_equal(self.ira.stack(compact).frames, self.ira.stack(hdus).frames)
+
+        self.assertEqual(CompactHDU.from_hdu(hdus[1]).ndims, (64, 32, 32))
+
+    def test_share(self):
+        hdus = self.ira.read(self.path, dtype='bcd', compact=True)
+        stack = self.ira.stack(hdus, share=True)
+
+        for hdu in hdus:
+            self.assertTrue(np.shares_memory(hdu.img, stack.frames))
+
+
+class ExposureTest(unittest.TestCase):
+    def setUp(self):
+        self.ira = IRA()
+        self.path = "data/test_imgs/ch2/bcd"
+        self.mask_path = "data/test_imgs/ch2/bcd/SPITZER_I2_46466816_0000_0000_2_bimsk.fits"
+
+    def test_companions(self):
+        exposures = self.ira.read(self.path, dtype='bcd', companions=['bunc', 'bimsk', 'none'], workers=2)
+
+        self.assertEqual(len(exposures), 11)
+        self.assertEqual(sorted(exposures[0].companions), ['bimsk', 'bunc'])
+        self.assertEqual(exposures[0].unc.shape, exposures[0].img.shape)
+        np.testing.assert_array_equal(exposures[0].mask, fitsio.read(self.mask_path))
+
+        # Exposures can be used in place of HDUs
+        self.assertEqual(len(self.ira.stack(exposures)), 11 * 64)
+
+    def test_pickle(self):
+        # Exposures sent back from the workers of a process pool keep the HDU and companions
+        exposures = self.ira.read(self.path, dtype='bcd', companions=['bunc', 'bimsk'], workers=2,
+                                  executor='process')
+        serial = self.ira.read(self.path, dtype='bcd', companions=['bunc', 'bimsk'])
+
+        self.assertEqual(len(exposures), len(serial))
+
+        for exposure, expected in zip(exposures, serial):
+            self.assertEqual(exposure.filename, expected.filename)
+            self.assertEqual(sorted(exposure.companions), ['bimsk', 'bunc'])
+            np.testing.assert_array_equal(exposure.unc, expected.unc)
+
+        exposure = pickle.loads(pickle.dumps(serial[0]))
+        self.assertEqual(exposure.timestamp, serial[0].timestamp)
+        np.testing.assert_array_equal(exposure.mask, serial[0].mask)
+
+        # Special methods are not looked up on the HDU, which has a __getstate__() of its own
+        self.assertRaises(AttributeError, exposure.__getattr__, '__getstate__')
+        self.assertEqual(exposure.__getattr__('timestamp'), exposure.hdu.timestamp)
+
+    def test_masked(self):
+        exposure = self.ira.read(self.path, dtype='bcd', companions=['bimsk'])[0]
+        bad = exposure.mask != 0
+
+        masked = exposure.masked()
+        self.assertTrue(np.shares_memory(masked.data, exposure.img))
+        np.testing.assert_array_equal(masked.mask, bad)
+
+        original = exposure.img.copy()
+
+        filled = exposure.nan_filled()
+        self.assertIsNot(filled, exposure.img)
+        self.assertTrue(np.isnan(filled[bad]).all())
+        np.testing.assert_array_equal(exposure.img, original)
+
+        filled = exposure.nan_filled(inplace=True)
+        self.assertIs(filled, exposure.img)
+        self.assertTrue(np.isnan(filled[bad]).all())
+
+        # Integer image data can not hold NaN
+        exposure.hdu.share_image(exposure.mask)
+        self.assertRaises(RuntimeError, exposure.nan_filled)
+
+    def test_mmap(self):
+        exposure = self.ira.read(self.path, dtype='bcd', companions=['bimsk'], mmap=True)[0]
+
+        filled = exposure.nan_filled(bits=exposure.mask.max())
+        self.assertIsNot(filled, exposure.img)
+        self.assertEqual(np.isnan(filled).sum(), np.count_nonzero(exposure.mask & exposure.mask.max()))
+
+        self.assertRaises(RuntimeError, exposure.nan_filled, inplace=True)
+
+
+class HeaderTableTest(unittest.TestCase):
+    def setUp(self):
+        self.ira = IRA()
+        self.path = "data/test_imgs/ch2/bcd"
+
+    def test_read(self):
+        table = self.ira.header_table()
+        hdus = self.ira.read(self.path, dtype='bcd', header_table=table, lazy=True, workers=2)
+
+        self.assertEqual(len(table), 11)
+        self.assertIsNone(hdus[3]._header)
+        self.assertEqual(hdus[3].hdr['BMJD_OBS'], hdus[3].timestamp)
+        self.assertEqual(table['NAXIS3'].dtype, np.int64)
+        self.assertEqual(hdus[3].img.shape, (64, 32, 32))
+
+        np.testing.assert_array_equal(table.frame_times(table.argsort()), frame_times(hdus))
+
+    def test_select(self):
+        table = self.ira.header_table()
+        hdrs = self.ira.read(self.path, dtype='bcd', headers_only=True, header_table=table)
+
+        times = table['BMJD_OBS']
+        rows = table.select(EXPTYPE=hdrs[0]['EXPTYPE'], BMJD_OBS=(times[2], None))
+
+        self.assertEqual(list(rows), list(np.flatnonzero(times >= times[2])))
+        self.assertTrue(np.isnan(table['BADPIX']).all())
+
+    def test_columns(self):
+        table = HeaderTable(['EXPID', 'EXPTYPE'])
+
+        for i in range(100):
+            table.append({'NAXIS3': 64, 'EXPID': i if i != 70 else None, 'EXPTYPE': 'sci', 'BMJD_OBS': 5e4 + i})
+
+        # Integers are promoted to floats once a value is missing
+        self.assertEqual(len(table), 100)
+        self.assertEqual(table['NAXIS3'].dtype, np.int64)
+        self.assertEqual(table['EXPID'].dtype, np.float64)
+        self.assertTrue(np.isnan(table['EXPID'][70]))
+        self.assertEqual(list(table.select(EXPTYPE='sci')), list(range(100)))
+        self.assertFalse(table['BMJD_OBS'].flags.writeable)
+
+        row = table.row(69)
+        self.assertEqual((row['EXPID'], row.get('EXPTYPE'), table.row(70)['EXPID']), (69, 'sci', None))
+        self.assertIsInstance(row['NAXIS3'], int)
+        self.assertRaises(KeyError, row.__getitem__, 'FLUXCONV')
+
+
+class CacheTest(unittest.TestCase):
+    def setUp(self):
+        self.ira = IRA()
+        self.path = "data/test_imgs/ch2/bcd"
+        self.tmp_dir = tempfile.mkdtemp()
+        self.cache = os.path.join(self.tmp_dir, 'cache')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_save_load(self):
+        table = self.ira.header_table()
+        exposures = self.ira.read(self.path, dtype='bcd', companions=['bimsk'], header_table=table)
+        stack = self.ira.stack(exposures)
+        mask = np.concatenate([exposure.mask for exposure in exposures])
+        sources = [exposure.path for exposure in exposures]
+
+        self.assertFalse(self.ira.cache_valid(self.cache, sources))
+        self.ira.save(self.cache, stack, table, sources=sources, mask=mask, flux=stack.frames.sum(axis=(1, 2)))
+        self.assertTrue(self.ira.cache_valid(self.cache, sources))
+        self.assertFalse(self.ira.cache_valid(self.cache, sources[1:]))
+
+        cache = self.ira.load(self.cache)
+
+        self.assertIsInstance(cache.stack.frames, np.memmap)
+        np.testing.assert_array_equal(cache.stack.frames, stack.frames)
+        np.testing.assert_array_equal(cache.stack.times, stack.times)
+        np.testing.assert_array_equal(cache['mask'], mask)
+        np.testing.assert_array_equal(cache.header_table.frame_times(), table.frame_times())
+        self.assertEqual(cache.header_table.row(3), table.row(3))
+
+
+class MemoTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.ira = IRA(memo_size=2, memo_path=os.path.join(self.tmp_dir, 'memo'))
+        self.hdus = self.ira.read("data/test_imgs/ch2/bcd", dtype='bcd')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_memo(self):
+        idx, max_val = self.ira.get_brightest_memo(self.hdus)
+        times, pix_vals = self.ira.pixel_data_memo(idx, self.hdus)
+
+        self.assertEqual(self.ira.get_brightest_memo(self.hdus), (idx, max_val))
+        self.assertIs(self.ira.pixel_data_memo(idx, self.hdus)[1], pix_vals)
+        self.assertEqual((self.ira.memo.hits, self.ira.memo.misses), (2, 2))
+
+        # The shared results can not be modified by the caller
+        with self.assertRaises(ValueError):
+            pix_vals -= 100
+
+        # Not memoized unless enabled
+        self.assertIsNot(IRA().pixel_data_memo(idx, self.hdus)[1], IRA().pixel_data_memo(idx, self.hdus)[1])
+
+        # Other parameters are not served the same result
+        self.assertIsNot(self.ira.pixel_data_memo((1, 2, 3), self.hdus)[1], pix_vals)
+
+        # The disk tier is shared by other instances using the same directory
+        ira = IRA(memo_path=self.ira.memo.path)
+        np.testing.assert_array_equal(ira.pixel_data_memo(idx, self.hdus)[1], pix_vals)
+        self.assertEqual(ira.memo.hits, 1)
+
+    def test_eviction(self):
+        self.ira.memo.max_bytes = 1
+
+        for i in range(3):
+            self.ira.pixel_data_memo((0, i, i), self.hdus)
+
+        self.assertEqual(len(self.ira.memo._entries), 2)
+        self.assertLessEqual(len(os.listdir(self.ira.memo.path)), 1)
+
+
+    def test_plot(self):
+        # The second plot of the same HDUs looks up both results
+        ira = IRA(memo_size=2, profile=True)
+
+        for i in range(2):
+            ira.plot_brightest_memo(self.hdus)
+
+        counters = ira.profile_report()['counters']
+        self.assertEqual((counters['cache_hits'], counters['cache_misses']), (2, 2))
+
+
+class ProfilerTest(unittest.TestCase):
+    def setUp(self):
+        self.calls = list()
+        self.ira = IRA(memo_size=2, profile=True, profile_callbacks=[lambda *call: self.calls.append(call)])
+        self.path = "data/test_imgs/ch2/bcd"
+
+    def test_read(self):
+        hdus = self.ira.read(self.path, dtype='bcd', workers=2)
+        report = self.ira.profile_report()
+
+        self.assertEqual(set(report['stages']), {'walk', 'filter', 'read', 'read_header', 'read_image', 'has_data'})
+        self.assertEqual(report['stages']['read']['calls'], len(hdus))
+        self.assertEqual(report['stages']['read_header']['calls'], len(hdus))
+        self.assertEqual(report['stages']['has_data']['calls'], len(hdus))
+        self.assertEqual(report['counters']['files_read'], len(hdus))
+        self.assertEqual(report['counters']['files_seen'],
+                         report['counters']['files_read'] + report['counters']['files_skipped'])
+        self.assertEqual(report['counters']['bytes_read'], sum(hdu.img.nbytes for hdu in hdus))
+        self.assertIn(('count', 'files_read', 1), self.calls)
+
+        # Lazy HDUs have not read any image data yet, which is timed once they do
+        self.ira.profiler.reset()
+        hdus = self.ira.read(self.path, dtype='bcd', lazy=True)
+        self.assertEqual(self.ira.profile_report()['counters']['bytes_read'], 0)
+        self.assertNotIn('read_image', self.ira.profile_report()['stages'])
+
+        hdus[0].img
+        self.assertEqual(self.ira.profile_report()['stages']['read_image']['calls'], 1)
+
+    def test_read_processes(self):
+        # The timings of the workers are merged into the profiler of the caller
+        hdus = self.ira.read(self.path, dtype='bcd', workers=2, executor='process')
+        report = self.ira.profile_report()
+
+        self.assertEqual(report['stages']['read_header']['calls'], len(hdus))
+        self.assertEqual(report['stages']['read_image']['calls'], len(hdus))
+        self.assertIn(('stage', 'has_data'), [call[:2] for call in self.calls])
+        self.assertTrue(all(hdu.profiler is self.ira.profiler for hdu in hdus))
+
+    def test_brightest(self):
+        hdus = self.ira.read(self.path, dtype='bcd')
+        self.ira.get_brightest(hdus)
+        self.ira.pixel_data((0, 15, 15), hdus)
+        report = self.ira.profile_report()
+
+        self.assertEqual(report['stages']['get_brightest']['calls'], 1)
+        self.assertEqual(report['stages']['get_max']['calls'], len(hdus))
+        self.assertEqual(report['stages']['pixel_data']['calls'], 1)
+        self.assertEqual(report['stages']['sort']['calls'], 1)
+
+    def test_static(self):
+        # Still static methods of the class, which are not profiled
+        hdus = IRA.read(self.path, dtype='bcd')
+
+        self.assertEqual(IRA.get_brightest(hdus), self.ira.get_brightest(hdus))
+        self.assertEqual(self.ira.profile_report()['stages']['get_brightest']['calls'], 1)
+
+    def test_memo(self):
+        hdus = self.ira.read(self.path, dtype='bcd')
+
+        for i in range(2):
+            self.ira.get_brightest_memo(hdus)
+
+        report = self.ira.profile_report()
+
+        # Only the miss runs, and times, get_brightest()
+        self.assertEqual(report['stages']['get_brightest']['calls'], 1)
+        self.assertEqual((report['counters']['cache_hits'], report['counters']['cache_misses']), (1, 1))
+
+    def test_disabled(self):
+        ira = IRA()
+        ira.read(self.path, dtype='bcd')
+
+        self.assertEqual(ira.profile_report(), {'stages': {}, 'counters': {}})
+
+
+class CatalogTest(unittest.TestCase):
+    def setUp(self):
+        self.ira = IRA()
+        self.path = "data/test_imgs/ch2/bcd"
+        self.tmp_dir = tempfile.mkdtemp()
+        self.catalog = self.ira.catalog(self.path, path=os.path.join(self.tmp_dir, 'catalog.sqlite'))
+
+    def tearDown(self):
+        self.catalog.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_update(self):
+        self.assertEqual(self.catalog.update(), 77)
+        self.assertEqual(self.catalog.update(), 0)
+
+    def test_query(self):
+        hdus = self.ira.read(self.path, dtype='bcd')
+        times = sorted(hdu.timestamp for hdu in hdus)
+
+        cat_hdus = self.ira.read(self.path, dtype='bcd', catalog=self.catalog,
+                                 query={'CHNLNUM': 2, 'BMJD_OBS': (times[2], times[5])})
+
+        self.assertEqual([hdu.timestamp for hdu in cat_hdus], times[2:6])
+        self.assertEqual(len(self.catalog.query(dtype='bimsk')), 11)
+
+    def test_subdirectory(self):
+        # Reading a sub-directory of the root without walking neither misses its files,
+        # nor removes the rows of the rest of the catalog
+        catalog = self.ira.catalog(os.path.dirname(self.path), path=os.path.join(self.tmp_dir, 'sub.sqlite'))
+        self.assertEqual(catalog.update(), 77)
+
+        hdus = self.ira.read(self.path, dtype='bcd', walk=False, catalog=catalog)
+        self.assertEqual(len(hdus), len(self.ira.read(self.path, dtype='bcd', walk=False)))
+        self.assertEqual(len(self.ira.read(os.path.dirname(self.path), walk=False, catalog=catalog)), 0)
+
+        self.assertEqual(len(catalog.query()), 77)
+        self.assertEqual(catalog.update(), 0)
+
+        catalog.close()
+
+
+class BinningTest(unittest.TestCase):
+    def setUp(self):
+        self.ira = IRA()
+        self.path = "data/test_imgs/ch2/bcd"
+
+        rng = np.random.RandomState(0)
+        self.times = np.arange(100.0)
+        self.flux = 10 + rng.normal(0, 1, 100)
+
+    def test_methods(self):
+        times, flux, errors = self.ira.bin_frames(self.times, self.flux, 10)
+        means = self.flux.reshape(10, 10).mean(axis=1)
+
+        self.assertEqual(flux.shape, (10, ))
+        np.testing.assert_allclose(times, self.times.reshape(10, 10).mean(axis=1))
+        np.testing.assert_allclose(flux, means)
+
+        # A single outlier in the first bin is clipped
+        _, clipped, _ = self.ira.bin_frames(self.times, np.where(self.times == 5, 100, self.flux), 10, 'clipped')
+        np.testing.assert_allclose(clipped[1:], means[1:])
+        self.assertLess(abs(clipped[0] - 10), 1)
+
+        _, weighted, weighted_errors = self.ira.bin_frames(self.times, self.flux, 10, 'weighted',
+                                                           errors=np.full(100, 2.0))
+        np.testing.assert_allclose(weighted, means)
+        np.testing.assert_allclose(weighted_errors, 2 / np.sqrt(10))
+
+    def test_reducer(self):
+        reducer = BinReducer(bin_size=8, method='median')
+
+        for i in range(0, 100, 7):
+            reducer.update(self.times[i:i + 7], self.flux[i:i + 7])
+
+        for expected, result in zip(self.ira.bin_frames(self.times, self.flux, 8, 'median'), reducer.result()):
+            np.testing.assert_allclose(result, expected)
+
+        # Frames with and without errors can not be mixed
+        reducer = BinReducer(bin_size=8).update(self.times[:4], self.flux[:4])
+        self.assertRaises(RuntimeError, reducer.update, self.times[4:8], self.flux[4:8], np.ones(4))
+
+        reducer = BinReducer(bin_size=8).update(self.times[:4], self.flux[:4], np.ones(4))
+        self.assertRaises(RuntimeError, reducer.update, self.times[4:8], self.flux[4:8])
+
+        # Frames out of time order, within or across updates, are not binned together
+        reducer = BinReducer(bin_size=8).update(self.times[4:8], self.flux[4:8])
+        self.assertRaises(RuntimeError, reducer.update, self.times[:4], self.flux[:4])
+        self.assertRaises(RuntimeError, BinReducer().update, self.times[::-1], self.flux)
+
+    def test_bin_pixels(self):
+        idxs = [(15, 15), (16, 16)]
+        hdus = self.ira.read(self.path, dtype='bcd')
+
+        streamed = self.ira.bin_pixels(self.ira.iread(self.path, dtype='bcd'), idxs, 32)
+        times, pix_vals = self.ira.pixels_data(idxs, hdus)
+
+        for expected, result in zip(self.ira.bin_frames(times, pix_vals, 32), streamed):
+            np.testing.assert_allclose(result, expected)
+
+        exposures = self.ira.iread(self.path, dtype='bcd', companions=['bunc'])
+        times, flux, errors = self.ira.bin_pixels(exposures, idxs, 64, 'weighted')
+        self.assertEqual(flux.shape, (11, 2))
+
+        # HDUs out of time order
+        self.assertRaises(RuntimeError, self.ira.bin_pixels, list(self.ira.collection(hdus))[::-1], idxs, 32)
+
+
+class CentroidTest(unittest.TestCase):
+    def setUp(self):
+        self.ira = IRA()
+
+        # Gaussians with known centers on a constant background
+        rng = np.random.RandomState(0)
+        ys, xs = np.mgrid[0:32, 0:32]
+
+        self.x = 15.3 + rng.normal(0, 0.1, 50)
+        self.y = 16.2 + rng.normal(0, 0.1, 50)
+        self.frames = 100 * np.exp(-0.5 * (((xs - self.x[:, None, None]) / 1.1) ** 2 +
+                                           ((ys - self.y[:, None, None]) / 0.9) ** 2)) + 5
+        self.frames[0, 13, 12] = np.nan
+
+    def test_methods(self):
+        for method in ('fwc', 'gaussian_2d', 'gaussian_1d'):
+            x, y, width = self.ira.get_centroids(self.frames, method)
+
+            tol = 0.05 if method == 'fwc' else 1e-3
+
+            self.assertEqual(width.shape, (50, 2))
+            np.testing.assert_allclose(x, self.x, atol=tol)
+            np.testing.assert_allclose(y, self.y, atol=tol)
+
+        np.testing.assert_allclose(width.mean(axis=0), [1.1, 0.9], atol=1e-3)
+
+
+class BackgroundTest(unittest.TestCase):
+    def setUp(self):
+        self.ira = IRA()
+
+        # Constant background with a bright source in the center and a few hot pixels
+        self.bkg = np.arange(1, 11, dtype=np.float64)
+        self.frames = np.ones((10, 32, 32)) * self.bkg[:, None, None]
+        self.frames[:, 14:18, 14:18] += 100
+        self.frames[:, 2, 3] = 1e4
+        self.frames[:, 30, 30] = np.nan
+
+    def test_methods(self):
+        np.testing.assert_allclose(self.ira.get_background(self.frames, 'median'), self.bkg)
+        np.testing.assert_allclose(self.ira.get_background(self.frames, 'annulus', x=15.5, y=15.5), self.bkg)
+        np.testing.assert_allclose(self.ira.get_background(self.frames, 'corners'), self.bkg)
+
+    def test_mask(self):
+        mask = np.zeros((10, 32, 32), dtype=np.int16)
+        mask[:, :, :16] = 1 << 3
+        self.frames[:, :, :16] = 1e3
+
+        np.testing.assert_allclose(self.ira.get_background(self.frames, 'corners', mask=mask), self.bkg)
+        self.assertFalse(bad_pixels(mask, bits=1 << 2).any())
+
+
+class ApertureTest(unittest.TestCase):
+    def setUp(self):
+        self.ira = IRA()
+
+    def test_circle_overlap(self):
+        self.assertAlmostEqual(circle_overlap(0, 1, 0, 1, 1), np.pi / 4)
+        self.assertAlmostEqual(circle_overlap(-5, 5, -5, 5, 2), 4 * np.pi)
+        self.assertAlmostEqual(circle_overlap(1, 2, 1, 2, 1), 0)
+
+    def test_photometry(self):
+        rng = np.random.RandomState(0)
+        frames = np.ones((100, 32, 32)) * 2
+        x, y = rng.uniform(10, 20, 100), rng.uniform(10, 20, 100)
+
+        # Aperture partly outside the frame
+        x[0] = 1
+
+        flux = self.ira.aperture_photometry(frames, x, y, [2, 3.5], background=1)
+
+        self.assertEqual(flux.shape, (100, 2))
+        self.assertTrue(np.all(np.isnan(flux[0])))
+        np.testing.assert_allclose(flux[1:], np.pi * np.array([[4, 12.25]]).repeat(99, axis=0))
+
+    def test_weights_cache(self):
+        weights = aperture_weights([2], bins=4)
+
+        self.assertIs(aperture_weights([2], bins=4), weights)
+        self.assertFalse(weights.flags.writeable)
+
+        # Sweeping over many apertures only keeps the most recent
+        for r in np.linspace(1, 3, 20):
+            aperture_weights([r], bins=4)
+
+        self.assertLessEqual(len(_weights_cache), 8)
+
+
+class PLDTest(unittest.TestCase):
+    def setUp(self):
+        self.ira = IRA()
+
+        rng = np.random.RandomState(0)
+        self.stamps = rng.uniform(1, 2, (1000, 3, 3))
+        self.times = np.linspace(0, 1, 1000)
+        self.coeffs = np.append(rng.normal(size=9), 0.5)
+        self.flux = np.dot(design_matrix(self.stamps, self.times, 1), self.coeffs)
+
+    def test_fit(self):
+        pld = self.ira.pld(self.stamps, self.flux, self.times, order=1)
+
+        np.testing.assert_allclose(pld.coeffs, self.coeffs, atol=1e-8)
+        np.testing.assert_allclose(pld.model(self.stamps, self.times), self.flux, atol=1e-8)
+
+    def test_update(self):
+        pld = PLD(order=1)
+
+        for i in range(0, 1000, 300):
+            pld.update(self.stamps[i:i + 300], self.flux[i:i + 300], self.times[i:i + 300])
+
+        self.assertEqual(pld.n_frames, 1000)
+        np.testing.assert_allclose(pld.coeffs, self.coeffs, atol=1e-8)
+
+
+class OutlierTest(unittest.TestCase):
+    def setUp(self):
+        self.ira = IRA()
+
+        rng = np.random.RandomState(0)
+        self.frames = rng.normal(10, 1, (200, 8, 8))
+
+        # A cosmic ray, a flickering hot pixel and a bad frame
+        self.frames[50, 2, 3] = 1000
+        self.frames[::3, 5, 5] += 50
+        self.frames[120] += 100
+
+    def test_rolling_median(self):
+        frames = np.arange(20, dtype=np.float64)[:, None, None] * np.ones((20, 2, 2))
+
+        np.testing.assert_array_equal(rolling_median(frames, 5)[2:-2], frames[2:-2])
+
+    def test_outlier_mask(self):
+        mask = self.ira.outlier_mask(self.frames)
+
+        self.assertTrue(mask[50, 2, 3])
+        self.assertEqual(list(zip(*np.nonzero(hot_pixels(mask)))), [(5, 5)])
+        self.assertEqual(list(np.nonzero(bad_frames(mask, 0.5))[0]), [120])
+
+        stack = Stack(self.frames, np.arange(200.0))
+        idx, max_val = self.ira.get_brightest(stack, mask=mask)
+
+        self.assertNotEqual(idx, (50, 2, 3))
+        self.assertLess(max_val, 1000)